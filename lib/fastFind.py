@@ -1,7 +1,8 @@
 from __future__ import print_function
 # fast search for combination of words using dictionaries
 
-import doctest, gzip, marshal, optparse, sys, codecs, logging
+import doctest, gzip, marshal, optparse, sys, codecs, logging, struct, zlib, mmap, time, \
+    collections, os, tempfile, hashlib, glob
 from os.path import *
 
 # as we use the regexes only to find \w, the original re module
@@ -18,6 +19,18 @@ SYMRE = re.compile(r"[\w'.]+")
 
 DASHWORDRE = re.compile(r"[\w'-]+")
 
+# compiled Aho-Corasick lexicons, see writeAcLex()
+ACEXT = ".lexac"
+ACMAGIC = "PUBLEXA1"
+ACHEADERFMT = "<IIIII"  # stateCount, slotCount, statesOffset, slotsOffset, poolOffset
+ACSTATEFMT = "<iiiii"   # failState, outState, depth, idOffset, idLength
+ACSLOTFMT = "<IIII"     # parentState+1 (0=empty slot), wordOffset, wordLength, childState
+# max number of entries of the transition cache of AcLex
+ACMAXCACHE = 2000000
+# a process that builds a lexicon in the cache dir has this many seconds
+# before other processes consider its lock stale
+ACLOCKTIMEOUT = 3600
+
 def recursiveAdd(dict, wordList, id):
     """
     recursively add the words from wordList to dictionary
@@ -177,6 +190,8 @@ def fastFind(text, lex, wordRe=WORDRE, toLower=True):
     if toLower:
         text = text.lower()
     words = splitText(text, wordRe)
+    if isinstance(lex, AcLex):
+        return lex.findWords(words)
     matches = []
     for i in range(0, len(words)):
         recursiveFind(words, i, lex, matches)
@@ -196,6 +211,8 @@ def fastFindFlankWords(text, lex, wordDist=1, wordRe=WORDRE, toLower=True):
     if toLower:
         text = text.lower()
     words = splitText(text, wordRe)
+    if isinstance(lex, AcLex):
+        return lex.findWords(words, flankCount=wordDist)
     matches = []
     for i in range(0, len(words)):
         recursiveFind(words, i, lex, matches, flankCount=wordDist)
@@ -236,8 +253,80 @@ def _lexIter(fileObj, toLower=False):
         #for name in names:
         yield (id, names)
 
-def loadLex(fname):
-    " load compiled dictionary (=gziped marshalled file) "
+def acLexName(fname):
+    """ return the name of the Aho-Corasick version of a compiled dictionary
+    >>> acLexName("data/genes/geneNames.marshal.gz")
+    'data/genes/geneNames.lexac'
+    """
+    return join(dirname(fname), basename(fname).split(".")[0]+ACEXT)
+
+def fileSha1(fname):
+    " return the hex sha1 of a file's content "
+    sha1 = hashlib.sha1()
+    fh = open(fname, "rb")
+    while True:
+        data = fh.read(1024*1024)
+        if len(data)==0:
+            break
+        sha1.update(data)
+    fh.close()
+    return sha1.hexdigest()
+
+def getCachedAcLex(fname, cacheDir):
+    """ return the path of the Aho-Corasick version of the lexicon fname in
+    cacheDir, usually a node-local directory. The file is named by a checksum of
+    the absolute path of fname and one of its content, so lexicons with the same
+    name in different directories do not replace each other. If it does not exist
+    yet, one process builds it, all others wait for it.
+    """
+    lexBase = basename(fname).split(".")[0]
+    pathSha1 = hashlib.sha1(abspath(fname)).hexdigest()[:8]
+    acPrefix = join(cacheDir, "%s.%s." % (lexBase, pathSha1))
+    acName = "%s%s%s" % (acPrefix, fileSha1(fname)[:16], ACEXT)
+    lockName = acName+".lock"
+    while not isfile(acName):
+        try:
+            lockFd = os.open(lockName, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError:
+            # another process is building it
+            if isfile(lockName) and time.time()-getmtime(lockName) > ACLOCKTIMEOUT:
+                logging.warn("Removing stale lock %s" % lockName)
+                os.remove(lockName)
+            time.sleep(1)
+            continue
+
+        try:
+            if not isfile(acName):
+                logging.info("Building Aho-Corasick lexicon %s from %s" % (acName, fname))
+                # older versions of the same lexicon file are not needed anymore
+                for oldName in glob.glob(acPrefix+"*"+ACEXT):
+                    os.remove(oldName)
+                writeAcLex(loadLex(fname, preferAc=False), acName)
+        finally:
+            os.close(lockFd)
+            os.remove(lockName)
+    return acName
+
+def loadLex(fname, preferAc=True, cacheDir=None):
+    """ load compiled dictionary (=gziped marshalled file).
+    If there is an up-to-date .lexac file next to it or fname is a .lexac file,
+    return an AcLex object instead, which fastFind() accepts like a dictionary.
+    If cacheDir is set, build the .lexac file there if needed, so all processes
+    on a machine share the same memory-mapped lexicon.
+    """
+    acName = acLexName(fname)
+    if fname.endswith(ACEXT) or \
+            (preferAc and isfile(acName) and getmtime(acName) >= getmtime(fname)):
+        logging.debug("Using Aho-Corasick lexicon %s" % acName)
+        return AcLex(acName)
+
+    if preferAc and cacheDir is not None:
+        try:
+            return AcLex(getCachedAcLex(fname, cacheDir))
+        except IOError:
+            # fname has changed and another process has just replaced the old version
+            return AcLex(getCachedAcLex(fname, cacheDir))
+
     if fname.endswith(".gz"):
         data = gzip.open(fname).read()
     else:
@@ -245,6 +334,230 @@ def loadLex(fname):
     lex = marshal.loads(data)
     return lex
 
+def _wordBytes(word):
+    " lexicon words and ids are stored as utf8 "
+    if isinstance(word, unicode):
+        return word.encode("utf8")
+    return str(word)
+
+def writeAcLex(lex, fname):
+    """ compile a nested-dict lexicon from constructLex() into a flat
+    Aho-Corasick automaton over words and write it to fname.
+    The file is a header, a table of states, an open-addressing hash table
+    of (state, word) -> state transitions and a pool of words and ids.
+    States are numbered in breadth-first order, 0 is the root.
+    """
+    stateIds = [None]  # id string of each state
+    stateDepths = [0]
+    children = [{}]     # state -> dict word -> child state
+    queue = collections.deque([(0, lex)])
+    while len(queue)!=0:
+        state, subDict = queue.popleft()
+        for word, subLex in subDict.iteritems():
+            if word==0:
+                if state!=0:
+                    stateIds[state] = _wordBytes(subLex)
+                continue
+            child = len(stateIds)
+            stateIds.append(None)
+            stateDepths.append(stateDepths[state]+1)
+            children.append({})
+            children[state][_wordBytes(word)] = child
+            queue.append((child, subLex))
+
+    # failure links: longest suffix of a state's words that is also a state
+    # out links: the next state on the failure path that has an id
+    stateCount = len(stateIds)
+    fails = [0]*stateCount
+    outs = [-1]*stateCount
+    for state in range(stateCount): # breadth-first: fails[state] is already known
+        for word, child in children[state].iteritems():
+            if state!=0:
+                fail = fails[state]
+                while fail!=0 and word not in children[fail]:
+                    fail = fails[fail]
+                fails[child] = children[fail].get(word, 0)
+            failState = fails[child]
+            if stateIds[failState]!=None:
+                outs[child] = failState
+            else:
+                outs[child] = outs[failState]
+
+    # string pool with words and ids
+    pool = []
+    poolOffsets = {}
+    poolLen = [0]
+    def addToPool(string):
+        if string not in poolOffsets:
+            poolOffsets[string] = poolLen[0]
+            pool.append(string)
+            poolLen[0] += len(string)
+        return poolOffsets[string]
+
+    stateData = []
+    for state in range(stateCount):
+        idStr = stateIds[state]
+        if idStr==None:
+            idOffset, idLen = -1, 0
+        else:
+            idOffset, idLen = addToPool(idStr), len(idStr)
+        stateData.append(struct.pack(ACSTATEFMT, fails[state], outs[state], stateDepths[state], \
+            idOffset, idLen))
+
+    transCount = stateCount-1
+    slotCount = 2
+    while slotCount < 2*transCount:
+        slotCount *= 2
+    mask = slotCount-1
+    slots = [None]*slotCount
+    for state in range(stateCount):
+        for word, child in children[state].iteritems():
+            slot = zlib.crc32(word, state) & mask
+            while slots[slot]!=None:
+                slot = (slot+1) & mask
+            slots[slot] = (state+1, addToPool(word), len(word), child)
+    emptySlot = struct.pack(ACSLOTFMT, 0, 0, 0, 0)
+    slotData = [emptySlot if s==None else struct.pack(ACSLOTFMT, *s) for s in slots]
+
+    statesOffset = len(ACMAGIC)+struct.calcsize(ACHEADERFMT)
+    slotsOffset = statesOffset + stateCount*struct.calcsize(ACSTATEFMT)
+    poolOffset = slotsOffset + slotCount*struct.calcsize(ACSLOTFMT)
+
+    tmpName = fname+".tmp"
+    ofh = open(tmpName, "wb")
+    ofh.write(ACMAGIC)
+    ofh.write(struct.pack(ACHEADERFMT, stateCount, slotCount, statesOffset, slotsOffset, poolOffset))
+    ofh.write("".join(stateData))
+    ofh.write("".join(slotData))
+    ofh.write("".join(pool))
+    ofh.close()
+    os.rename(tmpName, fname)
+    logging.info("Wrote Aho-Corasick lexicon with %d states to %s" % (stateCount, fname))
+
+class AcLex(object):
+    """ a lexicon compiled with writeAcLex(). The file is mmap'ed, so loading is
+    instant and the pages are shared between processes. Lookups are cached.
+    Use it like a lexicon from loadLex(), with fastFind() and fastFindFlankWords().
+
+    >>> lex = constructLex([("p1", ["how are"]), ("p2", ["you doing", "are you"]), ("p3", ["how are you"])])
+    >>> fname = tempfile.mktemp(suffix=ACEXT)
+    >>> writeAcLex(lex, fname)
+    >>> acLex = loadLex(fname)
+    >>> fastFind("how   are  you doing?", acLex)
+    [(0, 14, 'p3')]
+    >>> fastFind("you doing? how are", acLex)
+    [(0, 9, 'p2'), (11, 18, 'p1')]
+    >>> fastFind(u"are you doing", acLex)
+    [(0, 7, 'p2')]
+    >>> fastFindFlankWords("word0 how are word3", acLex)
+    [(6, 13, 'p1', ['word0'], ['word3'])]
+    >>> acLex.close(); os.remove(fname)
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.fh = open(fname, "rb")
+        self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(ACMAGIC)]!=ACMAGIC:
+            raise Exception("%s is not a compiled Aho-Corasick lexicon" % fname)
+        self.stateCount, self.slotCount, self.statesOffset, self.slotsOffset, self.poolOffset = \
+            struct.unpack_from(ACHEADERFMT, self.mm, len(ACMAGIC))
+        self.mask = self.slotCount-1
+        self.stateSize = struct.calcsize(ACSTATEFMT)
+        self.slotSize = struct.calcsize(ACSLOTFMT)
+        self.gotoCache = {}
+        self.stateCache = {}
+
+    def _goto(self, state, word):
+        " return the child of state for word or -1 "
+        key = (state, word)
+        child = self.gotoCache.get(key)
+        if child is not None:
+            return child
+
+        mm = self.mm
+        wordStr = _wordBytes(word)
+        wordLen = len(wordStr)
+        child = -1
+        slot = zlib.crc32(wordStr, state) & self.mask
+        while True:
+            parent, wordOffset, slotWordLen, slotChild = \
+                struct.unpack_from(ACSLOTFMT, mm, self.slotsOffset+slot*self.slotSize)
+            if parent==0:
+                break
+            if parent==state+1 and slotWordLen==wordLen:
+                start = self.poolOffset+wordOffset
+                if mm[start:start+wordLen]==wordStr:
+                    child = slotChild
+                    break
+            slot = (slot+1) & self.mask
+
+        if len(self.gotoCache) > ACMAXCACHE:
+            self.gotoCache.clear()
+        self.gotoCache[key] = child
+        return child
+
+    def _state(self, state):
+        " return (failState, outState, depth, idOffset, idLength) "
+        info = self.stateCache.get(state)
+        if info is None:
+            info = struct.unpack_from(ACSTATEFMT, self.mm, self.statesOffset+state*self.stateSize)
+            self.stateCache[state] = info
+        return info
+
+    def findWords(self, words, flankCount=0):
+        """ given a list of (start, end, word), return the longest non-overlapping
+        matches as (start, end, id), like recursiveFind() on all words """
+        # run the automaton and keep the longest match for each start word
+        longest = {}
+        state = 0
+        gotoCache = self.gotoCache
+        for wordIdx, (start, end, word) in enumerate(words):
+            child = gotoCache.get((state, word))
+            if child is None:
+                child = self._goto(state, word)
+            while child==-1 and state!=0:
+                state = self._state(state)[0]
+                child = self._goto(state, word)
+            if child==-1:
+                # the root has no matches
+                continue
+            state = child
+
+            fail, out, depth, idOffset, idLen = self._state(state)
+            if idOffset==-1:
+                matchState = out
+            else:
+                matchState = state
+            while matchState > 0:
+                fail, out, depth, idOffset, idLen = self._state(matchState)
+                # later matches for the same start word are longer
+                longest[wordIdx-depth+1] = (wordIdx, idOffset, idLen)
+                matchState = out
+
+        # go from left to right, skip matches that overlap the last one
+        matches = []
+        lastEnd = -1
+        for startIdx in sorted(longest):
+            endIdx, idOffset, idLen = longest[startIdx]
+            start = words[startIdx][0]
+            if start <= lastEnd:
+                continue
+            end = words[endIdx][1]
+            idStart = self.poolOffset+idOffset
+            matchId = self.mm[idStart:idStart+idLen]
+            if flankCount!=0:
+                leftWords = onlyWords(leftFlank(words, startIdx, flankCount))
+                rightWords = onlyWords(rightFlank(words, endIdx, flankCount))
+                matches.append((start, end, matchId, leftWords, rightWords))
+            else:
+                matches.append((start, end, matchId))
+            lastEnd = end
+        return matches
+
+    def close(self):
+        self.mm.close()
+        self.fh.close()
+
 def parseDict(fname, wordRe=WORDRE, toLower=False):
     """
     reads file (identifier<tab>name1|name2|name3|...)
@@ -287,10 +600,11 @@ def writeLex(lex, fname):
     binFile.write(str)
     logging.info("Wrote compiled dictionary to %s" % fname)
 
-def compileDict(dictFname, wordRe=WORDRE, toLower=False):
+def compileDict(dictFname, wordRe=WORDRE, toLower=False, writeAc=False):
     """
     convert dictionary file to memory data structure and write to gzipped marshalled file
     dictionary file lines have format <identifier> tab <name1>|<name2>|...
+    If writeAc is set, also write the Aho-Corasick version, see writeAcLex().
     """
     lex = parseDict(dictFname, wordRe, toLower)
     dictBase = basename(dictFname).split(".")[0]
@@ -300,14 +614,73 @@ def compileDict(dictFname, wordRe=WORDRE, toLower=False):
         ext = ".marshal"
     fname = join(dirname(dictFname), dictBase+ext)
     writeLex(lex, fname)
+    if writeAc:
+        writeAcLex(lex, acLexName(fname))
+
+def benchmarkLex(lexFname, textFnames, wordRe=WORDRE, toLower=True):
+    """ compare the nested-dict lexicon lexFname (.marshal.gz) with its
+    Aho-Corasick version: load time, matching time on the text files and the
+    matches. The .lexac file is written to a temp dir. Prints to stdout.
+    """
+    texts = [codecs.open(fname, "r", "utf8").read() for fname in textFnames]
+    textSize = sum([len(t) for t in texts])
+
+    startTime = time.time()
+    lex = loadLex(lexFname, preferAc=False)
+    dictLoadTime = time.time()-startTime
+
+    tmpDir = tempfile.mkdtemp(prefix="fastFindBench")
+    acFname = join(tmpDir, basename(acLexName(lexFname)))
+    startTime = time.time()
+    writeAcLex(lex, acFname)
+    compileTime = time.time()-startTime
+
+    startTime = time.time()
+    acLex = loadLex(acFname)
+    acLoadTime = time.time()-startTime
+
+    startTime = time.time()
+    dictMatches = [fastFind(text, lex, wordRe=wordRe, toLower=toLower) for text in texts]
+    dictFindTime = time.time()-startTime
+
+    startTime = time.time()
+    acMatches = [fastFind(text, acLex, wordRe=wordRe, toLower=toLower) for text in texts]
+    acFindTime = time.time()-startTime
+
+    # second run, with a warm transition cache
+    startTime = time.time()
+    for text in texts:
+        fastFind(text, acLex, wordRe=wordRe, toLower=toLower)
+    acFindTime2 = time.time()-startTime
+
+    diffCount = len([1 for d, a in zip(dictMatches, acMatches) if d!=a])
+    matchCount = sum([len(m) for m in dictMatches])
+    acSize = getsize(acFname)
+    acLex.close()
+    os.remove(acFname)
+    os.rmdir(tmpDir)
+
+    print("lexicon %s, %d text files, %d characters, %d matches" % \
+        (lexFname, len(texts), textSize, matchCount))
+    print("%-30s %10s %10s" % ("", "dict", "ahoCorasick"))
+    print("%-30s %10.3f %10.3f" % ("load time (sec)", dictLoadTime, acLoadTime))
+    print("%-30s %10.3f %10.3f" % ("find time (sec)", dictFindTime, acFindTime))
+    print("%-30s %10s %10.3f" % ("find time, warm cache (sec)", "", acFindTime2))
+    print("%-30s %10s %10.3f" % ("compile time (sec)", "", compileTime))
+    print("%-30s %10d %10d" % ("file size (bytes)", getsize(lexFname), acSize))
+    print("text files with different matches: %d" % diffCount)
 
 if __name__ == "__main__":
     parser = optparse.OptionParser("usage: %prog [options] dictFile files - scan files for strings")
     #parser.add_option("d", "--dictDir", dest="test", action="store_true", help="do something")
     parser.add_option("-t", "--test", dest="test", action="store_true", help="run tests")
+    parser.add_option("-b", "--bench", dest="bench", action="store_true", help="benchmark: compare dictFile (a .marshal.gz file) with its Aho-Corasick version on the text files")
     (options, args) = parser.parse_args()
     if options.test:
         _test()
+    elif options.bench:
+        logging.basicConfig(level=logging.WARN)
+        benchmarkLex(args[0], args[1:])
     elif len(args)==0:
         parser.print_help()
     else:
@@ -35,7 +35,7 @@
 # standard python libraries for regex
 import sys, logging, os.path, gzip, glob, doctest, marshal, types, operator 
 from collections import defaultdict, Counter
-import fastFind, pubConf, maxbio, pubDnaFind, seqMapLocal, pubGeneric, pubKeyVal
+import fastFind, pubConf, maxbio, pubDnaFind, seqMapLocal, pubGeneric, pubKeyVal, geneMapDb
 from os.path import *
 
 # try to use re2 if possible
@@ -324,7 +324,7 @@ def initData(markerTypes=None, exclMarkerTypes=None, addOptional=False):
             global geneNameLex
             fname = join(GENEDATADIR, "geneNames.marshal.gz")
             logging.info("Loading %s" % fname)
-            geneNameLex = fastFind.loadLex(fname)
+            geneNameLex = fastFind.loadLex(fname, cacheDir=pubConf.getLexCacheDir())
             continue
 
         # special case for bands
@@ -341,7 +341,7 @@ def initData(markerTypes=None, exclMarkerTypes=None, addOptional=False):
             global geneSymLex
             fname = join(GENEDATADIR, "symbols.marshal.gz")
             logging.info("Loading %s" % fname)
-            geneSymLex = fastFind.loadLex(fname)
+            geneSymLex = fastFind.loadLex(fname, cacheDir=pubConf.getLexCacheDir())
 
             global symLeftReqWords, symRightReqWords
             symLeftReqWords = readBestWords(join(GENEDATADIR, "left.tab"), 500)
@@ -808,6 +808,8 @@ upToSym = None
 entrezToUp = None
 symToEntrez = None
 entrezToSym = None
+# compiled mapping db, if it exists the dicts above are dict-like views of it
+geneMap = None
 
 # these are the annotations that are already entrez IDs and don't need to be 
 # resolved
@@ -834,17 +836,35 @@ def entrezSymbol(entrezId):
     entrezId = int(entrezId)
     return entrezToSym.get(entrezId, "invalidEntrezId")
 
-def loadMappings():
+def loadMappings(taxId=9606):
+    """ load the mappings accession -> uniprot -> entrez -> symbol. If pubPrepGeneDir
+    geneMap was run, they are read from the compiled mapping db through mmap, otherwise or if
+    the marshal files are newer than the mapping db, the marshal files are loaded into dicts. """
     global accToUps, upToEntrez, upToSym, entrezToUp, pmidToEntrez, entrezToSym, symToEntrez
+    global geneMap
+    fname = geneMapDb.gmapFname(GENEDATADIR, taxId)
+    if geneMapDb.isUpToDate(GENEDATADIR, taxId):
+        logging.info("Opening %s" % fname)
+        geneMap = geneMapDb.GeneMapDb(fname)
+        views = geneMap.views()
+        accToUps = views["accToUps"]
+        upToEntrez = views["upToEntrez"]
+        upToSym = views["upToSym"]
+        entrezToUp = views["entrezToUp"]
+        entrezToSym = views["entrezToSym"]
+        symToEntrez = views["symToEntrez"]
+        return
+
+    geneMap = None
     fname = join(GENEDATADIR, "uniprot.tab.marshal")
     logging.info("Loading %s" % fname)
-    data = marshal.load(open(fname, "rb"))[9606]
+    data = marshal.load(open(fname, "rb"))[taxId]
     accToUps = data["accToUps"]
     upToEntrez = data["upToEntrez"]
     upToSym = data["upToSym"]
     entrezToUp = data["entrezToUp"]
 
-    fname = join(GENEDATADIR, "entrez.9606.tab.marshal")
+    fname = join(GENEDATADIR, "entrez.%d.tab.marshal" % taxId)
     logging.info("Loading %s" % fname)
     data = marshal.load(open(fname, "rb"))
     entrezToSym = data["entrez2sym"]
@@ -933,7 +953,11 @@ def markerToGenes(markerType, markerId):
         markerId = markerId.upper()
 
     # normal case for most markers: two-step resolution acc -> uniprot -> entrez gene
-    if markerId in accToUps:
+    if geneMap!=None:
+        geneIds = geneMap.accToGenes(markerId)
+        logging.debug("Marker %s -> genes %s"  % (markerId, geneIds))
+        return geneIds
+    elif markerId in accToUps:
         #logging.debug("%s is in accToups" % markerId)
         upIds = accToUps[markerId]
         geneIds = {}
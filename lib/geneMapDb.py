@@ -0,0 +1,398 @@
+# compiled gene identifier mappings for geneFinder: accession -> uniprot -> entrez gene -> symbol
+
+# A mapping db is a single file per taxon, written by pubPrepGeneDir from uniprot.tab.marshal
+# and entrez.<taxId>.tab.marshal. All IDs are stored as integers: entrez gene IDs as
+# themselves, uniprot IDs, accessions and symbols as their index in a sorted string table.
+# The file is read through mmap and queried with binary searches, so opening it is
+# instantaneous and all processes on a machine share the same pages.
+
+import logging, struct, mmap, marshal, os
+from os.path import join, isfile
+
+import pubKeyVal
+
+GMAPMAGIC = "PUBGMAP1"
+GMAPHEADERFMT = "<8sII" # magic, taxId, number of sections
+GMAPSECTFMT = "<QQ"     # offset and length in bytes of a section
+GMAPHEADERSIZE = struct.calcsize(GMAPHEADERFMT)
+GMAPSECTSIZE = struct.calcsize(GMAPSECTFMT)
+uint32 = struct.Struct("<I")
+
+# the sections of the file, in this order. String tables are two sections: uint32 end offsets
+# of the strings and their concatenated bytes. "Lists" are two sections: uint32 end offsets
+# into the values and the int32 values. -1 means "no symbol" or "no entrez ID".
+SECTIONS = [
+    "upEnds", "upStrs",          # sorted uniprot IDs
+    "upSym",                     # uniprot index -> symbol index
+    "upEntrezEnds", "upEntrez",  # uniprot index -> list of entrez IDs
+    "accEnds", "accStrs",        # sorted accessions
+    "accUpEnds", "accUps",       # accession index -> list of uniprot indexes
+    "entrezIds",                 # sorted entrez IDs
+    "entrezSym",                 # entrez index -> symbol index
+    "entrezUpEnds", "entrezUps", # entrez index -> list of uniprot indexes
+    "symEnds", "symStrs",        # sorted symbols
+    "symEntrez",                 # symbol index -> entrez ID
+    ]
+
+def gmapFname(dataDir, taxId):
+    " return the name of the mapping db of a taxon "
+    return join(dataDir, "geneMap.%d.gmap" % int(taxId))
+
+class IntArray(object):
+    " read-only sequence of 32bit ints in a mmap "
+    def __init__(self, mm, offset, length, signed):
+        self.mm = mm
+        self.offset = offset
+        self.count = length/4
+        self.st = struct.Struct(signed and "<i" or "<I")
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i<0 or i>=self.count:
+            raise IndexError(i)
+        return self.st.unpack_from(self.mm, self.offset+4*i)[0]
+
+    def find(self, val):
+        " return the index of val or -1, a binary search "
+        unpack, mm, offset = self.st.unpack_from, self.mm, self.offset
+        lo, hi = 0, self.count
+        while lo<hi:
+            mid = (lo+hi)//2
+            if unpack(mm, offset+4*mid)[0]<val:
+                lo = mid+1
+            else:
+                hi = mid
+        if lo<self.count and unpack(mm, offset+4*lo)[0]==val:
+            return lo
+        return -1
+
+class StrTable(object):
+    " read-only sorted sequence of strings in a mmap "
+    def __init__(self, ends, mm, offset):
+        self.ends = ends
+        self.mm = mm
+        self.offset = offset
+
+    def __len__(self):
+        return len(self.ends)
+
+    def __getitem__(self, i):
+        end = self.ends[i]
+        start = 0
+        if i>0:
+            start = self.ends[i-1]
+        return self.mm[self.offset+start:self.offset+end]
+
+    def find(self, s):
+        " return the index of s or -1, a binary search "
+        if not isinstance(s, str):
+            s = pubKeyVal.toBytes(s)
+        unpack, mm, endsOffset, offset = uint32.unpack_from, self.mm, self.ends.offset, self.offset
+        lo, hi = 0, len(self.ends)
+        while lo<hi:
+            mid = (lo+hi)//2
+            if mid==0:
+                start = 0
+            else:
+                start = unpack(mm, endsOffset+4*mid-4)[0]
+            if mm[offset+start:offset+unpack(mm, endsOffset+4*mid)[0]]<s:
+                lo = mid+1
+            else:
+                hi = mid
+        if lo<len(self.ends) and self[lo]==s:
+            return lo
+        return -1
+
+class IntLists(object):
+    " read-only sequence of int lists in a mmap "
+    def __init__(self, ends, values):
+        self.ends = ends
+        self.values = values
+
+    def __getitem__(self, i):
+        start = 0
+        if i>0:
+            start = self.ends[i-1]
+        return [self.values[j] for j in range(start, self.ends[i])]
+
+class MapView(object):
+    """ read-only dict-like view of one of the mappings, so code that used the old dicts,
+    e.g. geneFinder.entrezToSym.get(), works unchanged. Nothing is loaded into memory. """
+    def __init__(self, lookup, keys):
+        self.lookup = lookup
+        self.keyFunc = keys
+
+    def get(self, key, default=None):
+        val = self.lookup(key)
+        if val is None:
+            return default
+        return val
+
+    def __getitem__(self, key):
+        val = self.lookup(key)
+        if val is None:
+            raise KeyError(key)
+        return val
+
+    def __contains__(self, key):
+        return self.lookup(key) is not None
+
+    def __len__(self):
+        return len(self.keyFunc())
+
+    def keys(self):
+        return list(self.keyFunc())
+
+    def iteritems(self):
+        for key in self.keyFunc():
+            yield key, self.lookup(key)
+
+class GeneMapDb(object):
+    """ the mappings of geneFinder.loadMappings, read from a compiled mapping db.
+
+    >>> writeGeneMapDb("/tmp/geneMapTest.gmap", 9606, {"accToUps": {"X05790": ["P06280"]},
+    ...     "upToEntrez": {"P06280": [2717]}, "upToSym": {"P06280": "GLA"},
+    ...     "entrezToUp": {2717: ["P06280"]}}, {2717: "GLA", 5308: "PITX2"})
+    >>> db = GeneMapDb("/tmp/geneMapTest.gmap")
+    >>> db.accToGenes("X05790"), db.accToGenes("X0"), db.entrezToSym(5308), db.symToEntrez("GLA")
+    ({2717: 'GLA'}, None, 'PITX2', 2717)
+    >>> db.upToEntrez("P06280"), db.entrezToUp(2717), db.entrezToUp(5308), db.upToSym("Q1")
+    ([2717], ['P06280'], None, None)
+    >>> db.views()["entrezToSym"].get(1, "none"), 2717 in db.views()["entrezToUp"]
+    ('none', True)
+    >>> os.remove("/tmp/geneMapTest.gmap")
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.ifh = open(fname, "rb")
+        self.mm = mmap.mmap(self.ifh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.taxId, sectCount = struct.unpack_from(GMAPHEADERFMT, self.mm, 0)
+        if magic!=GMAPMAGIC or sectCount!=len(SECTIONS):
+            raise Exception("%s is not a gene mapping db" % fname)
+        sects = {}
+        for i, name in enumerate(SECTIONS):
+            sects[name] = struct.unpack_from(GMAPSECTFMT, self.mm, GMAPHEADERSIZE+i*GMAPSECTSIZE)
+
+        def ints(name, signed=False):
+            offset, length = sects[name]
+            return IntArray(self.mm, offset, length, signed)
+
+        def strs(name):
+            return StrTable(ints(name+"Ends"), self.mm, sects[name+"Strs"][0])
+
+        self.ups = strs("up")
+        self.upSym = ints("upSym", True)
+        self.upEntrez = IntLists(ints("upEntrezEnds"), ints("upEntrez", True))
+        self.accs = strs("acc")
+        self.accUps = IntLists(ints("accUpEnds"), ints("accUps", True))
+        self.entrezIds = ints("entrezIds")
+        self.entrezSym = ints("entrezSym", True)
+        self.entrezUps = IntLists(ints("entrezUpEnds"), ints("entrezUps", True))
+        self.syms = strs("sym")
+        self.symEntrez = ints("symEntrez", True)
+
+    def _sym(self, symIdx):
+        if symIdx==-1:
+            return None
+        return self.syms[symIdx]
+
+    def _entrezIdx(self, entrezId):
+        try:
+            return self.entrezIds.find(int(entrezId))
+        except ValueError:
+            return -1
+
+    def accToUps(self, acc):
+        " return the list of uniprot IDs of an accession or None "
+        accIdx = self.accs.find(acc)
+        if accIdx==-1:
+            return None
+        return [self.ups[upIdx] for upIdx in self.accUps[accIdx]]
+
+    def accToGenes(self, acc):
+        " resolve acc -> uniprot -> entrez, return a dict entrezId -> symbol or None "
+        accIdx = self.accs.find(acc)
+        if accIdx==-1:
+            return None
+        geneIds = {}
+        for upIdx in self.accUps[accIdx]:
+            sym = self._sym(self.upSym[upIdx]) or ""
+            for gene in self.upEntrez[upIdx]:
+                geneIds[gene] = sym
+        return geneIds
+
+    def upToEntrez(self, upId):
+        upIdx = self.ups.find(upId)
+        if upIdx==-1:
+            return None
+        genes = self.upEntrez[upIdx]
+        if len(genes)==0:
+            return None
+        return genes
+
+    def upToSym(self, upId):
+        upIdx = self.ups.find(upId)
+        if upIdx==-1:
+            return None
+        return self._sym(self.upSym[upIdx])
+
+    def entrezToUp(self, entrezId):
+        entrezIdx = self._entrezIdx(entrezId)
+        if entrezIdx==-1:
+            return None
+        upIdxs = self.entrezUps[entrezIdx]
+        if len(upIdxs)==0:
+            return None
+        return [self.ups[upIdx] for upIdx in upIdxs]
+
+    def entrezToSym(self, entrezId):
+        entrezIdx = self._entrezIdx(entrezId)
+        if entrezIdx==-1:
+            return None
+        return self._sym(self.entrezSym[entrezIdx])
+
+    def symToEntrez(self, sym):
+        symIdx = self.syms.find(sym)
+        if symIdx==-1:
+            return None
+        entrezId = self.symEntrez[symIdx]
+        if entrezId==-1:
+            return None
+        return entrezId
+
+    def _keys(self, strTable, valFunc):
+        " return the keys of a string table that have a value "
+        return [strTable[i] for i in range(len(strTable)) if valFunc(i)]
+
+    def views(self):
+        " return a dict name -> dict-like MapView with the names of the old geneFinder dicts "
+        return {
+            "accToUps" : MapView(self.accToUps, lambda: list(self.accs)),
+            "upToEntrez" : MapView(self.upToEntrez, \
+                lambda: self._keys(self.ups, lambda i: len(self.upEntrez[i])!=0)),
+            "upToSym" : MapView(self.upToSym, \
+                lambda: self._keys(self.ups, lambda i: self.upSym[i]!=-1)),
+            "entrezToUp" : MapView(self.entrezToUp, \
+                lambda: [e for i, e in enumerate(self.entrezIds) if len(self.entrezUps[i])!=0]),
+            "entrezToSym" : MapView(self.entrezToSym, \
+                lambda: [e for i, e in enumerate(self.entrezIds) if self.entrezSym[i]!=-1]),
+            "symToEntrez" : MapView(self.symToEntrez, \
+                lambda: self._keys(self.syms, lambda i: self.symEntrez[i]!=-1)),
+            }
+
+    def close(self):
+        self.mm.close()
+        self.ifh.close()
+
+def _strTable(strs):
+    " return the end offsets and the concatenated bytes of a sorted list of strings "
+    ends = []
+    end = 0
+    for s in strs:
+        end += len(s)
+        ends.append(end)
+    return ends, "".join(strs)
+
+def _intLists(keys, keyToList, valFunc):
+    " return the end offsets and values of the lists of keys "
+    ends = []
+    values = []
+    for key in keys:
+        for val in keyToList.get(key, []):
+            values.append(valFunc(val))
+        ends.append(len(values))
+    return ends, values
+
+def writeGeneMapDb(fname, taxId, upData, entrezToSym):
+    """ write a mapping db from the uniprot.tab.marshal dict of a taxon and a dict
+    entrezId -> symbol """
+    toBytes = pubKeyVal.toBytes
+    accToUps = dict([(toBytes(k), [toBytes(u) for u in v]) for k, v in upData["accToUps"].iteritems()])
+    upToEntrez = dict([(toBytes(k), [int(e) for e in v]) for k, v in upData["upToEntrez"].iteritems()])
+    upToSym = dict([(toBytes(k), toBytes(v)) for k, v in upData["upToSym"].iteritems()])
+    entrezToUp = dict([(int(k), [toBytes(u) for u in v]) for k, v in upData["entrezToUp"].iteritems()])
+    # same as the inversion that geneFinder.loadMappings did, a symbol of several genes is
+    # resolved to the last one in the order of the marshal dict
+    symToEntrez = dict([(toBytes(y),int(x)) for (x,y) in entrezToSym.iteritems()])
+    entrezToSym = dict([(int(k), toBytes(v)) for k, v in entrezToSym.iteritems()])
+
+    upSet = set(upToEntrez).union(upToSym)
+    for upList in accToUps.values()+entrezToUp.values():
+        upSet.update(upList)
+    ups = sorted(upSet)
+    upIdx = dict([(u, i) for i, u in enumerate(ups)])
+    syms = sorted(set(upToSym.values()).union(entrezToSym.values()))
+    symIdx = dict([(s, i) for i, s in enumerate(syms)])
+    accs = sorted(accToUps)
+    entrezIds = sorted(set(entrezToSym).union(entrezToUp))
+
+    sects = {}
+    sects["upEnds"], sects["upStrs"] = _strTable(ups)
+    sects["upSym"] = [symIdx.get(upToSym.get(u), -1) for u in ups]
+    sects["upEntrezEnds"], sects["upEntrez"] = _intLists(ups, upToEntrez, int)
+    sects["accEnds"], sects["accStrs"] = _strTable(accs)
+    sects["accUpEnds"], sects["accUps"] = _intLists(accs, accToUps, upIdx.get)
+    sects["entrezIds"] = entrezIds
+    sects["entrezSym"] = [symIdx.get(entrezToSym.get(e), -1) for e in entrezIds]
+    sects["entrezUpEnds"], sects["entrezUps"] = _intLists(entrezIds, entrezToUp, upIdx.get)
+    sects["symEnds"], sects["symStrs"] = _strTable(syms)
+    sects["symEntrez"] = [symToEntrez.get(s, -1) for s in syms]
+
+    tmpName = fname+".tmp"
+    ofh = open(tmpName, "wb")
+    ofh.write(struct.pack(GMAPHEADERFMT, GMAPMAGIC, int(taxId), len(SECTIONS)))
+    ofh.write(len(SECTIONS)*GMAPSECTSIZE*"\0")
+    sectPos = []
+    for name in SECTIONS:
+        start = ofh.tell()
+        data = sects[name]
+        if isinstance(data, str):
+            ofh.write(data)
+        elif name.endswith("Ends") or name=="entrezIds":
+            pubKeyVal.writeArray(ofh, "I", data)
+        else:
+            pubKeyVal.writeArray(ofh, "i", data)
+        sectPos.append( (start, ofh.tell()-start) )
+    ofh.seek(GMAPHEADERSIZE)
+    for start, length in sectPos:
+        ofh.write(struct.pack(GMAPSECTFMT, start, length))
+    ofh.close()
+    os.rename(tmpName, fname)
+    logging.info("Wrote %d accessions, %d uniprot IDs, %d genes, %d symbols to %s" % \
+        (len(accs), len(ups), len(entrezIds), len(syms), fname))
+
+def sourceFnames(dataDir, taxId):
+    " return the marshal files of pubPrepGeneDir that the mapping db of taxId is compiled from "
+    return [join(dataDir, "uniprot.tab.marshal"), join(dataDir, "entrez.%d.tab.marshal" % int(taxId))]
+
+def isUpToDate(dataDir, taxId):
+    """ return True if the mapping db of taxId exists and is not older than the marshal files.
+    Logs an error if it is older, e.g. if pubPrepGeneDir uniprot was run without geneMap. """
+    fname = gmapFname(dataDir, taxId)
+    if not isfile(fname):
+        return False
+    gmapTime = os.path.getmtime(fname)
+    for srcFname in sourceFnames(dataDir, taxId):
+        if isfile(srcFname) and os.path.getmtime(srcFname) > gmapTime:
+            logging.error("%s is newer than %s, not using it. Run pubPrepGeneDir geneMap to update it." % \
+                (srcFname, fname))
+            return False
+    return True
+
+def compileGeneMaps(dataDir):
+    """ write a mapping db for every taxon in uniprot.tab.marshal in dataDir, with the symbols
+    from entrez.<taxId>.tab.marshal, if it exists """
+    fname = join(dataDir, "uniprot.tab.marshal")
+    logging.info("Loading %s" % fname)
+    allUpData = marshal.load(open(fname, "rb"))
+    for taxId, upData in allUpData.iteritems():
+        entrezToSym = {}
+        entrezFname = sourceFnames(dataDir, taxId)[1]
+        if isfile(entrezFname):
+            logging.info("Loading %s" % entrezFname)
+            entrezToSym = marshal.load(open(entrezFname, "rb"))["entrez2sym"]
+        else:
+            logging.warn("%s not found, no entrez gene symbols for taxon %s" % (entrezFname, taxId))
+        writeGeneMapDb(gmapFname(dataDir, taxId), taxId, upData, entrezToSym)
@@ -5,7 +5,8 @@ from future import standard_library
 standard_library.install_aliases()
 from past.utils import old_div
 import logging, os, sys, tempfile, csv, collections, types, codecs, gzip, \
-    os.path, re, glob, time, urllib.request, urllib.error, urllib.parse, doctest, http.client, socket, subprocess, shutil, atexit
+    os.path, re, glob, time, urllib.request, urllib.error, urllib.parse, doctest, http.client, socket, subprocess, shutil, atexit, \
+    threading, queue
 from types import *
 from os.path import isfile, isdir, getsize, abspath, realpath, dirname
 from collections import defaultdict
@@ -231,6 +232,98 @@ class TsvReader(object):
     def seek(self, pos):
         self.ifh.seek(pos)
 
+class LruCache(object):
+    " a dict with at most maxSize keys, the least recently used key is removed first "
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self.data = collections.OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        if key not in self.data:
+            return default
+        val = self.data.pop(key)
+        self.data[key] = val
+        return val
+
+    def put(self, key, val):
+        self.data.pop(key, None)
+        if len(self.data) >= self.maxSize:
+            self.data.popitem(last=False)
+        self.data[key] = val
+
+class PrefetchReader(object):
+    """ read-only file object that reads a file, gunzipping it if the name ends with .gz,
+    in a background thread in blocks of blockSize bytes, up to queueSize blocks ahead of
+    the reader. The decompression then runs while the caller, e.g. a parser, is
+    busy with the previous blocks. read() returns at most one block, like a pipe.
+    """
+    def __init__(self, fname, blockSize=1024*1024, queueSize=16):
+        self.name = fname
+        if fname.endswith(".gz"):
+            self.fh = gzip.open(fname, "rb")
+        else:
+            self.fh = open(fname, "rb")
+        self.blockSize = blockSize
+        self.queue = queue.Queue(queueSize)
+        self.block = b""
+        self.pos = 0
+        self.eof = False
+        self.closed = False
+        self.thread = threading.Thread(target=self._readBlocks)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _readBlocks(self):
+        " runs in the background thread "
+        try:
+            while not self.closed:
+                data = self.fh.read(self.blockSize)
+                self.queue.put(data)
+                if len(data)==0:
+                    break
+        except Exception as ex:
+            self.queue.put(ex)
+
+    def _nextBlock(self):
+        data = self.queue.get()
+        if isinstance(data, Exception):
+            raise data
+        if len(data)==0:
+            self.eof = True
+        self.block = data
+        self.pos = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            parts = [self.block[self.pos:]]
+            while not self.eof:
+                self._nextBlock()
+                parts.append(self.block)
+            self.block, self.pos = b"", 0
+            return b"".join(parts)
+
+        if self.pos >= len(self.block) and not self.eof:
+            self._nextBlock()
+        data = self.block[self.pos:self.pos+size]
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        " stop the background thread "
+        self.closed = True
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.fh.close()
+
 def iterTsvRows(inFile, headers=None, format=None, noHeaderCount=None, fieldTypes=None, encoding="utf8", fieldSep="\t", isGzip=False, skipLines=None, makeHeadersUnique=False, commentPrefix=None):
     """
         parses tab-sep file with headers as field names
@@ -447,6 +540,34 @@ def makedirs(path, quiet=False):
         if not quiet:
             raise
 
+def getFsType(path):
+    """ return the type of the filesystem of path from /proc/mounts, e.g. "ext4" or "nfs4".
+    None if it cannot be determined, e.g. not on Linux.
+    >>> getFsType("/proc")
+    'proc'
+    """
+    path = realpath(path)
+    if not isfile("/proc/mounts"):
+        return None
+    bestMount, bestType = "", None
+    for line in open("/proc/mounts"):
+        fields = line.split()
+        if len(fields) < 3:
+            continue
+        mountPoint = fields[1].replace("\\040", " ")
+        if path==mountPoint or path.startswith(mountPoint.rstrip("/")+"/"):
+            if len(mountPoint) >= len(bestMount):
+                bestMount, bestType = mountPoint, fields[2]
+    return bestType
+
+# filesystems where sqlite locking and WAL mode are unreliable
+NETWORKFSTYPES = set(["nfs", "nfs4", "cifs", "smbfs", "smb3", "fuse"])
+
+def isNetworkFs(path):
+    " return True if path is on NFS or another network filesystem, see getFsType "
+    fsType = getFsType(path)
+    return fsType is not None and fsType.split(".")[0] in NETWORKFSTYPES
+
 def appendTsvNamedtuple(filename, row):
     " append a namedtuple to a file. Write headers if file does not exist "
     if not os.path.isfile(filename):
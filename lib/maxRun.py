@@ -5,25 +5,212 @@ from __future__ import print_function
 # can also run python functions instead of commands by calling itself on the cluster
 # system and then calling the function (see main() and submitPythonFunc)
 
-import os, sys, logging, shutil, types, optparse, multiprocessing, subprocess, shlex, time, imp
+import os, sys, logging, shutil, types, optparse, multiprocessing, subprocess, shlex, time, imp, \
+    collections, hashlib
 import pubGeneric
-from os.path import isfile, join, basename, dirname, abspath
-
-def removeFinishedProcesses(processes):
-    " given a list of (commandString, process), remove those that have completed and return "
-    newProcs = []
-    for pollCmd, pollProc in processes:
-        retCode = pollProc.poll()
-        if retCode==None:
-            # still running
-            logging.debug("Still running %s" % pollCmd)
-            newProcs.append((pollCmd, pollProc))
-        elif retCode!=0:
-            # failed
-            raise Exception("Command %s failed" % pollCmd)
+from os.path import isfile, isdir, join, basename, dirname, abspath
+
+# seconds between two checks for finished smp jobs
+SMPPOLLSECS = 0.2
+
+# fields of the smpJobs.tab status file, one line is appended per finished job
+smpStatusFields = ["jobId", "status", "exitCode", "tryCount", "startTime", "endTime", "cpuSecs", "command"]
+
+def getTotalRamGb():
+    " return the physical memory of this machine in gigabytes, None if unknown "
+    if not isfile("/proc/meminfo"):
+        return None
+    for line in open("/proc/meminfo"):
+        if line.startswith("MemTotal:"):
+            return int(line.split()[1]) / (1024.0*1024.0)
+    return None
+
+class SmpScheduler(object):
+    """
+    runs commands on the local machine in parallel, similar to "para make":
+    - checks its own child processes with os.wait4(pid, WNOHANG), other children
+      of the process are not touched
+    - stdout and stderr of job <n> go to <batchDir>/smpLogs/<n>.out and <n>.err
+    - failed jobs are re-run up to maxTry times in total
+    - with maxRam (gigabytes per job), not more jobs than fit into RAM are started
+    - one line per finished job is appended to <batchDir>/smpJobs.tab, after a line with
+      the ID of the batch, the sha1 of the commands. When a batch with the same ID is
+      run again and the last run did not complete, e.g. after a crash or a failed job,
+      the jobs that completed are skipped. A batch that completed or a different list of
+      commands starts from scratch.
+    - with cleanUp, smpJobs.tab and the logs are removed when all jobs completed
+    Prints a summary like "para time" at the end and raises an exception if any job
+    failed maxTry times.
+    """
+    def __init__(self, batchDir, maxCpu, maxRam=None, maxTry=3, cleanUp=False):
+        self.batchDir = batchDir
+        self.maxCpu = maxCpu
+        self.maxRam = maxRam
+        self.maxTry = maxTry
+        self.cleanUp = cleanUp
+        self.statusFname = join(batchDir, "smpJobs.tab")
+        self.logDir = join(batchDir, "smpLogs")
+
+    def _batchId(self, commands):
+        " the ID of a list of commands "
+        cmdStr = "\n".join(commands)
+        if isinstance(cmdStr, unicode):
+            cmdStr = cmdStr.encode("utf8")
+        return hashlib.sha1(cmdStr).hexdigest()
+
+    def _readDoneCommands(self, batchId):
+        """ return the set of commands that completed in an earlier, incomplete run
+        of the same batch. None if there is nothing to resume. """
+        lastStatus = {}
+        if not isfile(self.statusFname):
+            return None
+        lines = open(self.statusFname).read().splitlines()
+        if len(lines)==0 or lines[0]!="#batch\t"+batchId:
+            logging.debug("%s is from another list of commands" % self.statusFname)
+            return None
+        if lines[-1]=="#complete":
+            logging.debug("%s is from a run that completed" % self.statusFname)
+            return None
+        for line in lines:
+            if line.startswith("#"):
+                continue
+            fields = line.split("\t")
+            if len(fields)!=len(smpStatusFields):
+                # last line can be incomplete if we were killed
+                continue
+            row = dict(zip(smpStatusFields, fields))
+            lastStatus[row["command"]] = row["status"]
+        return set([cmd for cmd, status in lastStatus.iteritems() if status=="done"])
+
+    def _maxParallel(self):
+        " number of jobs that can run at the same time, limited by CPUs and RAM "
+        maxParallel = self.maxCpu
+        if self.maxRam:
+            ramGb = getTotalRamGb()
+            if ramGb is not None:
+                maxParallel = max(1, min(maxParallel, int(ramGb // self.maxRam)))
+                logging.info("%.1f GB RAM and %d GB per job: running up to %d jobs" % \
+                    (ramGb, self.maxRam, maxParallel))
+        return maxParallel
+
+    def _start(self, jobId, command):
+        " start a job, return the tuple kept for running jobs "
+        outFh = open(join(self.logDir, "%d.out" % jobId), "w")
+        errFh = open(join(self.logDir, "%d.err" % jobId), "w")
+        logging.debug("Starting job %d: %s" % (jobId, command))
+        proc = subprocess.Popen(shlex.split(command), stdout=outFh, stderr=errFh)
+        return (jobId, proc, time.time(), outFh, errFh)
+
+    def _waitAny(self, running):
+        """ block until one of the pids in running has exited.
+        Return (pid, waitStatus, rusage) """
+        while True:
+            for pid in running:
+                retPid, waitStatus, rusage = os.wait4(pid, os.WNOHANG)
+                if retPid==pid:
+                    return pid, waitStatus, rusage
+            time.sleep(SMPPOLLSECS)
+
+    def run(self, commands):
+        " run all commands, skipping those that have completed in an interrupted run before "
+        if not isdir(self.logDir):
+            os.makedirs(self.logDir)
+
+        batchId = self._batchId(commands)
+        doneCmds = self._readDoneCommands(batchId)
+        queue = collections.deque()
+        for jobId, command in enumerate(commands):
+            if doneCmds is None or command not in doneCmds:
+                queue.append(jobId)
+        skipCount = len(commands)-len(queue)
+        if skipCount!=0:
+            logging.info("%d jobs completed in a previous run, not running them again" % skipCount)
+
+        if doneCmds is None:
+            statusFh = open(self.statusFname, "w")
+            statusFh.write("#batch\t"+batchId+"\n")
+            statusFh.write("#"+"\t".join(smpStatusFields)+"\n")
         else:
-            logging.info("Command %s completed successfully" % pollCmd)
-    return newProcs
+            statusFh = open(self.statusFname, "a")
+
+        maxParallel = self._maxParallel()
+        logging.info("Running %d commands on localhost, up to %d at a time, logs in %s" % \
+            (len(queue), maxParallel, self.logDir))
+
+        tryCounts = collections.defaultdict(int)
+        running = {} # pid -> (jobId, proc, startTime, outFh, errFh)
+        jobTimes = []
+        cpuSecs = 0.0
+        failedIds = []
+        batchStart = time.time()
+
+        while len(queue)!=0 or len(running)!=0:
+            while len(queue)!=0 and len(running) < maxParallel:
+                jobId = queue.popleft()
+                tryCounts[jobId] += 1
+                jobInfo = self._start(jobId, commands[jobId])
+                running[jobInfo[1].pid] = jobInfo
+
+            # block until one of our jobs exits
+            pid, waitStatus, rusage = self._waitAny(running)
+            jobId, proc, startTime, outFh, errFh = running.pop(pid)
+            outFh.close()
+            errFh.close()
+            if os.WIFEXITED(waitStatus):
+                exitCode = os.WEXITSTATUS(waitStatus)
+            else:
+                exitCode = -os.WTERMSIG(waitStatus)
+            proc.returncode = exitCode # we have reaped it, Popen must not wait again
+
+            endTime = time.time()
+            jobCpu = rusage.ru_utime + rusage.ru_stime
+            cpuSecs += jobCpu
+            if exitCode==0:
+                status = "done"
+                jobTimes.append(endTime-startTime)
+            elif tryCounts[jobId] < self.maxTry:
+                status = "retry"
+                logging.warn("Job %d failed with exit code %d, retrying. See %s/%d.err" % \
+                    (jobId, exitCode, self.logDir, jobId))
+                queue.append(jobId)
+            else:
+                status = "failed"
+                logging.error("Job %d failed %d times, last exit code %d. Command: %s" % \
+                    (jobId, tryCounts[jobId], exitCode, commands[jobId]))
+                failedIds.append(jobId)
+
+            row = [str(jobId), status, str(exitCode), str(tryCounts[jobId]), "%d" % startTime, \
+                "%d" % endTime, "%.1f" % jobCpu, commands[jobId]]
+            statusFh.write("\t".join(row)+"\n")
+            statusFh.flush()
+
+        if len(failedIds)==0:
+            statusFh.write("#complete\n")
+        statusFh.close()
+        self._logSummary(len(commands), skipCount, jobTimes, cpuSecs, failedIds, time.time()-batchStart)
+
+        if len(failedIds)!=0:
+            raise Exception("%d jobs failed, see %s and the logs in %s" % \
+                (len(failedIds), self.statusFname, self.logDir))
+
+        if self.cleanUp:
+            logging.info("Deleting %s and %s" % (self.statusFname, self.logDir))
+            os.remove(self.statusFname)
+            shutil.rmtree(self.logDir)
+
+    def _logSummary(self, jobCount, skipCount, jobTimes, cpuSecs, failedIds, wallSecs):
+        " log job counts and times, like 'para time' "
+        logging.info("Completed: %d of %d jobs" % (len(jobTimes)+skipCount, jobCount))
+        if skipCount!=0:
+            logging.info("Completed in previous runs: %d jobs" % skipCount)
+        if len(failedIds)!=0:
+            logging.info("Crashed: %d jobs" % len(failedIds))
+        logging.info("CPU time in finished jobs: %10ds %10.2fm %8.2fh %7.2fd" % \
+            (cpuSecs, cpuSecs/60, cpuSecs/3600, cpuSecs/86400))
+        if len(jobTimes)!=0:
+            logging.info("Average job time:          %10ds" % (sum(jobTimes)/len(jobTimes)))
+            logging.info("Longest finished job:      %10ds" % max(jobTimes))
+        logging.info("Submission to last job:    %10ds" % wallSecs)
 
 def removeParasolTags(command):
     " removes the special parasol check tags from a command "
@@ -48,7 +235,8 @@ class Runner:
     """
 
     def __init__(self, clusterType="auto", headNode=None, queue=None, dryRun=False, \
-        logDir=None, delayTime=None, maxPush=700000, maxJob=None, batchDir=".", runNow=False, maxRam=None):
+        logDir=None, delayTime=None, maxPush=700000, maxJob=None, batchDir=".", runNow=False, maxRam=None, \
+        maxTry=3):
         """ create joblist on parasol, do nothing on SGE 
             clusterType can be "local"(singlethread), "smp" (multithread), "sge" or "parasol"
 
@@ -58,6 +246,7 @@ class Runner:
 
             delayTime, maxPush, maxJob are only used for parasol
             queue is only used for SGE
+            maxTry is only used for smp: how often a failed job is run
         """
         self.clusterType = clusterType
         if self.clusterType=="localhost":
@@ -78,6 +267,8 @@ class Runner:
         batchDir = abspath(batchDir)
         self.batchDir = batchDir
         self.maxRam = maxRam
+        self.maxTry = maxTry
+        self.maxCpu = multiprocessing.cpu_count()
         self.headNode = None
 
         self.commands = [] # for smp commands
@@ -290,24 +481,9 @@ class Runner:
             pass
 
         elif self.clusterType=="smp":
-            # adapted from http://stackoverflow.com/questions/4992400/running-several-system-commands-in-parallel
-            logging.info("Running %d commands on localhost on %d CPUs" % (len(self.commands), self.maxCpu))
-            processes = []
-            for cmdCount, command in enumerate(self.commands):
-                logging.info("Starting process %s" % command)
-                proc =  subprocess.Popen(shlex.split(command))
-                procTuple = (command, proc)
-                processes.append(procTuple)
-                while len(processes) >= self.maxCpu:
-                    logging.debug("Waiting: totalCmd=%d, procCount=%d, cpuCount=%d, current=%d, ..." % \
-                        (len(self.commands), len(processes), self.maxCpu, cmdCount))
-                    time.sleep(1.0)
-                    processes = removeFinishedProcesses(processes)
-
-            # wait for all processes
-            while len(processes)>0:
-                time.sleep(0.5)
-                processes = removeFinishedProcesses(processes)
+            scheduler = SmpScheduler(self.batchDir, self.maxCpu, maxRam=self.maxRam, maxTry=self.maxTry, \
+                cleanUp=cleanUp)
+            scheduler.run(self.commands)
             logging.info("All processes completed")
 
 
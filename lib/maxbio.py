@@ -39,10 +39,10 @@ def openFile(fname, mode="r"):
 
 def flattenValues(dict):
     """ return all values in dictionary (key -> list) as one long flat list """
-    list = []
+    flatList = []
     for value in list(dict.values()):
-        list.extend(value)
-    return list
+        flatList.extend(value)
+    return flatList
 
 def writeToTsv(fileObj, rec):
     """ writes a namedtuple to a file as a tab-sep line """
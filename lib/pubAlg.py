@@ -9,7 +9,8 @@ from __future__ import print_function
 # module will call itself on the compute nodes if run on a cluster (->findFileSubmitJobs)
 
 import logging, sys, os, shutil, glob, optparse, copy, types, string, gzip, \
-    doctest, marshal, random
+    doctest, marshal, random, multiprocessing, multiprocessing.util, collections, heapq, zlib, \
+    sqlite3, hashlib, time
 
 from os.path import *
 from maxCommon import *
@@ -19,6 +20,16 @@ import pubGeneric, maxRun, pubConf, pubStore, maxCommon
 # extension of map output files
 MAPREDUCEEXT = ".marshal.gz"
 
+# streaming reduce: number of values kept in memory before they are written as sorted runs
+RUNMAXVALUES = 1000000
+# streaming reduce: maximum number of runs that are merged at the same time
+MERGEMAXRUNS = 200
+
+# parameters that do not change the rows of an annotator, ignored for the annotation cache
+NOCACHEPARAMS = set(["addFields", "fusedOutDirs", "annotCache"])
+# number of new rows that the annotation cache keeps in memory before it writes them
+ANNOTCACHEBATCH = 1000
+
 def loadClass(aMod, className, quiet=False):
     " try to find class in a module and return it if found, otherwise None "
     logging.debug("trying to load class %s" % className)
@@ -129,6 +140,8 @@ def findFiles(dataset):
     if dataDir==None:
         raise Exception("error in input data spec")
     fnames.extend(glob.glob(join(dataDir, "*.articles.gz")))
+    if len(fnames)==0:
+        fnames.extend(glob.glob(join(dataDir, "*.articles.col")))
     if len(fnames)==0:
         raise Exception("Could not find any *.articles.gz files in %s"% dataDir)
 
@@ -156,12 +169,13 @@ def findArticleBasenames(dataset, updateIds=None):
 
 def findFilesSubmitJobs(algNames, algMethod, inDirs, outDirs, outExt, \
         paramDict, runNow=False, cleanUp=False, updateIds=None, \
-        batchDir=".", runner=None, addFields=None, inDirExt=None):
+        batchDir=".", runner=None, addFields=None, inDirExt=None, fused=False):
     """ find data zip files and submit one map job per zip file
         Jobs call pubAlg.pyc and then run the algMethod-method of algName
 
         cleanUp: remove temporary files
         runNow: wil block until jobs are completed, then return
+        fused: submit only one job per zip file that runs all annotators, see runAnnotateFused()
 
         If a list of updateIds is specified, run only on files with one of these updateIds
         Returns the list of baseNames, e.g. 0_00000,0_00001, etc that it ran on
@@ -192,6 +206,10 @@ def findFilesSubmitJobs(algNames, algMethod, inDirs, outDirs, outExt, \
         logging.debug("Batch runner was supplied")
         paramDir = runner.batchDir
 
+    if fused:
+        return submitFusedJobs(algNames, inDirs, outDirs, outExt, paramDict, paramDir, \
+            runner, runNow=runNow, cleanUp=cleanUp, updateIds=updateIds)
+
     algCount = 0
     outNames = set()
     for algName, outDir in zip(algNames, outDirs):
@@ -232,6 +250,43 @@ def findFilesSubmitJobs(algNames, algMethod, inDirs, outDirs, outExt, \
         os.remove(paramFname)
     return list(outNames)
 
+def submitFusedJobs(algNames, inDirs, outDirs, outExt, paramDict, paramDir, runner, \
+        runNow=False, cleanUp=False, updateIds=None):
+    """ submit one annotate job per input chunk that runs all algNames over it.
+    The job gets the output file of the first algorithm, the other output
+    directories are in the parameter "fusedOutDirs".
+    """
+    outDirs = [abspath(d) for d in outDirs]
+    if paramDir==None:
+        paramDir = outDirs[0]
+    # the same annotId ranges as with one job per algorithm
+    for algCount, algName in enumerate(algNames):
+        if algName.startswith("java"):
+            raise Exception("java algorithms cannot run fused: %s" % algName)
+        paramKey = "startAnnotId."+basename(algName).split(".")[0]
+        if paramKey not in paramDict and len(algNames)>1:
+            paramDict[paramKey] = str(algCount*(10**pubConf.ANNOTDIGITS/len(algNames)))
+    paramDict["fusedOutDirs"] = outDirs
+    paramFname = join(paramDir, "fused.algParams.marshal.gz")
+    writeParamDict(paramDict, paramFname)
+
+    outNames = set()
+    for inDir in inDirs:
+        logging.debug("input directory %s" % inDir)
+        for inFile in findArticleBasenames(inDir, updateIds):
+            inBase = basename(inDir)+"_"+splitext(basename(inFile))[0]
+            outNames.add(inBase)
+            outFullname = join(outDirs[0], inBase)+outExt
+            command = "%s %s %s %s %s {check out exists %s} %s" % \
+                (sys.executable, __file__, ",".join(algNames), "annotateFused", inFile, \
+                outFullname, paramFname)
+            runner.submit(command)
+
+    runner.finish(wait=runNow, cleanUp=cleanUp)
+    if cleanUp:
+        os.remove(paramFname)
+    return list(outNames)
+
 #def getDataIterator(alg, reader):
 #    """ depending on the field "runOn" return the right
 #     type of iterator of the reader
@@ -375,16 +430,26 @@ def extendAnnotatorRow(annotId, articleData, headers, row, addFields, text):
 
     return fields
 
-def iterAnnotRows(alg, articleData, fileData, annotId, addFields):
+def iterAnnotRows(alg, articleData, fileData, annotId, addFields, cache=None):
     """
     Run the algorithm alg over the text data in fileData.
     Prefix with annotation and article IDs and postfix with a snippet
     Return next free annotation id.
+    If cache is an AnnotCache, the rows of texts that are in the cache are not annotated again.
     """
     text = fileData.content.replace("\a", "\n")
     fileData = fileData._replace(content=text)
 
-    annots = alg.annotateFile(articleData, fileData)
+    if cache is None:
+        annots = alg.annotateFile(articleData, fileData)
+    else:
+        cacheKey = cache.makeKey(fileData)
+        annots = cache.get(cacheKey)
+        if annots is None:
+            annots = alg.annotateFile(articleData, fileData)
+            if annots is not None:
+                annots = list(annots)
+            cache.put(cacheKey, annots)
     if annots==None:
         return
 
@@ -423,7 +488,8 @@ def getHeaders(alg, addFields):
         for i, addField in enumerate(addFields):
             headers.insert(2+i, addField)
 
-    if headers[-1]!="snippet" and headers[:2]==('start', 'end'):
+    # same condition as in extendAnnotatorRow
+    if alg.headers[-1]!="snippet" and alg.headers[:2]==['start', 'end']:
         headers.append("snippet")
     return headers
 
@@ -526,6 +592,13 @@ class Ret:
   # an empty struct, to be filled with values, for getAlgPrefs
   pass
 
+def openSentLayer(inName):
+    " load the sentences of the chunk of inName for pubNlp.sectionSentences, if they were precomputed "
+    sentFname = pubStore.makeChunkPath(dirname(inName), basename(inName).split(".")[0], "sents")
+    if isfile(sentFname):
+        import pubNlp # most algorithms do not need it
+        pubNlp.openSentLayer(sentFname)
+
 def getAlgPrefs(alg, paramDict):
     """ algorithms can specify what type of input they prefer to run on.
     pull out the four attributes onlyMain, onlyMeta, preferPdf and preferXml
@@ -591,36 +664,226 @@ def runAnnotate(reader, alg, paramDict, outName):
     Starts a new output file if an empty row is returned from the annotator.
     """
     addFields = paramDict.get("addFields", [])
-    tmpFnames = []
-    outFh, tmpFnames = newTempOutFile(tmpFnames, outName, alg, addFields)
-
-    for row in runAnnotateIter(reader, alg, paramDict, addFields):
-        if len(row)==0 and outName!="stdout":
-            outFh.close()
-            outFh, tmpFnames = newTempOutFile(tmpFnames, outName, alg, addFields)
-            continue
-
-        #row = [pubStore.removeTabNl(x) for x in row]
-        writeRow(row, outFh)
-        #line = "\t".join(row)
-        #outFh.write(line)
-        #outFh.write("\n")
+    rows = runAnnotateIter(reader, alg, paramDict, addFields)
+    writeAnnotRows(rows, alg, outName, addFields)
 
     if "cleanup" in dir(alg):
         logging.info("Running cleanup")
         alg.cleanup()
 
-    if outName!="stdout":
-        outFh.close()
-        moveManyTempToFinal(tmpFnames, outName)
+class AnnotRowWriter(object):
+    """ writes annotation rows of alg to outName via local tempfiles, starts a new file
+    on empty rows. The files are moved to outName by close().
+    """
+    def __init__(self, alg, outName, addFields):
+        self.alg = alg
+        self.outName = outName
+        self.addFields = addFields
+        self.tmpFnames = []
+        self.outFh, self.tmpFnames = newTempOutFile(self.tmpFnames, outName, alg, addFields)
+
+    def write(self, row):
+        if len(row)==0 and self.outName!="stdout":
+            self.outFh.close()
+            self.outFh, self.tmpFnames = newTempOutFile(self.tmpFnames, self.outName, \
+                self.alg, self.addFields)
+            return
+
+        #row = [pubStore.removeTabNl(x) for x in row]
+        writeRow(row, self.outFh)
+
+    def close(self):
+        if self.outName!="stdout":
+            self.outFh.close()
+            moveManyTempToFinal(self.tmpFnames, self.outName)
+
+def writeAnnotRows(rows, alg, outName, addFields):
+    """ write annotation rows to outName via local tempfiles, start a new file
+    on empty rows.
+    """
+    writer = AnnotRowWriter(alg, outName, addFields)
+    for row in rows:
+        writer.write(row)
+    writer.close()
+
+def getAlgVersion(alg, paramDict):
+    """ return a hash of the source code of alg, its optional "version" attribute and the
+    parameters that it gets. Changes of other modules that alg imports are not detected, an
+    annotator can set a "version" attribute for this.
+    """
+    if isinstance(alg, types.ModuleType):
+        algMod = alg
+    else:
+        algMod = sys.modules[alg.__class__.__module__]
+    srcFname = algMod.__file__
+    if srcFname.endswith(".pyc"):
+        srcFname = srcFname[:-1]
+    h = hashlib.sha1(open(srcFname, "rb").read())
+    h.update(str(getattr(alg, "version", "")))
+    params = [(key, val) for key, val in sorted(paramDict.iteritems()) \
+        if key not in NOCACHEPARAMS and not key.startswith("startAnnotId")]
+    h.update(repr(params))
+    return h.hexdigest()[:16]
+
+class AnnotCache(object):
+    """ sqlite file with the rows that annotators returned for a text, so annotateFile()
+    does not have to run again on the same text, e.g. when an article is re-released.
+    The key is the name and version of the annotator (getAlgVersion) and the sha1 of the file
+    type and text. Only the rows of the annotator are stored, annotIds, article fields and
+    snippets are added again by iterAnnotRows. So it is only correct for annotators that
+    look only at the text of the file and not at the article meta data or at other files.
+    New rows are written in batches. The table "stats" has the total size of the rows and
+    the hits and misses per annotator. When the total is bigger than maxMb, the least
+    recently used rows are removed on close(). The file has to be on a filesystem with
+    working locks, sqlite files on NFS can get corrupted, see openAnnotCache.
+    """
+    def __init__(self, fname, alg, paramDict, maxMb=None):
+        self.fname = fname
+        self.algName = alg.algName
+        self.keyPrefix = "%s:%s:" % (alg.algName, getAlgVersion(alg, paramDict))
+        if maxMb is None:
+            maxMb = pubConf.annotCacheMaxMb
+        self.maxBytes = maxMb*1000000
+        logging.info("Opening annotation cache %s for %s" % (fname, self.keyPrefix))
+        # long timeout: all jobs of a batch write to the same file
+        self.con = sqlite3.connect(fname, timeout=600)
+        self.con.text_factory = str
+        with self.con:
+            self.con.execute("CREATE TABLE IF NOT EXISTS rows "
+                "(key TEXT PRIMARY KEY, value BLOB, size INTEGER, lastUsed INTEGER)")
+            self.con.execute("CREATE INDEX IF NOT EXISTS rowsLastUsed ON rows (lastUsed)")
+            # counters: totalSize, hits:<algName> and misses:<algName>
+            self.con.execute("CREATE TABLE IF NOT EXISTS stats "
+                "(name TEXT PRIMARY KEY, value INTEGER)")
+            self.con.execute("INSERT OR IGNORE INTO stats VALUES ('totalSize', 0)")
+        self.hits = 0
+        self.misses = 0
+        self.usedKeys = []
+        self.newRows = []
+
+    def makeKey(self, fileData):
+        " return the key of a file "
+        content = fileData.content
+        if isinstance(content, unicode):
+            content = content.encode("utf8")
+        return self.keyPrefix+hashlib.sha1(str(fileData.fileType)+"\0"+content).hexdigest()
+
+    def get(self, key):
+        " return the list of rows of key or None if it is not in the cache "
+        res = self.con.execute("SELECT value FROM rows WHERE key=?", (key,)).fetchone()
+        if res is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.usedKeys.append(key)
+        return marshal.loads(zlib.decompress(res[0]))
+
+    def put(self, key, rows):
+        " store the rows of key, None is stored as an empty list "
+        if rows is None:
+            rows = []
+        try:
+            value = zlib.compress(marshal.dumps([list(row) for row in rows]))
+        except ValueError:
+            logging.warn("Annotator rows cannot be marshalled, not caching them: %s" % rows[:3])
+            return
+        self.newRows.append( (key, buffer(value), len(key)+len(value), int(time.time())) )
+        if len(self.newRows)>=ANNOTCACHEBATCH:
+            self.flush()
+
+    def _addStat(self, name, val):
+        " add val to a counter in the stats table, has to run in a transaction "
+        self.con.execute("INSERT OR IGNORE INTO stats VALUES (?, 0)", (name,))
+        self.con.execute("UPDATE stats SET value=value+? WHERE name=?", (val, name))
+
+    def flush(self):
+        " write new rows and the access times of the rows that were found "
+        now = int(time.time())
+        with self.con:
+            # a key that another job has added in the meantime has the same rows
+            addedSize = 0
+            for row in self.newRows:
+                if self.con.execute("INSERT OR IGNORE INTO rows VALUES (?, ?, ?, ?)", row).rowcount==1:
+                    addedSize += row[2]
+            self._addStat("totalSize", addedSize)
+            self.con.executemany("UPDATE rows SET lastUsed=? WHERE key=?", \
+                [(now, key) for key in self.usedKeys])
+        self.newRows = []
+        self.usedKeys = []
+
+    def _evict(self):
+        " remove the least recently used rows until the cache is 10% smaller than maxBytes "
+        totalSize = self.con.execute("SELECT value FROM stats WHERE name='totalSize'").fetchone()[0]
+        if totalSize <= self.maxBytes:
+            return 0
+        minFree = totalSize-int(0.9*self.maxBytes)
+        oldRows = []
+        freed = 0
+        for key, size in self.con.execute("SELECT key, size FROM rows ORDER BY lastUsed"):
+            oldRows.append( (key, size) )
+            freed += size
+            if freed >= minFree:
+                break
+        delCount = 0
+        with self.con:
+            # another job may have removed some of them already
+            freed = 0
+            for key, size in oldRows:
+                if self.con.execute("DELETE FROM rows WHERE key=?", (key,)).rowcount==1:
+                    freed += size
+                    delCount += 1
+            self._addStat("totalSize", -freed)
+        return delCount
+
+    def close(self):
+        " write everything, update the statistics and shrink the cache if needed "
+        self.flush()
+        with self.con:
+            self._addStat("hits:"+self.algName, self.hits)
+            self._addStat("misses:"+self.algName, self.misses)
+        evictCount = self._evict()
+        self.con.close()
+        total = self.hits+self.misses
+        logging.info("Annotation cache %s: %d hits, %d misses, hit rate %.1f%%, %d rows removed" % \
+            (self.fname, self.hits, self.misses, 100.0*self.hits/max(total, 1), evictCount))
+
+def openAnnotCache(alg, paramDict):
+    " return an AnnotCache if the parameter annotCache is set, otherwise None "
+    fname = paramDict.get("annotCache")
+    if fname is None:
+        return None
+    if maxCommon.isNetworkFs(dirname(abspath(fname))):
+        logging.error("%s is on a network filesystem, sqlite locking is not reliable there. "
+            "Not using the annotation cache." % fname)
+        return None
+    if "allResults" in dir(alg):
+        logging.warn("%s has an allResults() function, not using the annotation cache" % alg.algName)
+        return None
+    return AnnotCache(fname, alg, paramDict)
 
-def getStartAnnotId(alg, paramDict, fileId):
-    " get starting annotation ID for a given algorithm "
+def getStartAnnotId(alg, paramDict, fileId, annotIdAdd=None):
+    """ get starting annotation ID for a given algorithm. annotIdAdd is the
+    value returned by getAnnotIdStart, read from paramDict if not specified.
+    """
     annotDigits = int(pubConf.ANNOTDIGITS)
-    annotIdAdd = getAnnotIdStart(alg, paramDict)
+    if annotIdAdd is None:
+        annotIdAdd = getAnnotIdStart(alg, paramDict)
     annotIdStart = (int(fileId) * (10**annotDigits)) + annotIdAdd
     return annotIdStart
 
+def iterArticleAnnotRows(alg, articleData, fileDataList, annotIdAdd, addFields, cache=None):
+    " run alg over all files of an article and yield the rows, see iterAnnotRows for cache "
+    fileIds = [x.fileId for x in fileDataList]
+    logging.debug("Annotating article %s/%s with %d files, %s" % \
+        (articleData.articleId, articleData.externalId, len(fileDataList), fileIds))
+
+    for fileData in fileDataList:
+        annotId = getStartAnnotId(alg, None, fileData.fileId, annotIdAdd)
+        logging.debug("fileId %s, annotIdStart %d, fileLen %d" \
+            % (fileData.fileId, annotId, len(fileData.content)))
+        for row in iterAnnotRows(alg, articleData, fileData, annotId, addFields, cache):
+            yield row
+
 def runAnnotateIter(reader, alg, paramDict, addFields):
     """ annotate all articles in reader and yield a list of fields
     """
@@ -629,21 +892,17 @@ def runAnnotateIter(reader, alg, paramDict, addFields):
         alg.startup(paramDict)
 
     algPrefs = getAlgPrefs(alg, paramDict)
+    # the same offset for all files, so annotation IDs do not depend on the order of files
+    annotIdAdd = getAnnotIdStart(alg, paramDict)
+    cache = openAnnotCache(alg, paramDict)
 
     rowCount = 0
     for articleData, fileDataList in reader.iterArticlesFileList(algPrefs):
-
-        fileIds = [x.fileId for x in fileDataList]
-        logging.debug("Annotating article %s/%s with %d files, %s" % \
-            (articleData.articleId, articleData.externalId, len(fileDataList), fileIds))
-
-        for fileData in fileDataList:
-            annotId = getStartAnnotId(alg, paramDict, fileData.fileId)
-            logging.debug("fileId %s, annotIdStart %d, fileLen %d" \
-                % (fileData.fileId, annotId, len(fileData.content)))
-            for row in iterAnnotRows(alg, articleData, fileData, annotId, addFields):
-                yield row
-                rowCount += 1
+        for row in iterArticleAnnotRows(alg, articleData, fileDataList, annotIdAdd, addFields, cache):
+            yield row
+            rowCount += 1
+    if cache is not None:
+        cache.close()
 
     if "allResults" in dir(alg):
         assert(rowCount==0) # you cannot yield from annotFile() and also from results()
@@ -656,6 +915,187 @@ def runAnnotateIter(reader, alg, paramDict, addFields):
 
     logging.debug("Got %d rows from annotator" % rowCount)
 
+def runAnnotateFused(reader, algs, paramDict, outNames):
+    """ annotate all articles in reader with several algorithms in a single pass
+    over the reader: every article is read and decoded only once and then given to
+    all algorithms, each with the files that its algPrefs select. The rows of each
+    algorithm are written to its outName, like runAnnotate().
+    """
+    addFields = paramDict.get("addFields", [])
+    algPrefsList = []
+    annotIdAdds = []
+    caches = []
+    writers = []
+    for alg, outName in zip(algs, outNames):
+        if "allResults" in dir(alg):
+            raise Exception("%s has an allResults() function and cannot run fused" % alg.algName)
+        if "startup" in dir(alg):
+            logging.debug("Running startup of %s" % alg.algName)
+            alg.startup(paramDict)
+        algPrefsList.append(getAlgPrefs(alg, paramDict))
+        annotIdAdds.append(getAnnotIdStart(alg, paramDict))
+        caches.append(openAnnotCache(alg, paramDict))
+        writers.append(AnnotRowWriter(alg, outName, addFields))
+
+    # read the files only if at least one algorithm needs them
+    readPrefs = Ret()
+    readPrefs.onlyMeta = all([p.onlyMeta for p in algPrefsList])
+    readPrefs.onlyMain = readPrefs.preferPdf = readPrefs.preferXml = False
+
+    rowCounts = [0]*len(algs)
+    for articleData, fileDataList in reader.iterArticlesFileList(readPrefs):
+        for i, alg in enumerate(algs):
+            algFiles = fileDataList
+            if not readPrefs.onlyMeta:
+                algFiles = reader.filterFileList(articleData, fileDataList, algPrefsList[i])
+            for row in iterArticleAnnotRows(alg, articleData, algFiles, annotIdAdds[i], addFields, \
+                    caches[i]):
+                writers[i].write(row)
+                rowCounts[i] += 1
+
+    # the first output file is the one that the batch system checks, so it is moved last
+    for alg, writer, cache, rowCount in reversed(zip(algs, writers, caches, rowCounts)):
+        logging.debug("Got %d rows from annotator %s" % (rowCount, alg.algName))
+        if cache is not None:
+            cache.close()
+        writer.close()
+        if "cleanup" in dir(alg):
+            logging.info("Running cleanup of %s" % alg.algName)
+            alg.cleanup()
+
+# state of a worker process of an AnnotatorPool, set by _initAnnotWorker
+workerState = {}
+
+def _initAnnotWorker(algName, paramDict, addFields, annotIdAdd):
+    " load the annotator and run its startup, once per worker process "
+    alg = getAlg(algName, defClass="Annotate")
+    if "startup" in dir(alg):
+        logging.debug("Running startup in worker %d" % os.getpid())
+        alg.startup(paramDict)
+    if "cleanup" in dir(alg):
+        # run when the worker process exits
+        multiprocessing.util.Finalize(None, alg.cleanup, exitpriority=10)
+    workerState["alg"] = alg
+    workerState["paramDict"] = paramDict
+    workerState["addFields"] = addFields
+    workerState["annotIdAdd"] = annotIdAdd
+    workerState["recClasses"] = {}
+    cache = openAnnotCache(alg, paramDict)
+    if cache is not None:
+        multiprocessing.util.Finalize(None, cache.close, exitpriority=10)
+    workerState["cache"] = cache
+
+def _getRecClass(fields):
+    " namedtuple classes cannot be pickled, so they are re-created in the worker "
+    recClasses = workerState["recClasses"]
+    if fields not in recClasses:
+        recClasses[fields] = collections.namedtuple("tsvRec", fields)
+    return recClasses[fields]
+
+def _workerAlgPrefs(dummy):
+    " return the algPrefs of the worker's annotator as a dict "
+    return getAlgPrefs(workerState["alg"], workerState["paramDict"]).__dict__
+
+def _annotWorkerArticles(articles):
+    """ annotate a list of (articleFields, articleValues, fileFields, list of fileValues)
+    return a list of rows for each article
+    """
+    alg = workerState["alg"]
+    allRows = []
+    for artFields, artValues, fileFields, fileValuesList in articles:
+        articleData = _getRecClass(artFields)(*artValues)
+        fileDataList = []
+        if fileFields is not None:
+            FileRec = _getRecClass(fileFields)
+            fileDataList = [FileRec(*fileValues) for fileValues in fileValuesList]
+        rows = list(iterArticleAnnotRows(alg, articleData, fileDataList, \
+            workerState["annotIdAdd"], workerState["addFields"], workerState["cache"]))
+        allRows.append(rows)
+    return allRows
+
+class AnnotatorPool(object):
+    """ a pool of worker processes on the local machine that run the same annotator.
+    Each worker loads the annotator and runs its startup() only once.
+    runAnnotate() sends the articles of a reader to the workers and writes the rows
+    in the order of the articles, so the output is the same as with the
+    single-process runAnnotate().
+    """
+    def __init__(self, algName, paramDict, procCount, batchSize=10):
+        self.alg = getAlg(algName, defClass="Annotate")
+        if "allResults" in dir(self.alg):
+            raise Exception("%s has an allResults() function and cannot run in parallel" % algName)
+        self.batchSize = batchSize
+        self.addFields = paramDict.get("addFields", [])
+        paramDict = copy.copy(paramDict)
+        annotIdAdd = getAnnotIdStart(self.alg, paramDict)
+
+        logging.info("Starting %d worker processes for %s" % (procCount, algName))
+        self.pool = multiprocessing.Pool(procCount, _initAnnotWorker, \
+            (algName, paramDict, self.addFields, annotIdAdd))
+
+        # some algorithms set onlyMain etc. in their startup()
+        self.algPrefs = Ret()
+        self.algPrefs.__dict__.update(self.pool.apply(_workerAlgPrefs, (None,)))
+
+    def _iterBatches(self, articles):
+        " given (articleData, fileDataList) tuples, yield lists of articles in a format that can be pickled "
+        batch = []
+        for articleData, fileDataList in articles:
+            fileFields = None
+            if len(fileDataList)!=0:
+                fileFields = tuple(fileDataList[0]._fields)
+            batch.append((tuple(articleData._fields), tuple(articleData), \
+                fileFields, [tuple(f) for f in fileDataList]))
+            if len(batch)==self.batchSize:
+                yield batch
+                batch = []
+        if len(batch)!=0:
+            yield batch
+
+    def iterRows(self, reader):
+        " yield the annotation rows for all articles in reader, in article order "
+        articles = reader.iterArticlesFileList(self.algPrefs)
+        for batchRows in self.pool.imap(_annotWorkerArticles, self._iterBatches(articles)):
+            for rows in batchRows:
+                for row in rows:
+                    yield row
+
+    def annotateArticles(self, articles):
+        """ annotate a list of (articleData, fileDataList) and return a list of rows
+        for each article. Can be called from several threads at the same time. """
+        allRows = []
+        for batchRows in self.pool.map(_annotWorkerArticles, list(self._iterBatches(articles))):
+            allRows.extend(batchRows)
+        return allRows
+
+    def runAnnotate(self, reader, outName):
+        " annotate all articles in reader and write them to outName, like runAnnotate() "
+        rows = self.iterRows(reader)
+        writeAnnotRows(rows, self.alg, outName, self.addFields)
+
+    def close(self):
+        " stop the workers, this runs the annotator's cleanup() in each of them "
+        self.pool.close()
+        self.pool.join()
+
+def annotateLocal(algName, textDirs, paramDict, outDir, procCount, updateIds=None):
+    """ annotate all chunks in textDirs on the local machine with procCount
+    processes and write one .tab.gz file per chunk to outDir, with the same
+    names as the cluster jobs of annotate()
+    """
+    annotPool = AnnotatorPool(algName, paramDict, procCount)
+    for textDir in textDirs:
+        baseNames = findArticleBasenames(textDir, updateIds)
+        logging.info("Annotating %d chunks in %s" % (len(baseNames), textDir))
+        pm = maxCommon.ProgressMeter(len(baseNames))
+        for inFile in sorted(baseNames):
+            outFullname = join(abspath(outDir), basename(textDir)+"_"+basename(inFile))+".tab.gz"
+            reader = pubStore.openPubReader(inFile)
+            annotPool.runAnnotate(reader, outFullname)
+            reader.close()
+            pm.taskCompleted()
+    annotPool.close()
+
 def unmarshal(fname):
     if fname.endswith(".gz"):
         with gzip.open(fname, "rb") as f:
@@ -718,9 +1158,197 @@ def runMap(reader, alg, paramDict, outFname):
 
     moveTempToFinal(tmpOutFname, outFname)
 
+def openReduceOutput(alg, outFilename):
+    " open the reducer output file and write the headers, return None if outFilename is None "
+    logging.info("Writing to %s" % outFilename)
+    if outFilename==None:
+        ofh = None
+    elif outFilename=="stdout":
+        ofh = sys.stdout
+    else:
+        ofh = open(outFilename, "w")
+
+    if "headers" in dir(alg) and ofh!=None:
+        ofh.write("\t".join(alg.headers))
+        ofh.write("\n")
+    return ofh
+
+def writeReduceRows(alg, key, valList, ofh):
+    " run key and valList through the reducer and write the resulting rows to ofh "
+    tupleIterator = alg.reduce(key, valList)
+    for tuple in tupleIterator:
+        if tuple==None:
+            logging.debug("Got None, not writing anything")
+            continue
+        if type(tuple)==bytes: # make sure that returned value is a list
+            tuple = [tuple]
+        if type(tuple)==int: # make sure that it's a string
+            tuple = [str(tuple)]
+        tuple = [unicode(x).encode("utf8") for x in tuple] # convert to utf8
+        if ofh!=None:
+            ofh.write("\t".join(tuple))
+            ofh.write("\n")
+
+def keyPartition(key, partCount):
+    """ return the reduce partition of a key, the same in all processes
+    >>> keyPartition("hello", 1)
+    0
+    >>> keyPartition("hello", 4)==keyPartition("hello", 4)
+    True
+    """
+    return (zlib.crc32(marshal.dumps(key)) & 0xffffffff) % partCount
+
+def writeRun(data, fname):
+    " write a dict key -> list of values to fname as marshalled (key, values) records, sorted by key "
+    fh = open(fname, "wb")
+    for key in sorted(data):
+        marshal.dump((key, data[key]), fh)
+    fh.close()
+
+def iterRun(fname, runIdx):
+    " yield (key, runIdx, values) from a file written by writeRun "
+    fh = open(fname, "rb")
+    while True:
+        try:
+            key, valList = marshal.load(fh)
+        except EOFError:
+            break
+        yield key, runIdx, valList
+    fh.close()
+
+def iterMergedRuns(runFnames):
+    """ k-way merge of sorted runs. Yield (key, values), values of equal keys
+    are concatenated in the order of runFnames """
+    runIters = [iterRun(fname, runIdx) for runIdx, fname in enumerate(runFnames)]
+    lastKey = None
+    allVals = None
+    for key, runIdx, valList in heapq.merge(*runIters):
+        if allVals!=None and key==lastKey:
+            allVals.extend(valList)
+        else:
+            if allVals!=None:
+                yield lastKey, allVals
+            lastKey, allVals = key, list(valList)
+    if allVals!=None:
+        yield lastKey, allVals
+
+def mergeRunsToMax(runFnames, runDir, maxRuns=MERGEMAXRUNS):
+    """ merge runs into bigger runs until there are not more than maxRuns,
+    so the final merge does not need too many open files. Return new list of runs. """
+    passNo = 0
+    while len(runFnames) > maxRuns:
+        newFnames = []
+        for i in range(0, len(runFnames), maxRuns):
+            fnames = runFnames[i:i+maxRuns]
+            outFname = join(runDir, "%s.pass%d.%d" % (basename(fnames[0]), passNo, i))
+            fh = open(outFname, "wb")
+            for key, valList in iterMergedRuns(fnames):
+                marshal.dump((key, valList), fh)
+            fh.close()
+            for fname in fnames:
+                os.remove(fname)
+            newFnames.append(outFname)
+        runFnames = newFnames
+        passNo += 1
+    return runFnames
+
+def writeSortedRuns(fileNames, partCount, runDir, quiet=False):
+    """ read map output files and write their keys as sorted runs to runDir,
+    one set of runs per reduce partition. Return a list of run filenames per partition. """
+    partData = [{} for i in range(partCount)]
+    partRuns = [[] for i in range(partCount)]
+    valueCount = 0
+
+    def flushRuns():
+        for partIdx, data in enumerate(partData):
+            if len(data)==0:
+                continue
+            runFname = join(runDir, "part%d.run%d" % (partIdx, len(partRuns[partIdx])))
+            writeRun(data, runFname)
+            partRuns[partIdx].append(runFname)
+            data.clear()
+
+    logging.info("Writing map output as sorted runs to %s" % runDir)
+    meter = maxCommon.ProgressMeter(len(fileNames), quiet=quiet, stepCount=100)
+    for fileName in fileNames:
+        logging.debug("Reading "+fileName)
+        nodeData = unmarshal(fileName)
+        for key, values in nodeData.iteritems():
+            if not hasattr(values, "__iter__"):
+                values = [values]
+            partData[keyPartition(key, partCount)].setdefault(key, []).append(values)
+            valueCount += 1
+        del nodeData
+        if valueCount >= RUNMAXVALUES:
+            flushRuns()
+            valueCount = 0
+        meter.taskCompleted()
+    flushRuns()
+    return partRuns
+
+# the algorithm object, inherited by the forked reduce worker processes
+reduceState = {}
+
+def reducePartition(args):
+    " merge the sorted runs of one partition, reduce and write rows to a file. Return the key count "
+    runFnames, outFname = args
+    alg = reduceState["alg"]
+    ofh = open(outFname, "w")
+    keyCount = 0
+    for key, valList in iterMergedRuns(runFnames):
+        writeReduceRows(alg, key, valList, ofh)
+        keyCount += 1
+    ofh.close()
+    return keyCount
+
+def runStreamReduce(alg, paramDict, fileNames, outFilename, quiet=False):
+    """ reduce with bounded memory: the map output is split by key hash into
+    alg.reduceProcs partitions (default 1) and written as key-sorted runs to
+    a local temp dir. The runs of each partition are then merged and reduced,
+    one process per partition. reduceStartup and reduceEnd get an empty dict.
+    """
+    partCount = 1
+    if "reduceProcs" in dir(alg):
+        partCount = alg.reduceProcs
+
+    runDir = pubGeneric.makeTempDir("pubReduce")
+    partRuns = writeSortedRuns(fileNames, partCount, runDir, quiet=quiet)
+    partRuns = [mergeRunsToMax(runFnames, runDir) for runFnames in partRuns]
+    partOutNames = [join(runDir, "part%d.tab" % i) for i in range(partCount)]
+
+    ofh = openReduceOutput(alg, outFilename)
+    if "reduceStartup" in dir(alg):
+        logging.info("Running reduceStartup")
+        alg.reduceStartup({}, paramDict, ofh)
+
+    logging.info("Merging runs and running data through reducer, %d partitions" % partCount)
+    reduceState["alg"] = alg
+    jobs = zip(partRuns, partOutNames)
+    if partCount==1:
+        keyCounts = [reducePartition(jobs[0])]
+    else:
+        pool = multiprocessing.Pool(partCount)
+        keyCounts = pool.map(reducePartition, jobs)
+        pool.close()
+        pool.join()
+    logging.info("Reduced %d keys" % sum(keyCounts))
+
+    if ofh!=None:
+        for partOutName in partOutNames:
+            shutil.copyfileobj(open(partOutName), ofh)
+        ofh.close()
+
+    if "reduceEnd" in dir(alg):
+        logging.info("Running reduceEnd")
+        alg.reduceEnd({})
+    shutil.rmtree(runDir)
+
 def runReduce(algName, paramDict, path, outFilename, quiet=False, inFnames=None):
     """ parse pickled dicts from path, run through reduce function of alg and
-    write output to one file """
+    write output to one file.
+    If the algorithm has the attribute streamReduce=True, reduce with bounded
+    memory, see runStreamReduce.
+    """
 
     if outFilename!=None and isfile(outFilename):
         logging.info("deleting existing file %s" % outFilename)
@@ -750,15 +1378,20 @@ def runReduce(algName, paramDict, path, outFilename, quiet=False, inFnames=None)
         logging.error("Could not find any %s files in %s" % (MAPREDUCEEXT, path))
         sys.exit(1)
 
+    # inFnames from the combine step are plain filenames, findFiles returns (dir, fname)
+    fileNames = [f if isinstance(f, basestring) else f[1] for f in infiles]
+
+    if "streamReduce" in dir(alg) and alg.streamReduce:
+        runStreamReduce(alg, paramDict, fileNames, outFilename, quiet=quiet)
+        return
+
     # read pickle files into data dict
     data = {}
     fileCount = 0
     logging.info("Reading map output")
-    meter = maxCommon.ProgressMeter(len(infiles), quiet=quiet, stepCount=100)
-    for relDir, fileName in infiles:
-        binData = gzip.open(fileName, "rb").read()
-        nodeData = marshal.loads(binData)
-        del binData
+    meter = maxCommon.ProgressMeter(len(fileNames), quiet=quiet, stepCount=100)
+    for fileName in fileNames:
+        nodeData = unmarshal(fileName)
         for key, values in nodeData.iteritems():
             if not hasattr(values, "__iter__"):
                 values = [values]
@@ -769,17 +1402,7 @@ def runReduce(algName, paramDict, path, outFilename, quiet=False, inFnames=None)
         logging.debug("Reading "+fileName)
         meter.taskCompleted()
 
-    logging.info("Writing to %s" % outFilename)
-    if outFilename==None:
-        ofh = None
-    elif outFilename=="stdout":
-        ofh = sys.stdout
-    else:
-        ofh = open(outFilename, "w")
-
-    if "headers" in dir(alg) and ofh!=None:
-        ofh.write("\t".join(alg.headers))
-        ofh.write("\n")
+    ofh = openReduceOutput(alg, outFilename)
 
     if "reduceStartup" in dir(alg):
         logging.info("Running reduceStartup")
@@ -788,19 +1411,7 @@ def runReduce(algName, paramDict, path, outFilename, quiet=False, inFnames=None)
     logging.info("Running data through reducer")
     meter = maxCommon.ProgressMeter(len(data))
     for key, valList in data.iteritems():
-        tupleIterator = alg.reduce(key, valList)
-        for tuple in tupleIterator:
-            if tuple==None:
-                logging.debug("Got None, not writing anything")
-                continue
-            if type(tuple)==bytes: # make sure that returned value is a list
-                tuple = [tuple]
-            if type(tuple)==int: # make sure that it's a string
-                tuple = [str(tuple)]
-            tuple = [unicode(x).encode("utf8") for x in tuple] # convert to utf8
-            if ofh!=None:
-                ofh.write("\t".join(tuple))
-                ofh.write("\n")
+        writeReduceRows(alg, key, valList, ofh)
         meter.taskCompleted()
     if ofh!=None:
         ofh.close()
@@ -935,7 +1546,7 @@ def testAlg(algName, paramDict):
         alg.startup(paramDict) # to check if at least the algorithm works
 
 def annotate(algNames, textDirs, paramDict, outDirs, cleanUp=False, runNow=False, \
-    updateIds=None, batchDir=".", runner=None, addFields=[], concat=False):
+    updateIds=None, batchDir=".", runner=None, addFields=[], concat=False, fused=False):
     """
     submit jobs to batch system to run algorithm over text in textDir, write
     annotations to outDir
@@ -945,6 +1556,7 @@ def annotate(algNames, textDirs, paramDict, outDirs, cleanUp=False, runNow=False
     cleanUp deletes all cluster system tempfiles
     runNow waits until jobs have finished
     concat will concatenate all output files and write to outDir (actually a textfile)
+    fused runs all algorithms in one job per chunk, so the text is read only once
     """
     if isinstance(algNames, basestring):
         algNames = algNames.split(",")
@@ -958,7 +1570,7 @@ def annotate(algNames, textDirs, paramDict, outDirs, cleanUp=False, runNow=False
     logging.debug("Testing successful, submitting jobs")
     baseNames = findFilesSubmitJobs(algNames, "annotate", textDirs, outDirs, \
         ".tab.gz", paramDict, runNow=runNow, cleanUp=cleanUp, updateIds=updateIds, \
-        batchDir=batchDir, runner=runner, addFields=addFields)
+        batchDir=batchDir, runner=runner, addFields=addFields, fused=fused)
 
     if concat:
         for outDir in outDirs:
@@ -979,7 +1591,7 @@ def mapReduceTestRun(datasets, alg, paramDict, tmpDir, updateIds=None, skipMap=F
     if not isfile(oneInputFile):
         oneInputFile = firstBasename+".files.gz"
     logging.info("Testing algorithm on file %s" % oneInputFile)
-    reader = pubStore.PubReaderFile(oneInputFile)
+    reader = pubStore.openPubReader(oneInputFile)
     tmpAlgOut = join(tmpDir, "pubMapReduceTest.temp.marshal.gz")
     tmpRedOut = join(tmpDir, "red.temp.tab")
     if not skipMap:
@@ -1125,6 +1737,15 @@ if __name__ == '__main__':
     for key, val in paramDict.iteritems():
         logging.log(5, "parameter %s = %s" % (key, str(val)))
 
+    if algMethod=="annotateFused":
+        algs = [getAlg(name, defClass="Annotate") for name in algName.split(",")]
+        outNames = [join(outDir, basename(outName)) for outDir in paramDict["fusedOutDirs"]]
+        reader = pubStore.openPubReader(inName)
+        openSentLayer(inName)
+        runAnnotateFused(reader, algs, paramDict, outNames)
+        reader.close()
+        sys.exit(0)
+
     alg = getAlg(algName, defClass=string.capitalize(algMethod))
 
     if algMethod in ["combine", "processRow"]:
@@ -1134,7 +1755,8 @@ if __name__ == '__main__':
         elif algMethod=="combine":
             runCombine(inName, alg, paramDict, outName)
     else:
-        reader = pubStore.PubReaderFile(inName)
+        reader = pubStore.openPubReader(inName)
+        openSentLayer(inName)
         if algMethod=="map":
             runMap(reader, alg, paramDict, outName)
         elif algMethod=="annotate":
@@ -15,7 +15,7 @@ def filterOneChunk(inFname, searchSpec, outFname):
         words = searchSpec.split(",")
         words = [w.lower() for w in words]
 
-    reader = pubStore.PubReaderFile(inFname)
+    reader = pubStore.openPubReader(inFname)
     store  = pubStore.PubWriterFile(outFname)
 
     for article, files in reader.iterArticlesFileList(None):
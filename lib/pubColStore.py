@@ -0,0 +1,178 @@
+# a column-oriented, block-compressed file format for pubStore chunks
+
+# A column file stores one table of a chunk (articles or files) and is written
+# next to or instead of the gzipped tab-sep file, e.g. 0_00000.files.col
+# next to 0_00000.files.gz.
+#
+# Rows are collected into row groups. Every column of a row group is
+# marshalled and zlib-compressed into its own block, so a reader that needs
+# only some of the columns (e.g. everything but the "content" of files) never
+# reads or decompresses the other blocks.
+#
+# At the end of the file is a footer with the field names and, for each row
+# group, the offsets of its blocks and the IDs (articleId or fileId) of its
+# rows. Rows can thus be found by ID after reading only the footer.
+#
+# layout:
+#   MAGIC
+#   block, block, ... (one per column per row group)
+#   footer (a marshalled dict)
+#   offset of the footer, 8 bytes, little-endian
+#   MAGIC
+
+import logging, marshal, zlib, struct, os
+
+MAGIC = "PUBCOL1\n"
+TAILSIZE = 8 + len(MAGIC)
+
+# a row group is written once it has this many rows or this many bytes
+GROUPMAXROWS = 500
+GROUPMAXBYTES = 16000000
+
+class ColWriter(object):
+    """ writes rows (lists of byte strings) to a column file.
+    All rows must have one value for each of fieldNames. The values of the field
+    idField are kept in the footer as an index.
+    """
+    def __init__(self, fname, fieldNames, idField, compLevel=6):
+        self.fname = fname
+        self.fieldNames = list(fieldNames)
+        self.idField = idField
+        self.idIdx = self.fieldNames.index(idField)
+        self.compLevel = compLevel
+        self.groups = []
+        self.rowCount = 0
+        self.fh = open(fname, "wb")
+        self.fh.write(MAGIC)
+        self._newGroup()
+
+    def _newGroup(self):
+        self.cols = [[] for x in self.fieldNames]
+        self.groupBytes = 0
+
+    def writeRow(self, row):
+        " append a row to the file "
+        if len(row)!=len(self.fieldNames):
+            raise Exception("column writer %s: got %d fields, expected %d" % \
+                (self.fname, len(row), len(self.fieldNames)))
+        for col, val in zip(self.cols, row):
+            col.append(val)
+            self.groupBytes += len(val)
+        self.rowCount += 1
+        if len(self.cols[0]) >= GROUPMAXROWS or self.groupBytes >= GROUPMAXBYTES:
+            self._writeGroup()
+
+    def _writeGroup(self):
+        " compress and write the current row group, one block per column "
+        if len(self.cols[0])==0:
+            return
+        blocks = []
+        for col in self.cols:
+            data = zlib.compress(marshal.dumps(col), self.compLevel)
+            blocks.append((self.fh.tell(), len(data)))
+            self.fh.write(data)
+        ids = self.cols[self.idIdx]
+        self.groups.append((len(ids), ids, blocks))
+        logging.log(5, "Wrote row group with %d rows to %s" % (len(ids), self.fname))
+        self._newGroup()
+
+    def close(self):
+        " write last row group and footer "
+        self._writeGroup()
+        footer = {"fields" : self.fieldNames, "idField" : self.idField, "groups" : self.groups}
+        footerOffset = self.fh.tell()
+        self.fh.write(marshal.dumps(footer))
+        self.fh.write(struct.pack("<Q", footerOffset))
+        self.fh.write(MAGIC)
+        self.fh.close()
+        logging.debug("Closed column file %s, %d rows, %d row groups" % \
+            (self.fname, self.rowCount, len(self.groups)))
+
+class ColReader(object):
+    """ reads rows from a column file. Only the footer is read on open.
+    Rows are returned as lists of byte strings, or of unicode strings if
+    encoding is set.
+    """
+    def __init__(self, fname, encoding=None):
+        self.fname = fname
+        self.encoding = encoding
+        self.fh = open(fname, "rb")
+        fileSize = os.fstat(self.fh.fileno()).st_size
+        if fileSize < len(MAGIC)+TAILSIZE:
+            raise Exception("%s is too small to be a column file" % fname)
+        self.fh.seek(fileSize-TAILSIZE)
+        tail = self.fh.read(TAILSIZE)
+        if tail[8:]!=MAGIC:
+            raise Exception("%s is not a column file or was not closed properly" % fname)
+        footerOffset = struct.unpack("<Q", tail[:8])[0]
+        self.fh.seek(footerOffset)
+        footer = marshal.loads(self.fh.read(fileSize-TAILSIZE-footerOffset))
+
+        self.fieldNames = footer["fields"]
+        self.idField = footer["idField"]
+        self.groups = footer["groups"]
+        self.rowCount = sum([g[0] for g in self.groups])
+        self.idToPos = None
+
+    def _readBlock(self, offset, size):
+        self.fh.seek(offset)
+        col = marshal.loads(zlib.decompress(self.fh.read(size)))
+        if self.encoding!=None:
+            col = [val.decode(self.encoding) for val in col]
+        return col
+
+    def _fieldIdxs(self, fields):
+        " convert list of field names to list of field indexes "
+        if fields is None:
+            return list(range(len(self.fieldNames)))
+        return [self.fieldNames.index(f) for f in fields]
+
+    def _readGroup(self, groupIdx, fieldIdxs, missing):
+        " return the columns of a row group, columns not in fieldIdxs are filled with missing "
+        rowCount, ids, blocks = self.groups[groupIdx]
+        cols = []
+        for i, (offset, size) in enumerate(blocks):
+            if i in fieldIdxs:
+                cols.append(self._readBlock(offset, size))
+            else:
+                cols.append(rowCount*[missing])
+        return cols
+
+    def ids(self):
+        " return list of all row IDs, in file order "
+        allIds = []
+        for rowCount, ids, blocks in self.groups:
+            allIds.extend(ids)
+        return allIds
+
+    def iterRows(self, fields=None, missing=""):
+        """ yield all rows as lists. If fields is set, only these columns are
+        read and all others are set to missing. """
+        fieldIdxs = set(self._fieldIdxs(fields))
+        for groupIdx in range(len(self.groups)):
+            cols = self._readGroup(groupIdx, fieldIdxs, missing)
+            for row in zip(*cols):
+                yield list(row)
+
+    def getRows(self, rowIds, fields=None, missing=""):
+        """ yield the rows with the given IDs as lists, in file order.
+        Reads only the row groups that contain one of the IDs. """
+        if self.idToPos is None:
+            self.idToPos = {}
+            for groupIdx, (rowCount, ids, blocks) in enumerate(self.groups):
+                for rowIdx, rowId in enumerate(ids):
+                    self.idToPos.setdefault(rowId, []).append((groupIdx, rowIdx))
+
+        groupRows = {}
+        for rowId in rowIds:
+            for groupIdx, rowIdx in self.idToPos.get(str(rowId), []):
+                groupRows.setdefault(groupIdx, set()).add(rowIdx)
+
+        fieldIdxs = set(self._fieldIdxs(fields))
+        for groupIdx in sorted(groupRows):
+            cols = self._readGroup(groupIdx, fieldIdxs, missing)
+            for rowIdx in sorted(groupRows[groupIdx]):
+                yield [col[rowIdx] for col in cols]
+
+    def close(self):
+        self.fh.close()
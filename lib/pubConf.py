@@ -91,6 +91,17 @@ textDir = join(pubsDataDir, "text")
 # gzip compress the text data? Seeking is faster if not gzip compressed.
 compress = True
 
+# format of the text chunks written by the converters: "tsv" writes
+# .articles.gz and .files.gz, "col" writes column files .articles.col and
+# .files.col (see pubColStore.py), "both" writes both. Readers prefer the column
+# files if they exist. Metadata-only algorithms do not read file contents from
+# column files at all.
+chunkFormat = "tsv"
+
+# number of processes that parse chunks when articles.db is updated. Each loads
+# its chunks into a staging db, these are merged at the end.
+articleDbLoadProcs = 4
+
 # for pubConvMedline:
 
 # an sqlite db with the content of medline, kept up-to-date
@@ -177,6 +188,9 @@ bundleToText = {
 
 TEMPDIR = "/tmp/pubTools" # local filesystem on cluster nodes
 FASTTEMPDIR = TEMPDIR
+# node-local copies of fastFind lexicons in Aho-Corasick format, shared via mmap
+# by all jobs on a node. Set to None to always load the marshalled dictionaries.
+LEXCACHEDIR = join(TEMPDIR, "lexCache")
 
 maxBinFileSize = 50000000 # maximum filesize of any file before conversion to ASCII
 # pretty big, to allow big blobs like TIFF files etc, in docx files
@@ -191,6 +205,11 @@ clusterBatchDir = pubsDataDir + "/runs/"
 textBaseDir = pubsDataDir + "/text/"
 # the central base directory for all text annotations
 annotDir = pubsDataDir + "/annot/"
+# the rows of annotators can be cached with pubRunAnnot --annotCache, keyed by the annotator,
+# its version and the text of a file. The least recently used rows are removed when
+# the cache gets bigger than this, see pubAlg.AnnotCache. The cache file is a sqlite db and
+# has to be on a local disk: it is not used on NFS, where sqlite locking is unreliable
+annotCacheMaxMb = 20000
 # central directory for exported fasta file
 faDir = pubsDataDir + "/fastaExport/"
 
@@ -313,6 +332,27 @@ chunkArticleCount = 400
 # can be used to limit I/O and be nice to other cluster users
 convertMaxJob = 200
 
+# for conversion jobs: how many files of a chunk are converted in parallel
+# the converters are external programs, so threads are enough
+convertThreads = 4
+
+# number of long-lived converter processes that get files over a pipe, see
+# pubConverters.py. 0 = run the converters directly from the converting process
+convertProcs = 4
+
+# file extensions that are converted with the python functions in pubConverters.py
+# instead of the external programs in CONVERTERS, e.g. set(["docx", "xlsx", "html", "htm"]).
+# Their text is not exactly the same as the one of the external programs, so compare
+# the output on a sample of files before switching an extension.
+pyConverterExts = set()
+
+# directory of the content-addressed cache of converted files, shared by all
+# jobs of a publisher. None = <outDir>/convCache
+convCacheDir = None
+# max number of files in the conversion cache. When a pubConvPmc run is done, the
+# least recently used files above this number are removed. 0 = no limit
+convCacheMaxFiles = 1000000
+
 # PMID RESOLVER
 
 # filename of pubCompare output file in source dataset directory
@@ -502,6 +542,11 @@ maxChainLength=3000000
 # will run on 200 pieces
 chunkDivider = 10
 
+# pubMap: number of processes to split the psls by chunk
+pslSplitProcs = 8
+# pubMap: maximum number of chunk files that one psl split process keeps open
+pslSplitMaxOpenFiles = 500
+
 # which alignment table shall we use for cdna mapping?
 # (this is used by pubPrepCdnaDir to download mRNA alignmenst
 # and mRNA fasta files
@@ -598,6 +643,11 @@ mutDataDir = varDataDir
 # genome twobit file to use with variant detection
 genomeTwoBit = join(varDataDir, "hg19.2bit")
 
+# number of refseq sequences and of refseq psl lists that variant grounding keeps
+# in memory, the least recently used ones are removed first
+varSeqCacheSize = 20000
+varPslCacheSize = 20000
+
 # the british national corpus is a list of 30k common words in English
 # used for symbol filtering
 bncFname = '/hive/data/outside/pubs/wordFrequency/bnc/bnc.txt'
@@ -636,6 +686,17 @@ def getTempDir():
                 logging.info("Ignoring OSError, directory %s seems to exist already" % TEMPDIR)
     return TEMPDIR
 
+def getLexCacheDir():
+    " node-local directory for fastFind lexicons or None if the cache is switched off "
+    if LEXCACHEDIR is None:
+        return None
+    if not isdir(LEXCACHEDIR):
+        try:
+            makedirs(LEXCACHEDIR)
+        except OSError:
+            logging.info("Ignoring OSError, directory %s seems to exist already" % LEXCACHEDIR)
+    return LEXCACHEDIR
+
 def getUcscScriptDir():
     dirname(__file__)
 
@@ -0,0 +1,265 @@
+# converter backends for pubGeneric.toAscii
+
+# - in-process converters, python functions that get the bytes of a file and
+#   return its text, for formats that are easy to parse in python: docx and
+#   xlsx are zip files with xml inside, html. pubConf.pyConverterExts selects
+#   the extensions where these are used instead of the external programs.
+# - ConverterPool, long-lived worker processes that receive the bytes of a file
+#   over a pipe and return the text. The workers are forked once, when the
+#   parent is still small, and run the in-process converters or the external
+#   programs from pubConf.CONVERTERS.
+# - ConvStats, the number of files, failures, bytes and seconds per file extension
+
+import logging, zipfile, io, re, time, threading, multiprocessing, Queue, traceback
+import HTMLParser
+from xml.etree import cElementTree as etree
+
+import pubConf
+
+# ===== in-process converters =====
+
+WORDNS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+SHEETNS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+
+def convertDocx(fileContent):
+    " return the text of a .docx file, one line per paragraph "
+    zipFile = zipfile.ZipFile(io.BytesIO(fileContent))
+    root = etree.fromstring(zipFile.read("word/document.xml"))
+    lines = []
+    for parEl in root.iter(WORDNS+"p"):
+        parts = []
+        for el in parEl.iter():
+            if el.tag==WORDNS+"t" and el.text:
+                parts.append(el.text)
+            elif el.tag==WORDNS+"tab":
+                parts.append("\t")
+            elif el.tag in (WORDNS+"br", WORDNS+"cr"):
+                parts.append("\n")
+        lines.append("".join(parts))
+    return u"\n".join(lines)
+
+def sheetSortKey(name):
+    " sort xl/worksheets/sheet10.xml after sheet9.xml "
+    return [int(x) if x.isdigit() else x for x in re.split("([0-9]+)", name)]
+
+def convertXlsx(fileContent):
+    " return the cells of all sheets of an .xlsx file, tab-separated, one line per row "
+    zipFile = zipfile.ZipFile(io.BytesIO(fileContent))
+    names = zipFile.namelist()
+
+    sharedStrings = []
+    if "xl/sharedStrings.xml" in names:
+        root = etree.fromstring(zipFile.read("xl/sharedStrings.xml"))
+        for siEl in root.iter(SHEETNS+"si"):
+            sharedStrings.append("".join([t.text or "" for t in siEl.iter(SHEETNS+"t")]))
+
+    sheetNames = [n for n in names if n.startswith("xl/worksheets/sheet") and n.endswith(".xml")]
+    lines = []
+    for sheetName in sorted(sheetNames, key=sheetSortKey):
+        root = etree.fromstring(zipFile.read(sheetName))
+        for rowEl in root.iter(SHEETNS+"row"):
+            cells = []
+            for cEl in rowEl.iter(SHEETNS+"c"):
+                cellType = cEl.get("t")
+                if cellType=="inlineStr":
+                    val = "".join([t.text or "" for t in cEl.iter(SHEETNS+"t")])
+                else:
+                    vEl = cEl.find(SHEETNS+"v")
+                    val = "" if vEl is None or vEl.text is None else vEl.text
+                    if cellType=="s" and val!="":
+                        val = sharedStrings[int(val)]
+                cells.append(val.replace("\t", " ").replace("\n", " "))
+            lines.append("\t".join(cells))
+    return u"\n".join(lines)
+
+class HtmlTextParser(HTMLParser.HTMLParser):
+    " collects the text of an html page, without scripts and styles "
+    blockTags = set(["p", "div", "br", "tr", "li", "h1", "h2", "h3", "h4", "h5", "h6", "table", "title"])
+    skipTags = set(["script", "style"])
+
+    def __init__(self):
+        HTMLParser.HTMLParser.__init__(self)
+        self.parts = []
+        self.skipDepth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.skipTags:
+            self.skipDepth += 1
+        elif tag in self.blockTags:
+            self.parts.append("\n")
+        elif tag=="td" or tag=="th":
+            self.parts.append("\t")
+
+    def handle_endtag(self, tag):
+        if tag in self.skipTags:
+            self.skipDepth = max(0, self.skipDepth-1)
+        elif tag in self.blockTags:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if self.skipDepth==0:
+            self.parts.append(data)
+
+    def handle_entityref(self, name):
+        self.handle_data(self.unescape("&%s;" % name))
+
+    def handle_charref(self, name):
+        self.handle_data(self.unescape("&#%s;" % name))
+
+def convertHtml(fileContent):
+    " return the text of an html page "
+    if not isinstance(fileContent, unicode):
+        try:
+            fileContent = fileContent.decode("utf8")
+        except UnicodeDecodeError:
+            fileContent = fileContent.decode("latin1")
+    parser = HtmlTextParser()
+    parser.feed(fileContent)
+    parser.close()
+    text = "".join(parser.parts)
+    text = re.sub(u"[ \t\r\f\v]*\n[ \t\r\f\v\n]*", u"\n", text)
+    return text.strip()
+
+# file extension -> python function that converts the bytes of a file to text
+PYCONVERTERS = {
+    "docx" : convertDocx,
+    "xlsx" : convertXlsx,
+    "html" : convertHtml,
+    "htm"  : convertHtml,
+}
+
+def getPyConverter(fileExt):
+    " return the in-process converter for fileExt or None if the external program is to be used "
+    if fileExt in pubConf.pyConverterExts:
+        return PYCONVERTERS.get(fileExt)
+    return None
+
+def runPyConverter(convFunc, fileContent, fileDesc):
+    " run an in-process converter, return text or None if it failed "
+    try:
+        text = convFunc(fileContent)
+    except Exception as ex:
+        logging.info("in-process converter failed on %s: %s" % (fileDesc, ex))
+        return None
+    if text is None or len(text)==0:
+        return None
+    return text
+
+# ===== statistics =====
+
+class ConvStats(object):
+    " counts files, failures, input bytes and seconds per file extension, thread-safe "
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def add(self, fileExt, byteCount, seconds, failed):
+        with self.lock:
+            extStats = self.stats.setdefault(fileExt, [0, 0, 0, 0.0])
+            extStats[0] += 1
+            if failed:
+                extStats[1] += 1
+            extStats[2] += byteCount
+            extStats[3] += seconds
+
+    def rows(self):
+        " return rows (ext, files, failed, MB, seconds, files per sec, MB per sec) "
+        rows = []
+        with self.lock:
+            for fileExt, (count, failCount, byteCount, seconds) in sorted(self.stats.items()):
+                mbytes = byteCount/1000000.0
+                seconds = max(seconds, 0.000001)
+                rows.append((fileExt, count, failCount, mbytes, seconds, count/seconds, mbytes/seconds))
+        return rows
+
+    def logSummary(self):
+        if len(self.stats)==0:
+            return
+        logging.info("Converter statistics: ext, files, failed, MB, seconds, files/sec, MB/sec")
+        for row in self.rows():
+            logging.info("%s\t%d\t%d\t%.1f\t%.1f\t%.1f\t%.2f" % row)
+
+# statistics of all conversions in this process
+convStats = ConvStats()
+
+# ===== worker pool =====
+
+def workerLoop(conn, convFunc):
+    " receive (cmdLine, fileContent, fileExt, tempDir) from conn, send back the text or None "
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:
+            break
+        if msg is None:
+            break
+        try:
+            text = convFunc(*msg)
+        except Exception:
+            logging.error("converter worker: error on %s file" % msg[2])
+            traceback.print_exc()
+            text = None
+        conn.send(text)
+    conn.close()
+
+class ConverterWorker(object):
+    " a worker process and the parent's end of its pipe "
+    def __init__(self, convFunc):
+        self.conn, childConn = multiprocessing.Pipe()
+        self.proc = multiprocessing.Process(target=workerLoop, args=(childConn, convFunc))
+        self.proc.daemon = True
+        self.proc.start()
+        childConn.close()
+
+    def convert(self, args):
+        self.conn.send(args)
+        return self.conn.recv()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except IOError:
+            pass
+        self.conn.close()
+        self.proc.join(5)
+        if self.proc.is_alive():
+            self.proc.terminate()
+
+class ConverterPool(object):
+    """ procCount long-lived worker processes that run convFunc(cmdLine, fileContent, fileExt, tempDir),
+    usually pubGeneric.convertBinary. runConverter() has the same arguments and can be called by many
+    threads at the same time, each call waits for an idle worker. A worker that died, e.g. after a
+    converter received a signal, is replaced and its file counts as failed.
+    """
+    def __init__(self, procCount, convFunc):
+        self.convFunc = convFunc
+        self.idle = Queue.Queue()
+        self.workers = []
+        for i in range(procCount):
+            worker = ConverterWorker(convFunc)
+            self.workers.append(worker)
+            self.idle.put(worker)
+        logging.info("Started %d converter worker processes" % procCount)
+
+    def runConverter(self, cmdLine, fileContent, fileExt, tempDir):
+        " convert in a worker process, return text or None "
+        worker = self.idle.get()
+        startTime = time.time()
+        try:
+            text = worker.convert((cmdLine, fileContent, fileExt, tempDir))
+        except (EOFError, IOError) as ex:
+            logging.error("converter worker %d died on a %s file: %s, restarting it" % \
+                (worker.proc.pid, fileExt, ex))
+            worker.stop()
+            self.workers.remove(worker)
+            worker = ConverterWorker(self.convFunc)
+            self.workers.append(worker)
+            text = None
+        convStats.add(fileExt, len(fileContent), time.time()-startTime, text is None)
+        self.idle.put(worker)
+        return text
+
+    def close(self):
+        for worker in self.workers:
+            worker.stop()
+        self.workers = []
@@ -11,7 +11,8 @@ from __future__ import print_function
 
 import logging, os, shutil, codecs, re, types, datetime, \
     urllib2, re, zipfile, collections, urlparse, time, atexit, socket, signal, \
-    sqlite3, doctest, urllib, hashlib, string, copy, cStringIO, mimetypes, httplib, json, traceback
+    sqlite3, doctest, urllib, hashlib, string, copy, cStringIO, mimetypes, httplib, json, traceback, \
+    threading, sys
 from os.path import *
 from collections import defaultdict, OrderedDict
 from socket import timeout
@@ -136,8 +137,35 @@ forceDelay = -1
 # filenames of lockfiles
 lockFnames = []
 
-# http page cache, to avoid duplicate downloads
-webCache = {}
+class ThreadLocalDict(threading.local):
+    " a dict with separate contents in each thread "
+    def __init__(self):
+        self.data = {}
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, val):
+        self.data[key] = val
+
+    def clear(self):
+        self.data.clear()
+
+# http page cache, to avoid duplicate downloads. With concurrent crawls, every thread
+# crawls another document, so every thread has its own cache
+webCache = ThreadLocalDict()
+
+# concurrent crawls, see CrawlScheduler: the per-host token buckets used by wait()
+hostLimiter = None
+# number of requests that a host can get without delay after a pause
+HOSTBURST = 1
+# seconds between two throughput reports
+CRAWLREPORTSECS = 600
+# after ctrl-c, seconds to wait for the crawl threads to finish their current document
+CRAWLSTOPSECS = 60
 
 addHeaders = [ # additional headers for fulltext download metaData
 "mainHtmlUrl", # the main fulltext HTML URL
@@ -366,21 +394,24 @@ def getDelaySecs(host, forceDelaySecs):
     logging.debug("Delay time for host %s not known" % (host))
     return defaultDelay
 
-# globals for selenium
-browser = None
+# globals for selenium: the pseudo-display is shared, but every crawl thread drives
+# its own firefox, a webdriver must not be used by two threads at the same time
 display = None
+displayLock = threading.Lock()
+seleniumState = threading.local()
+allBrowsers = [] # the webdrivers of all threads, for stopAllFirefox()
 
 def startFirefox(force=False):
-    " start firefox on a pseudo-X11-display, return a webdriver object  "
+    " start firefox on a pseudo-X11-display, return the webdriver object of this thread "
     global display
-    global browser
     if not seleniumLoaded:
         raise pubGetError("Cannot get page, selenium is not installed on this machine", "noSelenium")
 
-    if not display:
-        logging.info("Starting pseudo-display")
-        display = Display(visible=0, size=(1024, 768))
-        display.start()
+    with displayLock:
+        if not display:
+            logging.info("Starting pseudo-display")
+            display = Display(visible=0, size=(1024, 768))
+            display.start()
 
     proxy = None
 
@@ -390,6 +421,7 @@ def startFirefox(force=False):
          'ftpProxy': pubConf.httpProxy,
          'sslProxy': pubConf.httpProxy})
 
+    browser = getattr(seleniumState, "browser", None)
     if not browser or force:
         # reduce logging
         # http://stackoverflow.com/questions/9226519/turning-off-logging-in-selenium-from-python
@@ -398,9 +430,40 @@ def startFirefox(force=False):
 
         logging.info('Starting firefox on pseudo-display')
         browser = webdriver.Firefox(proxy=proxy)
+        seleniumState.browser = browser
+        with displayLock:
+            allBrowsers.append(browser)
 
     return browser
 
+def getFirefox():
+    " return the webdriver object of this thread or None if it has not started firefox "
+    return getattr(seleniumState, "browser", None)
+
+def stopFirefox():
+    " quit the firefox of this thread, if there is one "
+    browser = getattr(seleniumState, "browser", None)
+    if browser is None:
+        return
+    seleniumState.browser = None
+    quitFirefox(browser)
+
+def quitFirefox(browser):
+    " quit a webdriver and forget it "
+    with displayLock:
+        if browser not in allBrowsers:
+            return
+        allBrowsers.remove(browser)
+    try:
+        browser.quit()
+    except Exception:
+        logging.warn("Could not quit firefox")
+
+def stopAllFirefox():
+    " quit the firefox of all threads, after the crawl threads have stopped "
+    for browser in list(allBrowsers):
+        quitFirefox(browser)
+
 def httpGetSelenium(url, delaySecs, mustGet=False):
     " use selenium to download a page "
     logging.info("Downloading %s using Selenium/Firefox" % url)
@@ -491,11 +554,15 @@ def _httpTimeout(signum, frame):
     raise TimeoutException()
 # -- end stackoverflow
 
-session = None
+# the requests session, one per thread
+httpState = threading.local()
+
+def isMainThread():
+    " signal handlers can only be changed in the main thread "
+    return isinstance(threading.current_thread(), threading._MainThread)
 
 def httpResetSession():
     " reset the http session, e.g. deletes all cookies "
-    global session
     session = requests.Session()
     if pubConf.httpProxy != None and useProxy:
         proxies = {
@@ -503,13 +570,13 @@ def httpResetSession():
          'https': pubConf.httpProxy
          }
         session.proxies.update(proxies)
+    httpState.session = session
 
 def httpGetRequest(url, userAgent, cookies, referer=None, newSession=False, accept=None):
     """
     download a url with the requests module, return a dict with the keys
     url, mimeType, charset and data
     """
-    global session
     logging.debug('HTTP request to %s. useragent: %s' % (url, userAgent))
     headers = {'user-agent': userAgent}
 
@@ -519,20 +586,26 @@ def httpGetRequest(url, userAgent, cookies, referer=None, newSession=False, acce
     if accept is not None:
         headers['Accept'] = accept
 
-    if session is None or newSession:
+    if getattr(httpState, "session", None) is None or newSession:
         httpResetSession()
+    session = httpState.session
 
     tryCount = 0
     r = None
 
     # Set the handler for the SIGALRM signal and set it to 30 secs
-    signal.signal(signal.SIGALRM, _httpTimeout)
+    # threads of concurrent crawls have to rely on the timeout of requests
+    useAlarm = isMainThread()
+    if useAlarm:
+        signal.signal(signal.SIGALRM, _httpTimeout)
 
     while tryCount < 3:
-        signal.alarm(30)
+        if useAlarm:
+            signal.alarm(30)
         try:
             r = session.get(url, headers=headers, cookies=cookies, allow_redirects=True, timeout=30)
-            signal.alarm(0) # stop the alarm
+            if useAlarm:
+                signal.alarm(0) # stop the alarm
             break
         except (requests.exceptions.ConnectionError,
          requests.exceptions.TooManyRedirects,
@@ -540,13 +613,15 @@ def httpGetRequest(url, userAgent, cookies, referer=None, newSession=False, acce
          requests.exceptions.RequestException,
          TimeoutException
          ):
-            signal.alarm(0) # stop the alarm
+            if useAlarm:
+                signal.alarm(0) # stop the alarm
             tryCount += 1
             logging.info('HTTP error, retry number %d' % tryCount)
             time.sleep(3)
 
     # stop the alarm
-    signal.alarm(0)
+    if useAlarm:
+        signal.alarm(0)
 
     if r == None:
         raise pubGetError('HTTP error on %s' % url, 'httpError', url)
@@ -844,7 +919,13 @@ def parseIssnStatus(outDir):
 lastCallSec = {}
 
 def wait(delaySec, host="default"):
-    " make sure that delaySec seconds have passed between two calls with the same value of 'host' "
+    """ make sure that delaySec seconds have passed between two calls with the same value of 'host'
+    During concurrent crawls, the token bucket of the host is used instead.
+    """
+    if hostLimiter is not None:
+        hostLimiter.acquire(host, delaySec)
+        return
+
     global lastCallSec
     delaySec = float(delaySec)
     nowSec = time.time()
@@ -1253,7 +1334,8 @@ def writePaperData(docId, pubmedMeta, fulltextData, outDir):
 
     pubmedMeta, warnMsgs = writeFilesToDisk(docId, pubmedMeta, fulltextData, outDir)
 
-    oldHandler = signal.signal(signal.SIGINT, ignoreCtrlc) # deact ctrl-c during write
+    if isMainThread():
+        oldHandler = signal.signal(signal.SIGINT, ignoreCtrlc) # deact ctrl-c during write
 
     writeMeta(outDir, pubmedMeta, fulltextData)
     addStatus = ""
@@ -1268,7 +1350,8 @@ def writePaperData(docId, pubmedMeta, fulltextData, outDir):
                      numFiles=len(fulltextData),
                      detail=addStatus)
 
-    signal.signal(signal.SIGINT, oldHandler) # react ctrl c handler
+    if isMainThread():
+        signal.signal(signal.SIGINT, oldHandler) # react ctrl c handler
 
 def parseIdStatus(fname):
     " parse crawling status file, return as dict status -> count "
@@ -1433,7 +1516,7 @@ def findCrawlers_article(artMeta):
     return those crawlers that return True for canDo_article(artMeta)
     """
     crawlers = []
-    for c in allCrawlers:
+    for c in getCrawlers():
         if c.canDo_article(artMeta):
             logging.log(5, "Based on meta data: Crawler %s is OK to crawl article %s" % (c.name, artMeta["title"]))
             crawlers.append(c)
@@ -1444,7 +1527,7 @@ def findCrawlers_url(landingUrl):
     return the crawlers that are OK with crawling a URL
     """
     crawlers = []
-    for c in allCrawlers:
+    for c in getCrawlers():
         if c.canDo_url(landingUrl):
             logging.log(5, "Based on URL: Crawler %s is OK to crawl url %s" % (c.name, landingUrl))
             crawlers.append(c)
@@ -3051,7 +3134,7 @@ class GenericCrawler(Crawler):
         cookies = None
         if useSelCookies:
             logging.debug("Importing cookies from selenium")
-            all_cookies = browser.get_cookies()
+            all_cookies = getFirefox().get_cookies()
             cookies = {}
             for s_cookie in all_cookies:
                 cookies[s_cookie["name"]]=s_cookie["value"]
@@ -3297,6 +3380,20 @@ allCrawlers = [
 
 allCrawlerNames = [c.name for c in allCrawlers]
 
+# the crawlers keep the state of the current document, e.g. useSelenium or a session,
+# so every thread of crawlDocumentsConcurrent gets its own crawler objects
+crawlerState = threading.local()
+
+def getCrawlers():
+    " return the crawler objects of this thread, in the order of allCrawlers "
+    if isMainThread():
+        return allCrawlers
+    crawlers = getattr(crawlerState, "crawlers", None)
+    if crawlers is None or len(crawlers)!=len(allCrawlers):
+        crawlers = [c.__class__() for c in allCrawlers]
+        crawlerState.crawlers = crawlers
+    return crawlers
+
 def addCrawler(name):
     " add an custom crawler to global list "
     global allCrawlers, allCrawlerNames
@@ -3330,7 +3427,7 @@ def selectCrawlers(artMeta, srcDir):
         logging.debug("Checking %s to see if a crawler has been configured" % crawlerSpecFname)
         if isfile(crawlerSpecFname):
             crawlerName = open(crawlerSpecFname).read().strip()
-            crawlers = [c for c in allCrawlers if c.name==crawlerName]
+            crawlers = [c for c in getCrawlers() if c.name==crawlerName]
             # give the crawlers the metadata. only useful for scihub right now.
             cNames = []
             for c in crawlers:
@@ -3376,7 +3473,7 @@ def crawlOneDoc(artMeta, srcDir, forceCrawlers=None):
         # just use the crawlers we got
         logging.debug("Crawlers were fixed externally: %s" % ",".join(forceCrawlers))
         cByName = {}
-        for c in allCrawlers:
+        for c in getCrawlers():
             cByName[c.name] = c
         crawlers = []
         for fc in forceCrawlers:
@@ -3542,6 +3639,314 @@ def crawlDocuments(docIds, skipIssns, forceContinue):
     if fileLogHandler!=None:
         rootLog.handlers.remove(fileLogHandler)
 
+class HostTokenBuckets(object):
+    """ politeness delays for concurrent crawls: a token bucket per host. A host gets one
+    token every delaySecs, at most 'burst' tokens are kept. Every request takes a token,
+    if there is none, the thread sleeps until its token is due. Requests of different
+    threads to the same host are queued in the order of their arrival. Counts requests and
+    waiting time per host.
+
+    >>> b = HostTokenBuckets()
+    >>> b.acquire("a.com", 0.2), b.acquire("b.com", 0.2), round(b.acquire("a.com", 0.2), 1)
+    (0.0, 0.0, 0.2)
+    """
+    def __init__(self, burst=None):
+        if burst is None:
+            burst = HOSTBURST
+        self.burst = float(burst)
+        self.lock = threading.Lock()
+        self.buckets = {} # host -> [tokens, time of last update]
+        self.reqCounts = defaultdict(int)
+        self.waitSecs = defaultdict(float)
+        self.startTime = time.time()
+
+    def acquire(self, host, delaySecs):
+        " take a token from the bucket of host, sleep until it is available. Return seconds waited. "
+        delaySecs = float(delaySecs)
+        with self.lock:
+            now = time.time()
+            tokens, lastTime = self.buckets.get(host, (self.burst, now))
+            if delaySecs <= 0:
+                tokens = self.burst
+            else:
+                tokens = min(self.burst, tokens + (now-lastTime)/delaySecs)
+            # tokens below 0 are reservations of threads that are sleeping
+            tokens -= 1.0
+            self.buckets[host] = [tokens, now]
+            waitSec = max(0.0, -tokens*delaySecs)
+            self.reqCounts[host] += 1
+            self.waitSecs[host] += waitSec
+
+        if waitSec > 0:
+            logging.info("Waiting for %f seconds before downloading from host %s" % (waitSec, host))
+            time.sleep(waitSec)
+        return waitSec
+
+    def report(self):
+        " log the number of requests per minute and the average waiting time for each host "
+        minutes = max(time.time()-self.startTime, 1.0)/60
+        with self.lock:
+            hostCounts = sorted(self.reqCounts.items(), key=lambda x: -x[1])
+            for host, count in hostCounts:
+                logging.info("host %s: %d requests, %.1f requests/min, %.1f secs wait per request" % \
+                    (host, count, count/minutes, self.waitSecs[host]/count))
+
+class DirLogFilter(logging.Filter):
+    " accept only the log messages of the threads that are crawling srcDir "
+    def __init__(self, srcDir, threadDirs):
+        logging.Filter.__init__(self)
+        self.srcDir = srcDir
+        self.threadDirs = threadDirs
+
+    def filter(self, record):
+        return self.threadDirs.get(record.thread)==self.srcDir
+
+class CrawlScheduler(object):
+    """ crawls documents with several threads, like crawlDocuments. There is one queue per
+    publisher (= source directory) and a publisher is crawled by at most dirThreads threads
+    at the same time. The threads take documents from the publishers in turn, so a slow
+    publisher or one that pauses after errors does not stop the others. The politeness
+    delays of getDelaySecs() are enforced per host by HostTokenBuckets, so the total
+    request rate of a host is the same as with a single thread. Every thread has its own
+    crawler objects (getCrawlers), requests session and firefox (startFirefox).
+
+    All source directories are locked during the crawl. docStatus.tab, issnStatus.tab and
+    the output files are written by one thread at a time and not at all anymore after
+    ctrl-c, see _stop(). Every directory's crawler.log gets the messages of the threads
+    that crawl it. The requests per host and the documents per publisher are logged
+    every CRAWLREPORTSECS seconds.
+    """
+    def __init__(self, docIds, skipIssns, forceContinue, threadCount, dirThreads=1):
+        self.skipIssns = skipIssns
+        self.forceContinue = forceContinue
+        self.threadCount = threadCount
+        self.dirThreads = dirThreads
+
+        self.queues = OrderedDict() # srcDir -> deque of docIds
+        for docId, srcDir in docIds:
+            self.queues.setdefault(srcDir, collections.deque()).append(docId)
+        self.srcDirs = list(self.queues)
+        self.nextDirIdx = 0
+        self.running = defaultdict(int) # srcDir -> number of threads crawling it
+        self.consecErrors = defaultdict(int)
+        self.doneCounts = defaultdict(int)
+        self.okCounts = defaultdict(int)
+        self.stopErrors = [] # pubGetErrors that stopped a directory
+        self.fatalError = None
+        self.stopEvent = threading.Event() # set after ctrl-c
+
+        self.cond = threading.Condition()
+        self.writeLock = threading.RLock()
+        self.threadDirs = {} # thread ident -> srcDir, for the DirLogFilters
+
+    def _nextDoc(self):
+        " return the next (docId, srcDir) to crawl, the publishers in turn, None if all are done "
+        with self.cond:
+            while True:
+                if self.fatalError is not None or self.stopEvent.is_set():
+                    return None
+                dirCount = len(self.srcDirs)
+                waitingDirs = 0
+                for i in range(dirCount):
+                    srcDir = self.srcDirs[(self.nextDirIdx+i) % dirCount]
+                    queue = self.queues[srcDir]
+                    if len(queue)==0:
+                        continue
+                    if self.running[srcDir] >= self.dirThreads:
+                        waitingDirs += 1
+                        continue
+                    self.nextDirIdx = (self.nextDirIdx+i+1) % dirCount
+                    self.running[srcDir] += 1
+                    return queue.popleft(), srcDir
+                if waitingDirs==0:
+                    return None
+                self.cond.wait(1.0)
+
+    def _stopDir(self, srcDir):
+        " do not crawl any more documents from srcDir "
+        with self.cond:
+            self.queues[srcDir].clear()
+
+    def _write(self, func, *args, **kwargs):
+        """ run a function that writes to the output directories, one thread at a time.
+        After ctrl-c, nothing is written anymore, see _stop() """
+        with self.writeLock:
+            if self.stopEvent.is_set():
+                return
+            func(*args, **kwargs)
+
+    def _crawlOne(self, docId, srcDir):
+        " crawl one document, like one iteration of crawlDocuments "
+        todoCount = sum([len(q) for q in self.queues.values()])
+        logging.info("--- Crawl start: docId %s, dir %s, %d IDs to crawl" % (docId, srcDir, todoCount))
+        webCache.clear()
+
+        try:
+            artMeta = getArticleMeta(docId)
+        except pubGetError:
+            self._write(writeDocIdStatus, srcDir, docId, "no_meta", "no metadata")
+            return
+
+        logging.info("Got Metadata: %s, %s, %s" % (artMeta["journal"], artMeta["year"], artMeta["title"]))
+
+        try:
+            self._write(checkIssnErrorCounts, artMeta, self.skipIssns, srcDir)
+            if self.stopEvent.is_set():
+                return
+            paperData = crawlOneDoc(artMeta, srcDir)
+            self._write(writePaperData, docId, artMeta, paperData, srcDir)
+            self.consecErrors[srcDir] = 0
+            self.okCounts[srcDir] += 1
+
+        except pubGetError as e:
+            self.consecErrors[srcDir] += 1
+            consecErrorCount = self.consecErrors[srcDir]
+            self._write(writeDocIdStatus, srcDir, artMeta["pmid"], e.logMsg, msg=e.longMsg, \
+                detail=e.detailMsg)
+            with self.writeLock:
+                issnYearErrorCounts[getIssnYear(artMeta)] += 1
+
+            # the waiting only pauses this publisher, the other threads go on
+            if e.logMsg not in ["noOutlinkOrDoi", "unknownHost", "noLicense"]:
+                waitSec = ERRWAIT*consecErrorCount
+                logging.debug("Sleeping for %d secs after error" % waitSec)
+                self.stopEvent.wait(waitSec)
+
+            if consecErrorCount > BIGWAITCONSECERR:
+                logging.warn("%d consecutive errors, pausing a bit" % consecErrorCount)
+                self.stopEvent.wait(900)
+
+            if consecErrorCount > MAXCONSECERR and not self.forceContinue:
+                logging.error("Too many consecutive errors, stopping crawl of %s" % srcDir)
+                e.longMsg = "Crawl of {} stopped after too many consecutive errors ({}): {}".format(\
+                    srcDir, consecErrorCount, e.longMsg)
+                self.stopErrors.append(e)
+                self._stopDir(srcDir)
+
+        except Exception as e:
+            if self.forceContinue:
+                logging.error("FAILED TO CRAWL PMID: {}".format(docId))
+                logging.error(traceback.format_exc())
+            else:
+                raise
+
+    def _work(self):
+        " thread: crawl documents until there are none left "
+        ident = threading.current_thread().ident
+        while True:
+            job = self._nextDoc()
+            if job is None:
+                break
+            docId, srcDir = job
+            self.threadDirs[ident] = srcDir
+            try:
+                self._crawlOne(docId, srcDir)
+            except:
+                logging.error(traceback.format_exc())
+                with self.cond:
+                    if self.fatalError is None:
+                        self.fatalError = sys.exc_info()
+            finally:
+                self.doneCounts[srcDir] += 1
+                with self.cond:
+                    self.running[srcDir] -= 1
+                    self.cond.notify_all()
+        stopFirefox()
+        self.threadDirs.pop(ident, None)
+
+    def report(self):
+        " log the throughput per host and per publisher "
+        hostLimiter.report()
+        hours = max(time.time()-hostLimiter.startTime, 1.0)/3600
+        for srcDir in self.srcDirs:
+            logging.info("dir %s: %d docs done, %d OK, %.1f docs/hour, %d left" % \
+                (srcDir, self.doneCounts[srcDir], self.okCounts[srcDir], \
+                self.doneCounts[srcDir]/hours, len(self.queues[srcDir])))
+
+    def _stop(self, threads):
+        """ after ctrl-c: the threads do not start new documents and do not write anything
+        anymore. Wait until a write that is running has finished, give the threads
+        CRAWLSTOPSECS to finish their current document and quit all firefox instances. """
+        # a second ctrl-c must not interrupt this
+        oldHandler = signal.signal(signal.SIGINT, ignoreCtrlc)
+        try:
+            logging.info("Stopping the crawl threads")
+            self.stopEvent.set()
+            with self.cond:
+                self.cond.notify_all()
+            with self.writeLock:
+                pass # from now on, _write() does not write anymore
+            endTime = time.time()+CRAWLSTOPSECS
+            for t in threads:
+                t.join(max(0.0, endTime-time.time()))
+            aliveCount = len([t for t in threads if t.is_alive()])
+            if aliveCount!=0:
+                logging.warn("%d threads did not stop, their current documents are not written" % \
+                    aliveCount)
+            stopAllFirefox()
+        finally:
+            signal.signal(signal.SIGINT, oldHandler)
+
+    def run(self):
+        " crawl all documents, return the number of downloaded articles "
+        global hostLimiter
+        rootLog = logging.getLogger('')
+        logHandlers = []
+        removeLocks()
+        for srcDir in self.srcDirs:
+            checkCreateLock(srcDir)
+            handler = pubGeneric.logToFile(join(srcDir, "crawler.log"))
+            handler.addFilter(DirLogFilter(srcDir, self.threadDirs))
+            logHandlers.append(handler)
+
+        hostLimiter = HostTokenBuckets()
+        threadCount = min(self.threadCount, len(self.srcDirs)*self.dirThreads)
+        logging.info("Crawling %d directories with %d threads" % (len(self.srcDirs), threadCount))
+        threads = []
+        for i in range(threadCount):
+            t = threading.Thread(target=self._work, name="crawler%d" % i)
+            t.daemon = True # a thread that does not stop after ctrl-c does not block the exit
+            t.start()
+            threads.append(t)
+
+        try:
+            lastReport = time.time()
+            try:
+                for t in threads:
+                    # join() with timeout, otherwise ctrl-c is not handled
+                    while t.is_alive():
+                        t.join(1.0)
+                        if time.time()-lastReport > CRAWLREPORTSECS:
+                            self.report()
+                            lastReport = time.time()
+            except KeyboardInterrupt:
+                self._stop(threads)
+                raise
+            self.report()
+        finally:
+            # the locks are removed only when no thread writes to the directories anymore
+            hostLimiter = None
+            removeLocks()
+            for handler in logHandlers:
+                rootLog.removeHandler(handler)
+
+        if self.fatalError is not None:
+            raise self.fatalError[0], self.fatalError[1], self.fatalError[2]
+        if len(self.stopErrors)!=0:
+            raise self.stopErrors[0]
+
+        successCount = sum(self.okCounts.values())
+        logging.info("Downloaded %d articles" % (successCount))
+        return successCount
+
+def crawlDocumentsConcurrent(docIds, skipIssns, forceContinue, threadCount, dirThreads=1):
+    """
+    run crawler on a list of (paperId, sourceDir) tuples with threadCount threads,
+    see CrawlScheduler
+    """
+    scheduler = CrawlScheduler(docIds, skipIssns, forceContinue, threadCount, dirThreads)
+    return scheduler.run()
+
 if __name__=="__main__":
     import doctest
     doctest.testmod()
@@ -160,6 +160,7 @@ class WordCounter:
     def __init__(self):
         self.wordCounts = {}
         self.headers = ["word", "count"]
+        self.streamReduce = True
 
     def map(self, article, file, text, results):
         " called once for each file. create dict word -> set of articleIds "
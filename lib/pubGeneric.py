@@ -5,8 +5,8 @@ from __future__ import division
 
 from builtins import range
 import os, logging, tempfile, sys, re, unicodedata, subprocess, time, types, traceback, \
-    glob, operator, doctest, ftplib, random, shutil, atexit, pickle
-import pubConf, pubXml, maxCommon, pubStore, maxRun, maxTables, pubKeyVal
+    glob, operator, doctest, ftplib, random, shutil, atexit, pickle, hashlib, gzip, threading, functools
+import pubConf, pubXml, maxCommon, pubStore, maxRun, maxTables, pubKeyVal, pubConverters
 from os.path import *
 from distutils.spawn import find_executable
 
@@ -43,6 +43,8 @@ def openKeyValDb(dbName, newDb=False, singleProcess=False, prefer=None):
     # possible other candidates: mdb, cdb, hamsterdb
     if prefer=="server":
         return pubKeyVal.RedisDb(dbName, newDb=newDb, singleProcess=singleProcess)
+    elif prefer=="const":
+        return pubKeyVal.ConstKvDb(dbName, newDb=newDb, singleProcess=singleProcess)
     else:
         return pubKeyVal.SqliteKvDb(dbName, newDb=newDb, singleProcess=singleProcess, tmpDir=pubConf.getFastTempDir())
 
@@ -101,10 +103,12 @@ def runCommandTimeout(command, timeout=30, bufSize=128000, env=None, shell=True)
         closeFds = True
     proc = subprocess.Popen(command, bufsize=bufSize, stdout=subprocess.PIPE, \
         stderr=subprocess.PIPE, shell=shell, close_fds=closeFds, env=env)
-    poll_seconds = 1
+    # start polling fast, most converter runs on small files take only a few msecs
+    poll_seconds = 0.01
     deadline = time.time()+timeout
     while time.time() < deadline and proc.poll() == None:
         time.sleep(poll_seconds)
+        poll_seconds = min(2*poll_seconds, 1)
 
     if proc.poll() == None:
         proc.terminate()
@@ -315,6 +319,28 @@ def runConverter(cmdLine, fileContent, fileExt, tempDir):
     else:
         return asciiData
 
+def convertBinary(cmdLine, fileContent, fileExt, tempDir):
+    """ convert with the in-process converter for fileExt if pubConf.pyConverterExts
+    selects one, otherwise run the external cmdLine. Returns text or None.
+    Adds the time to pubConverters.convStats. """
+    startTime = time.time()
+    pyConv = pubConverters.getPyConverter(fileExt)
+    if pyConv is not None:
+        asciiData = pubConverters.runPyConverter(pyConv, fileContent, fileExt)
+    else:
+        asciiData = runConverter(cmdLine, fileContent, fileExt, tempDir)
+    pubConverters.convStats.add(fileExt, len(fileContent), time.time()-startTime, asciiData is None)
+    return asciiData
+
+def startConverterPool(procCount=None):
+    """ start pubConf.convertProcs long-lived converter processes, see pubConverters.ConverterPool.
+    Returns None if procCount is 0. Start it early, the workers are forked from this process. """
+    if procCount is None:
+        procCount = pubConf.convertProcs
+    if procCount==0:
+        return None
+    return pubConverters.ConverterPool(procCount, convertBinary)
+
 # http://stackoverflow.com/questions/92438/stripping-non-printable-characters-from-a-string-in-python
 def countBadChars(string):
     """ count special chars in string, but not tab, cr, nl, etc """
@@ -358,9 +384,109 @@ def getFileExt(fileData, locFname, mimeType):
     logging.debug("File extension determined as  %s" % fileExt)
     return fileExt
 
+class ConvCache(object):
+    """ a content-addressed cache of converter output on disk. The key is the sha1 of
+    the input file plus its extension, so an unchanged file that reappears in a later
+    update (e.g. the supplementary files of updated PMC articles) is not converted again.
+    Failed conversions are not cached. Several processes can share one cacheDir.
+    A hit touches the file, so prune() can remove the least recently used ones.
+    """
+    def __init__(self, cacheDir):
+        self.cacheDir = cacheDir
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def makeKey(self, fileContent, fileExt, cmdLine):
+        " the converter is part of the key, the pdf fallback converter gives other output "
+        sha1 = hashlib.sha1(fileContent)
+        sha1.update("\0"+cmdLine)
+        return sha1.hexdigest()+"."+fileExt
+
+    def _path(self, key):
+        return join(self.cacheDir, key[:2], key+".txt.gz")
+
+    def get(self, key):
+        " return the converted text for key or None "
+        fname = self._path(key)
+        try:
+            data = gzip.open(fname).read()
+        except IOError:
+            with self.lock:
+                self.misses += 1
+            return None
+        try:
+            os.utime(fname, None)
+        except OSError:
+            pass # removed by prune() in the meantime
+        with self.lock:
+            self.hits += 1
+        return forceToUnicode(data)
+
+    def put(self, key, asciiData):
+        " store converted text, via a temp file and rename so readers never see partial files "
+        fname = self._path(key)
+        subDir = dirname(fname)
+        if not isdir(subDir):
+            try:
+                os.makedirs(subDir)
+            except OSError:
+                pass # another process was faster
+        if isinstance(asciiData, unicode):
+            asciiData = asciiData.encode("utf8")
+        try:
+            fd, tmpName = tempfile.mkstemp(dir=subDir, prefix=".tmp.", suffix=".txt.gz")
+            rawFh = os.fdopen(fd, "wb")
+            ofh = gzip.GzipFile(fileobj=rawFh, mode="wb")
+            ofh.write(asciiData)
+            ofh.close()
+            rawFh.close()
+            os.rename(tmpName, fname)
+        except (IOError, OSError) as ex:
+            logging.warn("Could not write %s to conversion cache: %s" % (key, ex))
+
+    def prune(self, maxFiles):
+        " remove the least recently used files until there are at most maxFiles left "
+        entries = []
+        for subDir in glob.glob(join(self.cacheDir, "??")):
+            for fname in os.listdir(subDir):
+                if fname.startswith(".tmp."):
+                    continue
+                path = join(subDir, fname)
+                try:
+                    entries.append((os.path.getmtime(path), path))
+                except OSError:
+                    pass
+        if len(entries) <= maxFiles:
+            return 0
+        entries.sort()
+        delCount = len(entries)-maxFiles
+        logging.info("Removing %d least recently used files from conversion cache %s" % \
+            (delCount, self.cacheDir))
+        for mtime, path in entries[:delCount]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return delCount
+
+    def runConverter(self, cmdLine, fileContent, fileExt, tempDir, convFunc=None):
+        " like convFunc (default: convertBinary), but look up the result in the cache first "
+        if convFunc is None:
+            convFunc = convertBinary
+        key = self.makeKey(fileContent, fileExt, cmdLine)
+        asciiData = self.get(key)
+        if asciiData is not None:
+            logging.debug("conversion cache hit %s" % key)
+            return asciiData
+        asciiData = convFunc(cmdLine, fileContent, fileExt, tempDir)
+        if asciiData is not None:
+            self.put(key, asciiData)
+        return asciiData
+
 def toAscii(fileData, mimeType=None, \
         maxBinFileSize=pubConf.maxBinFileSize, maxTxtFileSize=pubConf.maxTxtFileSize, \
-        minTxtFileSize=pubConf.minTxtFileSize):
+        minTxtFileSize=pubConf.minTxtFileSize, convCache=None, convPool=None):
     """ pick out the content from the fileData dictionary,
     write it to a local file in tempDir and convert it to
     ASCII format. Put output back into the content field.
@@ -370,6 +496,9 @@ def toAscii(fileData, mimeType=None, \
 
     returns fileData if successful, otherwise None
     returns only unicode strings (despite the name)
+
+    If convCache is a ConvCache, the output of external converters is cached.
+    If convPool is a pubConverters.ConverterPool, the conversion runs in one of its workers.
     """
     converters = pubConf.getConverters()
     tempDir = pubConf.getTempDir()
@@ -415,14 +544,19 @@ def toAscii(fileData, mimeType=None, \
         fileData["content"]=asciiData
 
     else:
-        asciiData = runConverter(cmdLine, fileContent, fileExt, tempDir)
+        convFunc = convertBinary
+        if convPool is not None:
+            convFunc = convPool.runConverter
+        if convCache is not None:
+            convFunc = functools.partial(convCache.runConverter, convFunc=convFunc)
+        asciiData = convFunc(cmdLine, fileContent, fileExt, tempDir)
 
         # try to detect corrupted pdf2text output and run second converter
         if fileExt=="pdf" and \
             ((asciiData==None or len(asciiData)<minTxtFileSize) or countBadChars(asciiData)>=10):
             logging.debug("No data or too many non printable characters in PDF, trying alternative program")
             cmdLine = converters["pdf2"]
-            asciiData = runConverter(cmdLine, fileContent, fileExt, tempDir)
+            asciiData = convFunc(cmdLine, fileContent, fileExt, tempDir)
 
         if asciiData==None:
             logging.info("conversion failed for %s" % fileDebugDesc)
@@ -448,12 +582,13 @@ def toAscii(fileData, mimeType=None, \
 
     return fileData
 
-def toAsciiEscape(fileData, mimeType=None, maxBinFileSize=pubConf.maxBinFileSize, maxTxtFileSize=pubConf.maxBinFileSize, minTxtFileSize=pubConf.minTxtFileSize):
+def toAsciiEscape(fileData, mimeType=None, maxBinFileSize=pubConf.maxBinFileSize, maxTxtFileSize=pubConf.maxBinFileSize, minTxtFileSize=pubConf.minTxtFileSize, convCache=None, convPool=None):
     """ convert to ascii, escape special characters
         returns a fileData dict
     """
     fileData = toAscii(fileData, mimeType=mimeType,\
-            maxBinFileSize=maxBinFileSize, maxTxtFileSize=maxTxtFileSize, minTxtFileSize=minTxtFileSize)
+            maxBinFileSize=maxBinFileSize, maxTxtFileSize=maxTxtFileSize, minTxtFileSize=minTxtFileSize, \
+            convCache=convCache, convPool=convPool)
     fileData = pubStore.dictToUtf8Escape(fileData)
     return fileData
 
@@ -1,4 +1,4 @@
-import logging, random, socket, atexit, sqlite3, os, time, shutil, zlib
+import logging, random, socket, atexit, sqlite3, os, time, shutil, zlib, struct, mmap, array, sys
 from os.path import join, dirname, basename, isdir, isfile, abspath
 
 import maxCommon, maxTables
@@ -13,16 +13,53 @@ try:
 except ImportError:
     pass
 
-def openDb(dbName, newDb=False, singleProcess=False, prefer=None):
-    " factory function: returns the right db object given a filename "
+# constant key-value files, see ConstKvDb
+KVCEXT = ".kvc"
+KVCMAGIC = "PUBKVC01"
+KVCHEADERFMT = "<8sQQQI" # magic, indexOffset, slotCount, recordCount, blockSize (0=uncompressed)
+KVCRECFMT = "<II"        # keyLength, valLength, followed by the key and the value
+KVCBLOCKFMT = "<I"       # length of a zlib-compressed block of records
+# the index is three arrays of slotCount entries: key hashes (uint32), offsets of the records
+# in their uncompressed block (uint32) and offsets of the records or blocks (uint64, 0=empty)
+# small blocks, as every lookup of a key that is not cached has to decompress a whole block
+KVCBLOCKSIZE = 1024
+KVCHEADERSIZE = struct.calcsize(KVCHEADERFMT)
+KVCRECSIZE = struct.calcsize(KVCRECFMT)
+KVCBLOCKHEADSIZE = struct.calcsize(KVCBLOCKFMT)
+kvcRecStruct = struct.Struct(KVCRECFMT)
+kvcUint32 = struct.Struct("<I")
+kvcUint64 = struct.Struct("<Q")
+
+def keyHash(key):
+    " hash function of ConstKvDb "
+    return zlib.crc32(key) & 0xffffffff
+
+def toBytes(s):
+    " keys and values of ConstKvDb are byte strings "
+    if isinstance(s, unicode):
+        return s.encode("utf8")
+    return str(s)
+
+def writeArray(ofh, typeCode, values):
+    " write an array with little-endian values "
+    arr = array.array(typeCode, values)
+    if sys.byteorder=="big":
+        arr.byteswap()
+    arr.tofile(ofh)
+
+def openDb(dbName, newDb=False, singleProcess=False, prefer=None, bulk=False, wal=False, compress=False):
+    """ factory function: returns the right db object given a filename. wal is only used by
+    sqlite, compress only when a new const db is written. """
     #return LevelDb(dbName, newDb=newDb)
     # possible other candidates: mdb, cdb, hamsterdb
     logging.info("key-value store preference for: %s" % prefer)
     logging.info("newDb %s" % str(newDb))
     if prefer=="server":
         return RedisDb(dbName, newDb=newDb, singleProcess=singleProcess)
+    elif prefer=="const":
+        return ConstKvDb(dbName, newDb=newDb, singleProcess=singleProcess, compress=compress)
     else:
-        return SqliteKvDb(dbName, newDb=newDb, singleProcess=singleProcess)
+        return SqliteKvDb(dbName, newDb=newDb, singleProcess=singleProcess, bulk=bulk, wal=wal)
 
 def findFreePort(port=None):
     """
@@ -175,8 +212,41 @@ class SqliteKvDb(object):
         Uses batches when writing.
         On ramdisk, this can write 50k pairs / sec, tested on 40M uniprot pairs
         set onlyUnique if you know that the keys are unique.
+        With bulk=True, a new db is built for a rebuild: the pairs are written to an unindexed
+        staging db and copied in key order into the db at close(), which is then renamed to
+        its final name. Readers see the old db until then.
+        With wal=True, updates of an existing db switch it to WAL mode, so readers are not
+        blocked by the writer. The mode is stored in the db and WAL needs shared memory, so
+        all readers have to be on the same host. It is not switched on if the db is on a
+        network filesystem.
+
+    >>> db = SqliteKvDb("/tmp/pubKeyValTest", newDb=True, bulk=True, eightBit=True)
+    >>> db.update([("b", "1"), ("a", "2"), ("b", "3")])
+    >>> db.close()
+    >>> db = SqliteKvDb("/tmp/pubKeyValTest", eightBit=True)
+    >>> db["a"], db["b"], sorted(db.keys())
+    ('2', '3', ['a', 'b'])
+    >>> db.update([("c", "4")])
+    >>> db.con.execute("PRAGMA journal_mode").fetchone()[0], db["c"]
+    ('delete', '4')
+    >>> db.close()
+    >>> db = SqliteKvDb("/tmp/pubKeyValTest", eightBit=True, wal=True)
+    >>> db.update([("c", "4")])
+    >>> db.con.execute("PRAGMA journal_mode").fetchone()[0]
+    'wal'
+    >>> db.close()
+    >>> db = SqliteKvDb("/tmp/pubKeyValTest", newDb=True, bulk=True, eightBit=True)
+    >>> db.update([("d", "5")])
+    >>> SqliteKvDb("/tmp/pubKeyValTest", eightBit=True)["c"]
+    '4'
+    >>> db.close()
+    >>> db = SqliteKvDb("/tmp/pubKeyValTest", eightBit=True)
+    >>> sorted(db.keys())
+    ['d']
+    >>> db.close()
+    >>> os.remove(db.dbName)
     """
-    def __init__(self, fname, singleProcess=False, newDb=False, tmpDir=None, onlyKey=False, compress=False, keyIsInt=False, eightBit=False, onlyUnique=False):
+    def __init__(self, fname, singleProcess=False, newDb=False, tmpDir=None, onlyKey=False, compress=False, keyIsInt=False, eightBit=False, onlyUnique=False, bulk=False, wal=False):
         self.onlyUnique = onlyUnique
         self.compress = compress
         self.batchMaxSize = 100000
@@ -184,14 +254,27 @@ class SqliteKvDb(object):
         self.finalDbName = None
         self.onlyKey = onlyKey
         self.dbName = "%s.sqlite" % fname
-        if newDb and isfile(self.dbName):
+        # a bulk rebuild keeps the old db until it is replaced by the new one in close()
+        self.bulk = bulk and (newDb or not isfile(self.dbName))
+        if newDb and not self.bulk and isfile(self.dbName):
             os.remove(self.dbName)
         isolLevel = None
         self.singleProcess = singleProcess
         if singleProcess:
             isolLevel = "exclusive"
         self.con = None
-        if not os.path.isfile(self.dbName) and tmpDir!=None:
+        # incremental updates switch to WAL on the first write
+        self.useWal = wal and not self.bulk
+        if self.bulk:
+            # build the new db under a temporary name, on the ramdisk if possible
+            self.finalDbName = self.dbName
+            tmpName = "%s.%d.tmp" % (basename(self.dbName), os.getpid())
+            self.dbName = join(tmpDir or dirname(abspath(self.dbName)), tmpName)
+            logging.debug("Bulk-loading new db into %s" % self.dbName)
+            if isfile(self.dbName):
+                os.remove(self.dbName)
+            maxCommon.delOnExit(self.dbName)
+        elif not os.path.isfile(self.dbName) and tmpDir!=None:
             # create a new temp db on ramdisk
             self.finalDbName = self.dbName
             #self.dbName = join(pubConf.getFastTempDir(), basename(self.dbName))
@@ -226,6 +309,20 @@ class SqliteKvDb(object):
             self.cur.execute("PRAGMA temp_store=memory")
             self.con.commit()
 
+        if self.bulk:
+            # the pairs go into a staging db without an index, the primary key index of the
+            # db is then built in one go by inserting them in key order in close()
+            self.loadDbName = self.dbName+".load"
+            if isfile(self.loadDbName):
+                os.remove(self.loadDbName)
+            maxCommon.delOnExit(self.loadDbName)
+            self.con.execute("ATTACH DATABASE ? AS load", (self.loadDbName,))
+            self.con.execute("CREATE TABLE load.data (key %s, value BLOB)" % keyType)
+            for dbAlias in ["main", "load"]:
+                self.con.execute("PRAGMA %s.synchronous=OFF" % dbAlias)
+                self.con.execute("PRAGMA %s.journal_mode=OFF" % dbAlias)
+            self.con.commit()
+
         if eightBit:
             self.con.text_factory = str
 
@@ -255,6 +352,20 @@ class SqliteKvDb(object):
             value = zlib.decompress(value)
         return value
 
+    def getMany(self, keys, batchSize=500):
+        " return a dict key -> value for all keys that are in the db, with one query per batchSize keys "
+        keys = list(keys)
+        res = {}
+        for i in range(0, len(keys), batchSize):
+            batch = keys[i:i+batchSize]
+            sql = "select key, value from data where key in (%s)" % ",".join(["?"]*len(batch))
+            for key, value in self.con.execute(sql, batch):
+                value = maxCommon.toAscii(value)
+                if self.compress:
+                    value = zlib.decompress(value)
+                res[key] = value
+        return res
+
     def __setitem__(self, key, value):
         if self.compress:
             value = zlib.compress(value)
@@ -284,10 +395,20 @@ class SqliteKvDb(object):
     def update(self, keyValPairs):
         " add many key,val pairs at once "
         logging.debug("Writing %d key-val pairs to db" % len(keyValPairs))
-        if self.onlyUnique:
+        if self.bulk:
+            sql = "INSERT INTO load.data (key, value) VALUES (?,?)"
+        elif self.onlyUnique:
             sql = "INSERT INTO data (key, value) VALUES (?,?)"
         else:
             sql = "INSERT OR REPLACE INTO data (key, value) VALUES (?,?)"
+        if self.useWal:
+            self.useWal = False
+            if maxCommon.isNetworkFs(dirname(abspath(self.dbName))):
+                logging.warn("%s is on a network filesystem, not switching it to WAL mode" % \
+                    self.dbName)
+            else:
+                self.con.execute("PRAGMA journal_mode=WAL")
+                self.con.execute("PRAGMA synchronous=NORMAL")
         #try:
         self.cur.executemany(sql, keyValPairs)
         #except sqlite3.IntegrityError:
@@ -297,16 +418,283 @@ class SqliteKvDb(object):
     def keys(self):
         return [row[0] for row in self.con.execute("select key from data").fetchall()]
 
+    def _finishBulk(self):
+        " copy the staging db in key order into the db and rename it to its final name "
+        logging.info("Sorting and indexing %s" % self.dbName)
+        if self.onlyUnique:
+            sql = "INSERT INTO main.data SELECT %s FROM load.data ORDER BY key"
+        else:
+            # the last value of a key wins, like with INSERT OR REPLACE
+            sql = "INSERT OR REPLACE INTO main.data SELECT %s FROM load.data ORDER BY key, rowid"
+        cols = "key, value"
+        if self.onlyKey:
+            cols = "key"
+        self.con.execute(sql % cols)
+        self.con.commit()
+        self.con.execute("DETACH DATABASE load")
+        self.con.close()
+        os.remove(self.loadDbName)
+
+        finalTmpName = "%s.%d.tmp" % (self.finalDbName, os.getpid())
+        if dirname(abspath(self.dbName))!=dirname(abspath(self.finalDbName)):
+            logging.info("Copying %s to %s" % (self.dbName, finalTmpName))
+            shutil.copy(self.dbName, finalTmpName)
+            os.remove(self.dbName)
+        os.rename(finalTmpName, self.finalDbName)
+        logging.info("Renamed new db to %s" % self.finalDbName)
+
     def close(self):
         if len(self.batch)>0:
             self.update(self.batch)
         self.con.commit()
+        if self.bulk:
+            self._finishBulk()
+            return
         self.con.close()
         if self.finalDbName!=None:
             logging.info("Copying %s to %s" % (self.dbName, self.finalDbName))
             shutil.copy(self.dbName, self.finalDbName)
             os.remove(self.dbName)
 
+class ConstKvDb(object):
+    """ immutable on-disk key/value store, like cdb or sparkey. It is written in a single pass
+        and read through mmap with one hash table lookup per key, so many processes can
+        share it. A new file is created if newDb is set or if the file does not exist yet,
+        it is only visible after close(). An existing file cannot be changed, it has to be
+        written again. The last value of a key wins, None is stored as "".
+        With compress=True, the records are zlib-compressed in blocks of KVCBLOCKSIZE bytes.
+        Writing needs ~40 bytes of RAM per key for the index.
+
+    >>> db = ConstKvDb("/tmp/pubKeyValTest", newDb=True)
+    >>> db.update([("a", "1"), ("b", None), ("a", "2")])
+    >>> db.close()
+    >>> db = ConstKvDb("/tmp/pubKeyValTest")
+    >>> db["a"], db.get("b"), "c" in db, len(db), sorted(db.keys())
+    ('2', '', False, 2, ['a', 'b'])
+    >>> db.getMany(["a", "c"])
+    {'a': '2'}
+    >>> db.update([("c", "3")])
+    Traceback (most recent call last):
+    ...
+    Exception: /tmp/pubKeyValTest.kvc is a constant key-value db and cannot be changed, write it again with newDb=True
+    >>> os.remove(db.dbName)
+    """
+    def __init__(self, fname, singleProcess=False, newDb=False, compress=False, blockCacheSize=1024):
+        self.dbName = fname+KVCEXT
+        self.blockCache = maxCommon.LruCache(blockCacheSize)
+        self.mm = None
+        self.ofh = None
+        if newDb or not isfile(self.dbName):
+            self.tmpName = "%s.%d.tmp" % (self.dbName, os.getpid())
+            logging.debug("Creating constant key-value db %s" % self.tmpName)
+            self.ofh = open(self.tmpName, "w+b")
+            self.ofh.write(struct.pack(KVCHEADERFMT, KVCMAGIC, 0, 0, 0, 0))
+            self.filePos = KVCHEADERSIZE
+            self.blockSize = 0
+            if compress:
+                self.blockSize = KVCBLOCKSIZE
+            self.block = []
+            self.blockLen = 0
+            # hash, offset in block, file offset of every record
+            self.recHashes = array.array("I")
+            self.recPos = array.array("I")
+            self.recOffsets = array.array("L")
+        else:
+            logging.debug("Opening constant key-value db %s" % self.dbName)
+            self.ifh = open(self.dbName, "rb")
+            self._openMmap(self.ifh)
+
+    def _openMmap(self, fh):
+        " map the file and read the header "
+        self.mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, indexOffset, self.slotCount, self.recordCount, self.blockSize = \
+            struct.unpack_from(KVCHEADERFMT, self.mm, 0)
+        if magic!=KVCMAGIC:
+            raise Exception("%s is not a constant key-value db" % self.dbName)
+        self.hashStart = indexOffset
+        self.posStart = indexOffset+4*self.slotCount
+        self.offsetStart = indexOffset+8*self.slotCount
+
+    def _getBlock(self, offset):
+        " return the uncompressed block at offset "
+        block = self.blockCache.get(offset)
+        if block is None:
+            compLen, = kvcUint32.unpack_from(self.mm, offset)
+            start = offset+KVCBLOCKHEADSIZE
+            block = zlib.decompress(self.mm[start:start+compLen])
+            self.blockCache.put(offset, block)
+        return block
+
+    def _readRecord(self, offset, pos):
+        " return key and value of the record at file offset or at pos in the block at offset "
+        if self.blockSize==0:
+            data, start = self.mm, offset
+        else:
+            data, start = self._getBlock(offset), pos
+        keyLen, valLen = kvcRecStruct.unpack_from(data, start)
+        keyStart = start+KVCRECSIZE
+        valStart = keyStart+keyLen
+        return data[keyStart:valStart], data[valStart:valStart+valLen]
+
+    def _lookup(self, key):
+        " return the value of key or None "
+        if not isinstance(key, str):
+            key = toBytes(key)
+        h = zlib.crc32(key) & 0xffffffff # keyHash(), inlined
+        mm = self.mm
+        slot = h % self.slotCount
+        while True:
+            offset, = kvcUint64.unpack_from(mm, self.offsetStart+8*slot)
+            if offset==0:
+                return None
+            if kvcUint32.unpack_from(mm, self.hashStart+4*slot)[0]==h:
+                pos, = kvcUint32.unpack_from(mm, self.posStart+4*slot)
+                recKey, val = self._readRecord(offset, pos)
+                if recKey==key:
+                    return val
+            slot += 1
+            if slot==self.slotCount:
+                slot = 0
+
+    def get(self, key, default=None):
+        val = self._lookup(key)
+        if val is None:
+            return default
+        return val
+
+    def __contains__(self, key):
+        return self._lookup(key) is not None
+
+    def __getitem__(self, key):
+        val = self._lookup(key)
+        if val is None:
+            raise KeyError(key)
+        return val
+
+    def __len__(self):
+        return self.recordCount
+
+    def getMany(self, keys):
+        " return a dict key -> value for all keys that are in the db "
+        res = {}
+        for key in keys:
+            val = self._lookup(key)
+            if val is not None:
+                res[key] = val
+        return res
+
+    def keys(self):
+        offsets = array.array("L")
+        offsets.fromstring(self.mm[self.offsetStart:self.offsetStart+8*self.slotCount])
+        positions = array.array("I")
+        positions.fromstring(self.mm[self.posStart:self.posStart+4*self.slotCount])
+        if sys.byteorder=="big":
+            offsets.byteswap()
+            positions.byteswap()
+        return [self._readRecord(offset, pos)[0] for offset, pos in zip(offsets, positions) if offset!=0]
+
+    def dispName(self):
+        " return a name for log messages "
+        return "const:"+self.dbName
+
+    def _checkWritable(self):
+        if self.ofh is None:
+            raise Exception("%s is a constant key-value db and cannot be changed, "
+                "write it again with newDb=True" % self.dbName)
+
+    def __setitem__(self, key, value):
+        self._checkWritable()
+        key = toBytes(key)
+        if value is None:
+            value = ""
+        value = toBytes(value)
+        rec = struct.pack(KVCRECFMT, len(key), len(value))+key+value
+        self.recHashes.append(keyHash(key))
+        self.recOffsets.append(self.filePos)
+        if self.blockSize==0:
+            self.recPos.append(0)
+            self.ofh.write(rec)
+            self.filePos += len(rec)
+        else:
+            self.recPos.append(self.blockLen)
+            self.block.append(rec)
+            self.blockLen += len(rec)
+            if self.blockLen>=self.blockSize:
+                self._writeBlock()
+
+    def _writeBlock(self):
+        " compress and write the current block "
+        data = zlib.compress("".join(self.block))
+        self.ofh.write(struct.pack(KVCBLOCKFMT, len(data)))
+        self.ofh.write(data)
+        self.filePos += KVCBLOCKHEADSIZE+len(data)
+        self.block = []
+        self.blockLen = 0
+
+    def update(self, keyValPairs):
+        " add many key,val pairs at once "
+        self._checkWritable()
+        for key, val in keyValPairs:
+            self[key] = val
+
+    def _writeIndex(self):
+        " build the hash table with linear probing and write it after the records "
+        hashes, positions, offsets = self.recHashes, self.recPos, self.recOffsets
+        slotCount = max(1, (len(hashes)*10)//7) # max load factor 0.7
+        logging.info("Indexing %d records into %d slots" % (len(hashes), slotCount))
+        slotHashes = array.array("I", [0])*slotCount
+        slotPos = array.array("I", [0])*slotCount
+        slotOffsets = array.array("L", [0])*slotCount
+        assert(slotOffsets.itemsize==8) # the offsets are 64 bit
+        # the records are mapped now, to compare the keys of duplicates and hash collisions
+        self.ofh.flush()
+        self.mm = mmap.mmap(self.ofh.fileno(), 0, access=mmap.ACCESS_READ)
+        recordCount = 0
+        # go backwards, so the last value of a key is found first
+        for i in xrange(len(hashes)-1, -1, -1):
+            h = hashes[i]
+            slot = h % slotCount
+            isDup = False
+            while slotOffsets[slot]!=0:
+                if slotHashes[slot]==h:
+                    slotKey = self._readRecord(slotOffsets[slot], slotPos[slot])[0]
+                    if slotKey==self._readRecord(offsets[i], positions[i])[0]:
+                        isDup = True
+                        break
+                slot += 1
+                if slot==slotCount:
+                    slot = 0
+            if not isDup:
+                slotHashes[slot] = h
+                slotPos[slot] = positions[i]
+                slotOffsets[slot] = offsets[i]
+                recordCount += 1
+        self.mm.close()
+        self.mm = None
+
+        self.ofh.seek(self.filePos)
+        writeArray(self.ofh, "I", slotHashes)
+        writeArray(self.ofh, "I", slotPos)
+        writeArray(self.ofh, "L", slotOffsets)
+        self.ofh.seek(0)
+        self.ofh.write(struct.pack(KVCHEADERFMT, KVCMAGIC, self.filePos, slotCount, \
+            recordCount, self.blockSize))
+
+    def close(self):
+        if self.ofh is not None:
+            if self.blockLen!=0:
+                self._writeBlock()
+            self._writeIndex()
+            self.ofh.close()
+            self.ofh = None
+            os.rename(self.tmpName, self.dbName)
+            logging.info("Wrote %d records to %s" % (len(self.recHashes), self.dbName))
+            self.recHashes = self.recPos = self.recOffsets = None
+        elif self.mm is not None:
+            self.mm.close()
+            self.mm = None
+            self.ifh.close()
+
 class LevelDb(object):
     """ wrapper around leveldb, store and query key/val pais.
     Not very useful, as it always locks the database, only one process can read!!
@@ -353,9 +741,15 @@ class LevelDb(object):
     def close(self):
         pass
 
-def indexKvFile(fname, startOffset=0, prefer=None, newDb=False):
-    " load a key-value tab-sep file with two fields into a key-value DB "
-    db  = openDb(fname, singleProcess=True, prefer=prefer, newDb=newDb)
+def indexKvFile(fname, startOffset=0, prefer=None, newDb=False, wal=False, compress=False):
+    """ load a key-value tab-sep file with two fields into a key-value DB. A new sqlite db is
+    bulk-loaded, an existing one is updated, in WAL mode if wal is set. A const db cannot
+    be updated, only written again with newDb. compress is only used for const dbs. """
+    if prefer=="const" and not newDb and isfile(fname+KVCEXT):
+        raise Exception("%s is a constant key-value db and cannot be updated, "
+            "write it again with newDb (pubIndexTab -n)" % (fname+KVCEXT))
+    db  = openDb(fname, singleProcess=True, prefer=prefer, newDb=newDb, bulk=True, wal=wal, \
+        compress=compress)
     ifh = maxTables.openFile(fname)
     ifh.seek(startOffset)
     i = 0
@@ -379,13 +773,13 @@ def indexKvFile(fname, startOffset=0, prefer=None, newDb=False):
             raise Exception("cannot load more than two fields or empty line")
 
         pairs.append ( (key, val) )
+        i+=1
 
-        if i%chunkSize==0:
+        if len(pairs)==chunkSize:
             db.update(pairs)
             logging.info("Wrote %d records..." % i)
             pairs = []
         #db[key] = val
-        i+=1
     if len(pairs)!=0:
         db.update(pairs)
     db.close()
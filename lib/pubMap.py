@@ -1,5 +1,6 @@
 import sys, logging, optparse, os, collections, tempfile,\
-    shutil, glob, array, codecs, string, re, gzip, time, socket, subprocess
+    shutil, glob, array, codecs, string, re, gzip, time, socket, subprocess, multiprocessing, \
+    operator, heapq, marshal
 
 import maxRun, pubStore, pubConf, pubGeneric, maxCommon, bigBlat, pubAlg, unidecode
 import maxbio, tabfile, maxMysql, maxTables, util, pubMapProp, pubCdr3Filter
@@ -360,6 +361,7 @@ def chainPsls(pslList, maxDistDict):
     """
     logging.log(5, "%d unchained genome hits" % len(pslList))
     chromPsls = indexByDbChrom(pslList)
+    getStart = operator.attrgetter("tStart")
 
     chains = {}
     for dbChrom, chromPslList in chromPsls.iteritems():
@@ -368,8 +370,9 @@ def chainPsls(pslList, maxDistDict):
         if "_hap" in chrom:
             logging.log(5, "haplotype chromosome, skipping all features")
             continue
-        chromPslList = maxbio.sortList(chromPslList, "tStart", reverse=False)
-        chain = []
+        chromPslList.sort(key=getStart)
+        chain = {}
+        chainId = None
         lastEnd = None
         alreadyChained = {}
         maxDist = maxDistDict.get(db, maxDistDict["default"])
@@ -382,31 +385,24 @@ def chainPsls(pslList, maxDistDict):
                     logging.log(5, "same match, but different tSequenceType (cdna, prot, genome)," \
                         "keeping hit")
                 else:
-                    logging.log(5, "weird match, q-sequence already in this chain, skipping %s" % \
-                        str(psl))
+                    logging.log(5, "weird match, q-sequence already in this chain, skipping %s", psl)
                     continue
             if len(chain)>0 and abs(int(psl.tStart) - lastEnd) > maxDist:
-                chainId = chain[0].tName + "-" + str(chain[0].tStart)
                 chains[chainId]=chain
                 alreadyChained = {}
-                chain = []
-            logging.log(5, "Adding feature %s to chain" % str(psl))
-            chain.append(psl)
+                chain = {}
+            if len(chain)==0:
+                # chainId looks like hg19,chr1,g-123456
+                chainId = psl.tName + "-" + str(psl.tStart)
+                chainStart = psl.tStart
+            logging.log(5, "Adding feature %s to chain", psl)
+            chain.setdefault(psl.qName, []).append(psl)
             alreadyChained[psl.qName] = psl
             lastEnd = psl.tEnd
-        chainId = db + "," + chrom + "-" + str(chain[0].tStart)
+        chainId = db + "," + chrom + "-" + str(chainStart)
         chains[chainId]=chain
 
-    # index all chains by qName to create a nested dict chainId -> seqId -> pslList
-    # chainId looks like hg19,chr1,123456
-    idxChains = {}
-    for chainId, pslList in chains.iteritems():
-        pslDict = {}
-        for psl in pslList:
-            pslDict.setdefault(psl.qName, []).append(psl)
-        idxChains[chainId] = pslDict
-
-    return idxChains
+    return chains
 
 #def indexByDb(pslList):
     #""" index psl by db (in target name) and return as dict[db] -> list of psls
@@ -418,17 +414,6 @@ def chainPsls(pslList, maxDistDict):
         #pslByDb.setdefault(db, []).append(psl)
     #return pslByDb
 
-def getBestElements(dict):
-    """ given a dict with name -> score, keep only the ones with the highest score,
-        return them as a list
-    """ 
-    maxScore = max(dict.values())
-    result = []
-    for key, value in dict.iteritems():
-        if value == maxScore:
-            result.append(key)
-    return result
-
 def onlyLongestChains(chains): 
     """ given a dict chainId -> annotId -> list of psls,
     return a filtered list where members are 
@@ -456,42 +441,57 @@ def onlyLongestChains(chains):
 
     so chain2 is kept, its sequences removed from all other chains and the process repeats
     until there are no chains left.
+
+    Chains with the same number of members are kept together in one round. The
+    chains are in a heap by their number of members. When members are removed
+    from a chain, it is pushed again with its new size and the old entry is
+    skipped when it comes up.
     """
+    # chainId -> dict qName -> list of psls, only members not used yet
+    members = {}
+    qNameChains = defaultdict(list)
+    heap = []
+    for chainId, qNameDict in chains.iteritems():
+        members[chainId] = dict(qNameDict)
+        for qName in qNameDict:
+            qNameChains[qName].append(chainId)
+        heap.append((-len(qNameDict), chainId))
+    heapq.heapify(heap)
 
     bestChains = {}
-    while len(chains)!=0:
-        # create score for chains: number of qNames, e.g. chain1->1, chain2->3
-        logging.log(5, "Starting chain balancing with %d chains" % len(chains))
-        chainScores = {}
-        for chainId, qNameDict in chains.iteritems():
-            chainScores[chainId] = len(qNameDict.keys())
-        logging.log(5, "chainScores are: %s" % chainScores)
-
-        # keep only chains with best scores, create list with their chainIds
-        # and create list with  qNames of all their members
-        bestChainIds = getBestElements(chainScores)
-        logging.log(5, "Best chainIds are: %s" % str(bestChainIds))
+    while len(heap)!=0:
+        negScore, chainId = heapq.heappop(heap)
+        if chainId not in members or len(members[chainId])!=-negScore:
+            continue # outdated entry
+
+        # keep all chains with the best score
+        bestChainIds = [chainId]
+        while len(heap)!=0 and heap[0][0]==negScore:
+            negScore, chainId = heapq.heappop(heap)
+            if chainId in members and len(members[chainId])==-negScore:
+                bestChainIds.append(chainId)
+        logging.log(5, "Best chainIds with %d sequences: %s" % (-negScore, str(bestChainIds)))
+
         chainQNames = set()
         for bestChainId in bestChainIds:
             db = bestChainId.split(",")[0]
-            bestChain = chains[bestChainId]
+            bestChain = members.pop(bestChainId)
             bestChains.setdefault(db, []).append(maxbio.flattenValues(bestChain))
-            for pslList in bestChain.values():
-                for psl in pslList:
-                    chainQNames.add(psl.qName)
-        logging.log(5, "Best chain contains %d sequences, removing these from other chains" % \
-            len(chainQNames))
-
-        # keep only psls with names not in chainQNames 
-        newChains = {}
-        for chainId, chainDict in chains.iteritems():
-            newChainDict = {}
-            for qName, pslList in chainDict.iteritems():
-                if qName not in chainQNames:
-                    newChainDict[qName]=pslList
-            if len(newChainDict)!=0:
-                newChains[chainId] = newChainDict
-        chains = newChains
+            chainQNames.update(bestChain)
+
+        # remove their sequences from all other chains
+        changedIds = set()
+        for qName in chainQNames:
+            for chainId in qNameChains.pop(qName):
+                chainMembers = members.get(chainId)
+                if chainMembers is not None and qName in chainMembers:
+                    del chainMembers[qName]
+                    changedIds.add(chainId)
+        for chainId in changedIds:
+            if len(members[chainId])==0:
+                del members[chainId]
+            else:
+                heapq.heappush(heap, (-len(members[chainId]), chainId))
     return bestChains
 
 def chainsToBeds(chains):
@@ -635,70 +635,163 @@ def submitMergeSplitChain(runner, textDir, inDirs, splitDir, bedDir, maxDbMatchC
     #if len(filteredDirs)==0:
         #raise Exception("Nothing to do, %s are empty" % inDirs)
 
-    # merge/sort/filter psls into one file and split them again for chaining
-    mergedPslFilename = mergeFilterPsls(inDirs)
+    # merge/sort/filter psls and split them again for chaining
     articleToChunk = pubGeneric.readArticleChunkAssignment(textDir, updateIds)
-    splitPsls(mergedPslFilename, splitDir, articleToChunk, maxDbMatchCount)
-    os.remove(mergedPslFilename)
+    splitPsls(inDirs, splitDir, articleToChunk, maxDbMatchCount)
 
     submitChainFileJobs(runner, splitDir, bedDir, list(dbList))
 
-def mergeFilterPsls(inDirs):
-    """ merge/sort/filter all psls (separated by db) in inDir into a temp file with all
-    psls for all dbs, split into chunked pieces and write them to outDir 
+class PslPartWriter(object):
+    """ appends lines to one partition file per chunk, <outDir>/<chunkId>.<suffix>.psl.
+    Keeps up to maxCount files open, the least recently used one is closed when a new
+    one has to be opened and reopened for appending later.
     """
-    tmpFile, tmpPslFname = pubGeneric.makeTempFile("pubMap_split.", suffix=".psl")
-    tmpFile.close()
-    logging.debug("Merging into tmp file %s" % tmpPslFname)
-    pslSortTmpDir = join(pubConf.getTempDir(), "pubMap-sortSplitPsls")
-    if isdir(pslSortTmpDir):
-        shutil.rmtree(pslSortTmpDir)
-    os.makedirs(pslSortTmpDir)
-    logging.info("Sorting psls in %s to temp file %s" % (str(inDirs), pslSortTmpDir))
-    inDirString = " ".join(inDirs)
-    cmd = "pslSort dirs -nohead stdout %(pslSortTmpDir)s %(inDirString)s | pslCDnaFilter stdin %(tmpPslFname)s -minAlnSize=19 -globalNearBest=0" % locals()
-    maxCommon.runCommand(cmd)
-    shutil.rmtree(pslSortTmpDir)
-    return tmpPslFname
-
-def splitPsls(inPslFile, outDir, articleToChunk, maxDbMatchCount):
-    " splitting psls according to articleToChunk, ignore articles with > maxDbMatchCount psls "
-    logging.info("SPLIT PSL - Reading %s, splitting to directory %s" % (inPslFile, outDir))
+    def __init__(self, outDir, suffix, maxCount=500):
+        self.outDir = outDir
+        self.suffix = suffix
+        self.maxCount = maxCount
+        self.handles = collections.OrderedDict()
+        self.openCount = 0
+
+    def write(self, chunkIdStr, line):
+        fh = self.handles.pop(chunkIdStr, None)
+        if fh is None:
+            if len(self.handles) >= self.maxCount:
+                oldId, oldFh = self.handles.popitem(last=False)
+                oldFh.close()
+            fh = open(join(self.outDir, "%s.%s.psl" % (chunkIdStr, self.suffix)), "a")
+            self.openCount += 1
+        self.handles[chunkIdStr] = fh
+        fh.write(line)
+
+    def close(self):
+        for fh in self.handles.values():
+            fh.close()
+        self.handles.clear()
+
+# state of the psl split worker processes, set before the processes are forked
+# to share the big articleId -> chunk dict: partDir, articleToChunk, outDir, maxDbMatchCount
+splitState = {}
+
+def pslChunkId(articleId, articleToChunk):
+    """ return the chunkId of an article. Without an article to chunk assignment, use one chunk per
+    pubConf.chunkArticleCount articleIds """
+    if articleToChunk:
+        return articleToChunk[articleId] // pubConf.chunkDivider
+    return articleId // pubConf.chunkArticleCount
+
+def partitionPslFile(inFname):
+    """ append the lines of a psl file to one partition file per chunk. Lines are
+    not parsed, only the articleId of the qName is read. """
     articleDigits = pubConf.ARTICLEDIGITS
-    groupIterator = maxCommon.iterTsvGroups(inPslFile, format="psl", groupFieldNumber=9, useChars=articleDigits)
-
-    chunkFiles = {}
-    chunkId = 0
-    articleIdCount = 0
-    for articleId, pslList in groupIterator:
-        articleId = int(articleId)
-        articleIdCount += 1
-        # try to derive the current chunkId from the index files
-        # if that doesn't work, just create one chunk for each X
-        # articleIds
-        if articleToChunk:
-            chunkId  = articleToChunk[int(articleId)] / pubConf.chunkDivider
-        else:
-            chunkId  = articleIdCount / pubConf.chunkArticleCount
-        logging.debug("articleId %s, %d matches" % (articleId, len(pslList)))
-        if len(pslList) >= maxDbMatchCount:
-            logging.debug("Skipping %s: too many total matches" % str(pslList[0].qName))
+    articleToChunk = splitState["articleToChunk"]
+    writer = PslPartWriter(splitState["partDir"], str(os.getpid()), pubConf.pslSplitMaxOpenFiles)
+    chunkStrs = {}
+    for line in open(inFname):
+        # skip psLayout headers
+        if not line[:1].isdigit():
             continue
+        qName = line.split("\t", 10)[9]
+        articleId = int(qName[:articleDigits])
+        chunkIdStr = chunkStrs.get(articleId)
+        if chunkIdStr is None:
+            chunkIdStr = "%.5d" % pslChunkId(articleId, articleToChunk)
+            chunkStrs[articleId] = chunkIdStr
+        writer.write(chunkIdStr, line)
+    writer.close()
+    return writer.openCount
+
+def pslSortKey(line):
+    " sort key of a psl line: qName, tName, tStart, tEnd, then the line itself "
+    fields = line.split("\t", 17)
+    return (fields[9], fields[13], int(fields[15]), int(fields[16]), line)
+
+def filterSplitChunk(chunkIdStr):
+    """ sort the psls of a chunk by qName, keep only the best ones per qName with pslCDnaFilter
+    and write them to <outDir>/<chunkId>.psl, without articles with too many matches.
+    Returns (number of articles written, number of articles skipped) """
+    partFnames = sorted(glob.glob(join(splitState["partDir"], chunkIdStr+".*.psl")))
+    lines = []
+    for partFname in partFnames:
+        lines.extend(open(partFname).readlines())
+    # all psls of a query are consecutive. The order of the lines in the partition files
+    # depends on the processes that wrote them, so sort on the whole line, too, to get the
+    # same output from every run
+    lines.sort(key=pslSortKey)
+
+    cmd = ["pslCDnaFilter", "stdin", "stdout", "-minAlnSize=19", "-globalNearBest=0"]
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    filtered, dummy = proc.communicate("".join(lines))
+    if proc.returncode!=0:
+        raise Exception("pslCDnaFilter failed on chunk %s, return code %d" % (chunkIdStr, proc.returncode))
+    del lines
 
-        chunkIdStr  = "%.5d" % chunkId
-        if not chunkId in chunkFiles:
-            chunkFname = join(outDir, chunkIdStr+".psl")
-            outFile = open(chunkFname, "w")
-            chunkFiles[chunkId]= outFile
-        else:
-            outFile = chunkFiles[chunkId]
-
-        for psl in pslList:
-            pslString = "\t".join([str(x) for x in psl])+"\n"
-            outFile.write(pslString)
-
-        articleIdCount += 1
-    logging.info("Finished writing to %d files in directory %s" % (len(chunkFiles), outDir))
+    articleDigits = pubConf.ARTICLEDIGITS
+    maxDbMatchCount = splitState["maxDbMatchCount"]
+    outFile = open(join(splitState["outDir"], chunkIdStr+".psl"), "w")
+    writeCount, skipCount = 0, 0
+    artLines = []
+    lastArticleId = None
+    for line in filtered.splitlines(True)+[None]:
+        articleId = None
+        if line is not None:
+            articleId = line.split("\t", 10)[9][:articleDigits]
+        if articleId!=lastArticleId and len(artLines)!=0:
+            if len(artLines) >= maxDbMatchCount:
+                logging.debug("Skipping %s: too many total matches" % lastArticleId)
+                skipCount += 1
+            else:
+                outFile.write("".join(artLines))
+                writeCount += 1
+            artLines = []
+        if line is not None:
+            artLines.append(line)
+        lastArticleId = articleId
+    outFile.close()
+
+    for partFname in partFnames:
+        os.remove(partFname)
+    return writeCount, skipCount
+
+def splitPsls(inDirs, outDir, articleToChunk, maxDbMatchCount, procCount=None):
+    """ merge all psls (separated by db) in inDirs and split them into one file per article chunk
+    in outDir, keep only the best matches and ignore articles with >= maxDbMatchCount psls.
+
+    The psl lines are first partitioned by chunk into a temp dir, with each input file
+    processed by one of procCount processes. Then each chunk is sorted and filtered on its own,
+    also in procCount processes. Memory is limited by the size of a chunk.
+    """
+    if procCount is None:
+        procCount = pubConf.pslSplitProcs
+    partDir = join(pubConf.getTempDir(), "pubMap-splitPsls")
+    if isdir(partDir):
+        shutil.rmtree(partDir)
+    os.makedirs(partDir)
+
+    inFnames = []
+    for inDir in inDirs:
+        inFnames.extend([join(inDir, fname) for fname in sorted(os.listdir(inDir))])
+
+    splitState.update(partDir=partDir, articleToChunk=articleToChunk, outDir=outDir, \
+        maxDbMatchCount=maxDbMatchCount)
+    pool = multiprocessing.Pool(procCount)
+    try:
+        logging.info("SPLIT PSL - Partitioning %d psl files from %s by chunk into %s, %d processes" % \
+            (len(inFnames), str(inDirs), partDir, procCount))
+        pool.map(partitionPslFile, inFnames, chunksize=1)
+
+        chunkIdStrs = sorted(set([basename(fname).split(".")[0] for fname in os.listdir(partDir)]))
+        logging.info("SPLIT PSL - Sorting and filtering %d chunks, writing to %s" % (len(chunkIdStrs), outDir))
+        counts = pool.map(filterSplitChunk, chunkIdStrs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    shutil.rmtree(partDir)
+
+    writeCount = sum([c[0] for c in counts])
+    skipCount = sum([c[1] for c in counts])
+    logging.info("Finished writing %d articles to %d files in directory %s, skipped %d articles with too many matches" % \
+        (writeCount, len(chunkIdStrs), outDir, skipCount))
 
 def submitChainFileJobs(runner, pslDir, bedDir, dbList):
     """ submit jobs, one for each psl file in pslDir, to chain psls and convert to bed """
@@ -865,6 +958,91 @@ def firstAuthor(string):
     string = unidecode.unidecode(string)
     return string
 
+def makeArticleRow(articleData, artDbs):
+    " return the row of hgFixed.article.tab for an article and the set of dbs it is mapped to "
+    artId = int(articleData.articleId)
+    dbString = ",".join(sorted(artDbs))
+    refString = makeRefString(articleData)
+    pmid = str(articleData.pmid)
+    if pmid=="" or pmid=="NONE":
+        pmid = 0
+    
+    eIssn = articleData.eIssn
+    if eIssn=="":
+        eIssn = articleData.printIssn
+
+    prepSql = pubStore.prepSqlString
+    articleRow =  (str(artId), \
+                   prepSql(articleData.externalId, maxLen=2000), \
+                   str(pmid), \
+                   prepSql(articleData.doi), \
+                   str(articleData.source), \
+                   str(articleData.publisher), \
+                   prepSql(refString, maxLen=2000), \
+                   prepSql(articleData.journal), \
+                   prepSql(eIssn), \
+                   prepSql(articleData.vol), \
+                   prepSql(articleData.issue), \
+                   prepSql(articleData.page), \
+                   sanitizeYear(articleData.year), \
+                   prepSql(articleData.title, maxLen=6000), \
+                   prepSql(articleData.authors, maxLen=6000), \
+                   firstAuthor(articleData.authors), \
+                   prepSql(articleData.abstract, maxLen=32000), \
+                   prepSql(articleData.fulltextUrl, maxLen=1000), \
+                   dbString)
+    return articleRow
+
+def writeProcessedArticle(extIdFh, articleId, externalId, doi):
+    " write one line to processedArticles.tab "
+    extIdFh.write(articleId+"\t")
+    extId = pubStore.prepSqlString(externalId, maxLen=2000).encode("utf8")
+    extIdFh.write(extId+"\t") # bing-urls contain unicode
+    extIdFh.write(pubStore.prepSqlString(doi).encode("utf8")+"\n")
+
+def isUpdateChunk(chunkId, updateIds):
+    " True if chunkId, like 0_00001, belongs to one of the updateIds. All chunks if updateIds is empty. "
+    if updateIds is None or len(updateIds)==0:
+        return True
+    for updateId in updateIds:
+        if chunkId.startswith(str(updateId)+"_"):
+            return True
+    return False
+
+def lookupMappedArticles(articleDbs, textDir):
+    """ get the article data of all articleIds in articleDbs from the articles.db of textDir.
+    Return a dict articleId -> ArticleRec or None if there is no articles.db or some
+    articles are not in it, e.g. because the index was not updated.
+    """
+    dbPath = pubStore.getArtDbPath(textDir)
+    if not isfile(dbPath):
+        logging.info("No article index %s" % dbPath)
+        return None
+    con, cur = pubStore.openArticleDb(textDir)
+    idStrs = ["%0*d" % (pubConf.ARTICLEDIGITS, artId) for artId in articleDbs]
+    logging.info("Looking up %d mapped articles in %s" % (len(idStrs), dbPath))
+    artDicts = pubStore.lookupArticlesBy(con, cur, "articleId", idStrs)
+    if len(artDicts)!=len(idStrs):
+        logging.warn("%d mapped articles are not in %s" % (len(idStrs)-len(artDicts), dbPath))
+        return None
+
+    articles = {}
+    for idStr, artDict in artDicts.iteritems():
+        articles[int(idStr)] = pubStore.articleDbRowToRec(artDict)
+    return articles
+
+def writeProcessedArticlesDb(textDir, updateIds, extIdFh):
+    " write processedArticles.tab from the articles.db of textDir, return the number of articles "
+    con, cur = pubStore.openArticleDb(textDir)
+    sql = "SELECT articleId, externalId, doi, chunkId FROM articles"
+    count = 0
+    for articleId, externalId, doi, chunkId in pubStore.executeRetry(cur, sql):
+        if not isUpdateChunk(chunkId or "", updateIds):
+            continue
+        writeProcessedArticle(extIdFh, articleId, externalId or "", doi or "")
+        count += 1
+    return count
+
 def writeArticleTables(articleDbs, textDir, tableDir, updateIds):
     """ 
         create the articles table based on articleDbs, display Ids and 
@@ -873,68 +1051,45 @@ def writeArticleTables(articleDbs, textDir, tableDir, updateIds):
         also create processedArticles.tab for JSON elsevier script to distinguish between
         processed and no-sequence articles.
 
+        The mapped articles are looked up in bulk in the articles.db of textDir and
+        processedArticles.tab only needs three columns of it, so this does not read
+        the text files. Without an up-to-date articles.db, all articles of the text
+        files are read.
     """
 
     logging.info("- Formatting article information to genome browser format")
     logging.debug("- dbs %s, textDir %s, tableDir %s, updateIds %s" % (articleDbs, textDir, tableDir, updateIds))
     # prepare output files
-    artFiles = {}
-
     articleFname    = join(tableDir, "hgFixed.article.tab")
     articleFh       = codecs.open(articleFname, "w", encoding="utf8")
     extIdFh         = open(join(tableDir, "publications.processedArticles.tab"), "w")
 
     logging.info("Writing article titles, abstracts, authors")
-    articleDict = {}
     articleCount = 0
-    for articleData in pubStore.iterArticleDataDir(textDir, updateIds=updateIds):
-        artId = int(articleData.articleId)
-        doi = pubStore.prepSqlString(articleData.doi)
-
-        # write to processedArticles.tab
-        extIdFh.write(articleData.articleId+"\t")
-        extId = pubStore.prepSqlString(articleData.externalId, maxLen=2000).encode("utf8")
-        extIdFh.write(extId+"\t") # bing-urls contain unicode
-        extIdFh.write(doi+"\n")
-
-        artDbs = articleDbs.get(artId, None)
-        if not artDbs:
-            continue
-        logging.debug("article %d has dbs %s" % (artId, str(artDbs)))
-
-        dbString = ",".join(artDbs)
-        refString = makeRefString(articleData)
-        pmid = str(articleData.pmid)
-        if pmid=="" or pmid=="NONE":
-            pmid = 0
-        
-        eIssn = articleData.eIssn
-        if eIssn=="":
-            eIssn = articleData.printIssn
-
-        prepSql = pubStore.prepSqlString
-        articleRow =  (str(artId), \
-                       prepSql(articleData.externalId, maxLen=2000), \
-                       str(pmid), \
-                       prepSql(articleData.doi), \
-                       str(articleData.source), \
-                       str(articleData.publisher), \
-                       prepSql(refString, maxLen=2000), \
-                       prepSql(articleData.journal), \
-                       prepSql(eIssn), \
-                       prepSql(articleData.vol), \
-                       prepSql(articleData.issue), \
-                       prepSql(articleData.page), \
-                       sanitizeYear(articleData.year), \
-                       prepSql(articleData.title, maxLen=6000), \
-                       prepSql(articleData.authors, maxLen=6000), \
-                       firstAuthor(articleData.authors), \
-                       prepSql(articleData.abstract, maxLen=32000), \
-                       prepSql(articleData.fulltextUrl, maxLen=1000), \
-                       dbString)
-        articleFh.write(u'\t'.join(articleRow))
-        articleFh.write(u'\n')
-        articleCount+=1
+    mappedArticles = lookupMappedArticles(articleDbs, textDir)
+    if mappedArticles is not None:
+        processedCount = writeProcessedArticlesDb(textDir, updateIds, extIdFh)
+        logging.info("Wrote %d processed articles from article index" % processedCount)
+        for artId in sorted(mappedArticles):
+            articleFh.write(u'\t'.join(makeArticleRow(mappedArticles[artId], articleDbs[artId])))
+            articleFh.write(u'\n')
+            articleCount+=1
+    else:
+        logging.info("Reading all articles from %s" % textDir)
+        for articleData in pubStore.iterArticleDataDir(textDir, updateIds=updateIds):
+            artId = int(articleData.articleId)
+            writeProcessedArticle(extIdFh, articleData.articleId, articleData.externalId, \
+                articleData.doi)
+
+            artDbs = articleDbs.get(artId, None)
+            if not artDbs:
+                continue
+            logging.debug("article %d has dbs %s" % (artId, str(artDbs)))
+            articleFh.write(u'\t'.join(makeArticleRow(articleData, artDbs)))
+            articleFh.write(u'\n')
+            articleCount+=1
+    articleFh.close()
+    extIdFh.close()
     logging.info("Written info on %d articles to %s" % (articleCount, tableDir))
 
 def parseBeds(bedDirs):
@@ -1053,14 +1208,12 @@ def readReformatBed(bedFname, artDescs, artClasses, impacts, dataset, annotLoci)
         articleIdInt = int(articleId)
 
         art = artDescs[articleIdInt]
-        issn = art.printIssn
+        issn = art[ARTDESCISSNIDX]
         impact = impacts.get(issn, 0)
 
         # translate 
-        artDescFields = (art.publisher, art.pmid, art.doi, \
-            art.printIssn, art.journal, art.title, art.firstAuthor, art.year)
-        artDescFields = [pubStore.prepSqlString(f, maxLen=255) for f in artDescFields]
-        fields.extend(artDescFields) # don't add the articleId itself
+        artDescVals = [pubStore.prepSqlString(f, maxLen=255) for f in art]
+        fields.extend(artDescVals) # don't add the articleId itself
         fields.append(str(impact))
 
         # add the class field
@@ -1869,13 +2022,17 @@ def parseFileDescs(fname):
         res[int(row.fileId)] = (row.desc, row.url)
     return res
         
+# the fields of articles.tab that readReformatBed adds to the beds, in this order
+artDescFields = ["publisher", "pmid", "doi", "printIssn", "journal", "title", "firstAuthor", "year"]
+ARTDESCISSNIDX = artDescFields.index("printIssn")
+
 def parseArtDescs(fname):
-    " read article descriptions into memory (can be very big, several gbs) "
+    """ read article descriptions into memory (can be very big, several gbs)
+    return dict articleId -> tuple of artDescFields """
     logging.info("Parsing %s" % fname)
     res = {}
     for row in maxCommon.iterTsvRows(fname):
-        #res[int(r.articleId)] = (r.publisher, r.pmid, r.doi, r.printIssn, r.journal, r.title, r.firstAuthor, r.year)
-        res[int(row.articleId)] = row
+        res[int(row.articleId)] = tuple([getattr(row, f) for f in artDescFields])
     return res
 
 def parseImpacts(fname):
@@ -1906,6 +2063,35 @@ def parseArtClasses(textDir, updateIds):
     logging.info("Found article classes for %d articles" % len(res))
     return res
 
+# increase when the format of the data in the table caches changes
+TABLECACHEVERSION = 1
+
+def loadCachedTable(cacheDir, srcFname, parseFunc, *args):
+    """ return parseFunc(*args), the parsed data of srcFname. The result is kept in a marshal
+    file in cacheDir and read from there as long as srcFname has the same size and mtime.
+    The data must be made of types that marshal supports: dicts, lists, tuples and strings.
+    """
+    cacheFname = join(cacheDir, basename(srcFname).split(".")[0]+".marshal")
+    stat = os.stat(srcFname)
+    srcKey = (TABLECACHEVERSION, abspath(srcFname), stat.st_size, int(stat.st_mtime))
+
+    if isfile(cacheFname):
+        cacheKey, data = marshal.load(open(cacheFname, "rb"))
+        if tuple(cacheKey)==srcKey:
+            logging.info("Read parsed %s from %s" % (srcFname, cacheFname))
+            return data
+        logging.info("%s changed, not using %s" % (srcFname, cacheFname))
+
+    data = parseFunc(*args)
+    if not isdir(cacheDir):
+        os.makedirs(cacheDir)
+    tmpFname = cacheFname+".tmp"
+    with open(tmpFname, "wb") as fh:
+        marshal.dump((srcKey, data), fh)
+    os.rename(tmpFname, cacheFname)
+    logging.info("Wrote parsed %s to %s" % (srcFname, cacheFname))
+    return data
+
 def runTablesStep(d, options):
     " generate table files for mysql "
     # this step creates tables in batchDir/tables
@@ -1916,9 +2102,11 @@ def runTablesStep(d, options):
     # reformat bed and sequence files
     if not options.skipConvert:
         # load all extended bed+ fields data into memory
-        artDescs   = parseArtDescs(d.artDescFname)
-        artClasses = parseArtClasses(d.textDir, d.updateIds)
-        impacts    = parseImpacts(pubConf.impactFname)
+        artDescs   = loadCachedTable(d.tableCacheDir, d.artDescFname, parseArtDescs, d.artDescFname)
+        artClasses = loadCachedTable(d.tableCacheDir, pubConf.classFname, parseArtClasses, \
+            d.textDir, d.updateIds)
+        impacts    = loadCachedTable(d.tableCacheDir, pubConf.impactFname, parseImpacts, \
+            pubConf.impactFname)
         annotLoci  = findLociBedDir(d.bedDir)
 
         rewriteFilterBedFiles(d.bedDir, d.tableDir, pubConf.speciesNames, \
@@ -181,6 +181,8 @@ class PipelineConfig:
 
         # tables for genome browser
         self.tableDir     = join(batchDir, "tables")
+        # parsed article descriptions, classes and impacts for the tables step
+        self.tableCacheDir = join(batchDir, "tableCache")
 
         # non-blat files
         self.fileDescFname      = join(batchDir, "files.tab") # file descriptions for browser tables
@@ -5,9 +5,9 @@
 #>>> logger = logging.getLogger().setLevel(5)
 #>>> logger = logging.getLogger().setLevel(logging.INFO)
 
-import re, logging, array, operator, string, itertools
+import re, logging, array, operator, string, itertools, gzip, os, shutil, tempfile
 from collections import OrderedDict, Counter
-from os.path import join
+from os.path import join, dirname, basename, isfile
 import pubConf, fastFind
 import unidecode
 
@@ -495,15 +495,19 @@ def sectionSplitter(text, fileType, minLen=4000, refMinLen=500, minDist=MINSECLE
 # --- frequently used English words -----
 
 commonWords = None
+commonWordsList = None
 
 def initCommonWords(listName="top1000"):
-    """ read BNC wordlists into memory
+    """ read BNC wordlists into memory, if not already loaded
     listName is one of top1000, verbs
     >>> initCommonWords()
     >>> isCommonWord("doing")
     True
     """
-    global commonWords
+    global commonWords, commonWordsList
+    if commonWordsList==listName:
+        return
+    commonWordsList = listName
     commonWords = set()
     fname = join(pubConf.staticDataDir, "bnc", listName+".txt")
     for line in open(fname):
@@ -593,8 +597,92 @@ def rangeToPosSet(rows):
 # translation table to remove some spec characters for desc string
 descTbl = string.maketrans('-|:', '   ')
 
+def segmentText(text, fileType="", minSectDist=MINSECLEN):
+    """ split text into sections and sentences. Returns a list of section names and
+    a list of (sectionIdx, start, end, wordCount, hasVerb) for all sentences, the
+    input of sectionSentences(). hasVerb is 1 if the sentence contains a verb.
+    >>> segmentText("Short text. We did something great and were right.")
+    (['probablyAbstract'], [(0, 0, 11, 2, 0), (0, 12, 50, 7, 1)])
+    """
+    initCommonWords("verbs")
+    secNames = []
+    sents = []
+    for secStart, secEnd, section in sectionSplitter(text, fileType, minDist=minSectDist):
+        secIdx = len(secNames)
+        secNames.append(section)
+        # skip the section title (e.g. "Results") line
+        secStart = skipForwMax(text, secStart, 60)
+
+        secText = text[secStart:secEnd]
+        for sentStart, sentEnd, sentence in sentSplitter(secText):
+            sentWords = wordSet(sentence)
+            hasVerb = int(not sentWords.isdisjoint(commonWords))
+            sents.append((secIdx, secStart+sentStart, secStart+sentEnd, len(sentWords), hasVerb))
+    return secNames, sents
+
+# sidecar files of text chunks with the output of segmentText() for every file
+SENTLAYEREXT = "sents"
+# the sentence layer of the current chunk: fileId -> (textLen, isSupp, section names, sentences)
+sentLayer = {}
+
+def writeSentLayer(chunkFname):
+    """ write the <chunk>.sents.gz file with the sections and sentences of all files
+    of the chunk of chunkFname, e.g. xxx.articles.gz. One line per file with
+    fileId, text length, 1 if fileType is supp, the section names and the
+    sentences as five integers each, see segmentText().
+    """
+    import pubStore # not needed to read sentence layers
+    chunkId = basename(chunkFname).split(".")[0]
+    outFname = join(dirname(chunkFname), "%s.%s.gz" % (chunkId, SENTLAYEREXT))
+    tmpFname = tempfile.mktemp(prefix="pubNlp.sents.", dir=pubConf.getTempDir())
+    ofh = gzip.open(tmpFname, "w")
+    fileCount = 0
+    reader = pubStore.openPubReader(chunkFname)
+    for articleData, fileDataList in reader.iterArticlesFileList(None):
+        for fileData in fileDataList:
+            # the same text as the annotators get, see pubAlg.iterAnnotRows
+            text = fileData.content.replace("\a", "\n")
+            secNames, sents = segmentText(text, fileData.fileType)
+            ints = [str(x) for sent in sents for x in sent]
+            row = [str(fileData.fileId), str(len(text)), str(int(fileData.fileType=="supp")), \
+                ",".join(secNames), ",".join(ints)]
+            ofh.write("\t".join(row))
+            ofh.write("\n")
+            fileCount += 1
+    reader.close()
+    ofh.close()
+    shutil.move(tmpFname, outFname)
+    logging.info("Wrote sentences of %d files to %s" % (fileCount, outFname))
+
+def openSentLayer(fname):
+    """ load a <chunk>.sents.gz file. sectionSentences() will then use it for
+    the files of this chunk. """
+    global sentLayer
+    sentLayer = {}
+    for line in gzip.open(fname):
+        fileId, textLen, isSupp, secNames, ints = line.rstrip("\n").split("\t")
+        sentLayer[fileId] = (int(textLen), isSupp=="1", secNames, ints)
+    logging.debug("Loaded sentences of %d files from %s" % (len(sentLayer), fname))
+
+def getLayerSents(fileId, text, fileType, minSectDist):
+    """ return the section names and sentences of a file from the sentence layer or None
+    if they are not in it or cannot be used for these arguments """
+    if fileId is None or minSectDist!=MINSECLEN:
+        return None
+    layerData = sentLayer.get(str(fileId))
+    if layerData is None:
+        return None
+    textLen, isSupp, secNames, ints = layerData
+    if textLen!=len(text) or isSupp!=(fileType=="supp"):
+        logging.debug("sentence layer data of file %s does not match its text" % str(fileId))
+        return None
+    ints = [int(x) for x in ints.split(",")] if ints!="" else []
+    sents = [tuple(ints[i:i+5]) for i in range(0, len(ints), 5)]
+    return secNames.split(","), sents
+
 def sectionSentences(text, fileType="", minSectDist=MINSECLEN, minChars=30, \
-        minWords=5, maxLines=10, minSpaces=4, mustHaveVerb=True, skipSections=["refs","ack"]):
+        minWords=5, maxLines=10, minSpaces=4, mustHaveVerb=True, skipSections=["refs","ack"], \
+        fileId=None):
     """
     Try split the text into sections and these into clean
     grammatically parsable English sentences. Skip the reference
@@ -604,57 +692,57 @@ def sectionSentences(text, fileType="", minSectDist=MINSECLEN, minChars=30, \
     TOCs, figures, tables etc).
     Yields tuples (section, start, end, sentence). Sentence has newline replaced
     with space.
+    If fileId is in the sentence layer loaded with openSentLayer(), the sections
+    and sentences are taken from there instead of splitting the text again.
     >>> text = "           \\nIntroduction\\n                                                         \\nMethods\\n no. yes. palim palim. We did something great and were right.\\nResults\\nOur results are very solid\\nand robust and reliable."
     >>> list(sectionSentences(text, minSectDist=1))
     [['methods', 114, 152, 'We did something great and were right.'], ['results', 160, 212, ' Our results are very solid and strong and reliable.']]
     """
-    if mustHaveVerb:
-        initCommonWords("verbs")
+    layerSents = getLayerSents(fileId, text, fileType, minSectDist)
+    if layerSents is None:
+        secNames, sents = segmentText(text, fileType, minSectDist)
+    else:
+        secNames, sents = layerSents
 
-    for secStart, secEnd, section in sectionSplitter(text, fileType, minDist=minSectDist):
+    for secIdx, start, end, wordCount, hasVerb in sents:
+        section = secNames[secIdx]
         if section in skipSections:
-            logging.info("Skipping section %s %d-%d" % (section, secStart, secEnd))
+            continue
+        sentence = text[start:end]
+        if end-start < minChars:
+            logging.debug("Sentence too short: %s" % sentence)
             continue
 
-        # skip the section title (e.g. "Results") line
-        secStart = skipForwMax(text, secStart, 60)
-
-        secText = text[secStart:secEnd]
-        for sentStart, sentEnd, sentence in sentSplitter(secText):
-            if sentEnd-sentStart < minChars:
-                logging.debug("Sentence too short: %s" % sentence)
-                continue
-
-            sentWords = wordSet(sentence)
-            if len(sentWords) < minWords:
-                logging.debug("Sentence skipped, too few words: %s" % sentence)
-                continue
+        if wordCount < minWords:
+            logging.debug("Sentence skipped, too few words: %s" % sentence)
+            continue
 
-            if mustHaveVerb is True:
-                commSentWords = sentWords.intersection(commonWords)
-                if len(commSentWords)==0:
-                    logging.debug("Sentence skipped, no verb: %s" % sentence)
-                    continue
+        if mustHaveVerb is True and not hasVerb:
+            logging.debug("Sentence skipped, no verb: %s" % sentence)
+            continue
 
-            nlCount = sentence.count("\n")
-            if nlCount > maxLines:
-                logging.debug("Sentence spread over too many lines: %s" % sentence)
-                continue
+        nlCount = sentence.count("\n")
+        if nlCount > maxLines:
+            logging.debug("Sentence spread over too many lines: %s" % sentence)
+            continue
 
-            spcCount = sentence.count(" ")
-            if spcCount < minSpaces:
-                logging.debug("Sentence has too few spaces: %s" % sentence)
-                continue
+        spcCount = sentence.count(" ")
+        if spcCount < minSpaces:
+            logging.debug("Sentence has too few spaces: %s" % sentence)
+            continue
 
-            if "********************" in sentence:
-                # UC library login part on Highwire pages
-                logging.debug("Too many stars")
-                continue
+        if "********************" in sentence:
+            # UC library login part on Highwire pages
+            logging.debug("Too many stars")
+            continue
 
-            sentence = sentence.replace("\n", " ")
-            # replace all special chars with long forms (e.g. alpha, beta etc)
+        sentence = sentence.replace("\n", " ")
+        # replace all special chars with long forms (e.g. alpha, beta etc)
+        try:
+            sentence.encode("ascii")
+        except UnicodeError:
             sentence = unidecode.unidecode(sentence)
-            yield [section, secStart+sentStart, secStart+sentEnd, sentence]
+        yield [section, start, end, sentence]
 
 # disease dictionary
 disLex = None
@@ -667,7 +755,7 @@ def findDiseases(text):
     global disLex
     if disLex==None:
         disPath = join(pubConf.staticDataDir, "diseases", "diseases.marshal.gz")
-        disLex = fastFind.loadLex(disPath)
+        disLex = fastFind.loadLex(disPath, cacheDir=pubConf.getLexCacheDir())
 
     for (start, end, name) in fastFind.fastFind(text, disLex, toLower=True):
         yield start, end, name
@@ -685,7 +773,7 @@ def findDrugs(text):
     global drugLex
     if drugLex==None:
         drugPath = pubConf.getStaticFile("drugs", "drugbank.marshal.gz")
-        drugLex = fastFind.loadLex(drugPath)
+        drugLex = fastFind.loadLex(drugPath, cacheDir=pubConf.getLexCacheDir())
 
     for (start, end, name) in fastFind.fastFind(text, drugLex, toLower=True):
         if name.lower() in drugBlacklist:
@@ -704,7 +792,7 @@ def findCells(text):
     global cellLex
     dictFname = pubConf.getStaticFile("cellTypes", "cellTypes.marshal")
     if cellLex is None:
-        cellLex = fastFind.loadLex(dictFname)
+        cellLex = fastFind.loadLex(dictFname, cacheDir=pubConf.getLexCacheDir())
 
     for (start, end, name) in fastFind.fastFind(text.lower(), cellLex):
         if name.lower() in cellBlackList:
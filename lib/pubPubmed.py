@@ -9,6 +9,7 @@ import socket
 
 from xml.etree.ElementTree import ParseError
 from xml.etree.cElementTree import ParseError as ParseError2
+import xml.etree.cElementTree as etree
 from collections import OrderedDict
 
 class PubmedError(Exception):
@@ -218,12 +219,45 @@ def parsePubmedMedlineIter(xml):
         raise
 
     for artEl in topEl.getXmlAll(recordTag):
-        medlineCitEl = artEl.getXmlFirst("MedlineCitation")
-        dataDict = parseMedline(medlineCitEl)
+        yield parsePubmedArticle(artEl)
 
-        pubmedCitEl = artEl.getXmlFirst("PubmedData")
-        dataDict = parsePubmedFields(pubmedCitEl, dataDict)
-        yield dataDict
+def parsePubmedArticle(artEl):
+    " parse a <PubmedArticle> XmlParser object to a dict "
+    medlineCitEl = artEl.getXmlFirst("MedlineCitation")
+    dataDict = parseMedline(medlineCitEl)
+
+    pubmedCitEl = artEl.getXmlFirst("PubmedData")
+    dataDict = parsePubmedFields(pubmedCitEl, dataDict)
+    return dataDict
+
+def parsePubmedMedlineStream(fileObj):
+    """
+    Parse pubmed xml format from a file object and yield the same dicts as parsePubmedMedlineIter.
+    The file is parsed incrementally and every <PubmedArticle> is freed after it was parsed,
+    so memory use does not depend on the size of the file.
+
+    >>> import io
+    >>> xml = "<PubmedArticleSet><PubmedArticle>"+PubmedTestDoc()+"<PubmedData/></PubmedArticle></PubmedArticleSet>"
+    >>> streamDicts = list(parsePubmedMedlineStream(io.BytesIO(xml)))
+    >>> iterDicts = list(parsePubmedMedlineIter(xml))
+    >>> for d in streamDicts+iterDicts: del d["time"]
+    >>> streamDicts==iterDicts
+    True
+    >>> len(streamDicts), streamDicts[0]["pmid"]==u"20430833"
+    (1, True)
+    """
+    recordTag = "PubmedArticle"
+    rootEl = None
+    for event, el in etree.iterparse(fileObj, events=("start", "end")):
+        if rootEl is None:
+            rootEl = el
+        if event=="end" and el.tag==recordTag:
+            yield parsePubmedArticle(maxXml.XmlParser(root=el))
+            # drop the article and all earlier ones from the tree
+            rootEl.clear()
+
+    if rootEl is None:
+        raise PubmedError("Got empty XML file", "pubmedEmptyXml")
 
 def ncbiEFetchGenerator(ids, dbName="pubmed", tool="pubtools", email=pubConf.email, debug=False):
     """
@@ -14,13 +14,13 @@ from __future__ import division
 from builtins import range
 from past.utils import old_div
 import os, logging, sys, time, codecs, shutil, csv, glob, operator, types
-import zipfile, gzip, re, random, tempfile, copy, string
+import zipfile, gzip, re, random, tempfile, copy, string, multiprocessing, math
 try:
     import sqlite3
 except ImportError:
     logging.warn("No sqlite3 loaded")
 
-import pubGeneric, pubConf, maxCommon, unicodeConvert, maxTables, pubPubmed
+import pubGeneric, pubConf, maxCommon, unicodeConvert, maxTables, pubPubmed, pubColStore
 
 try:
     import Bio.bgzf
@@ -30,7 +30,7 @@ except ImportError:
     bgzfLoaded = False
 
 from os.path import *
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 
 # need to increase maximum size of fields for csv module
 csv.field_size_limit(50000000)
@@ -267,6 +267,22 @@ def articleDictToTuple(artDict):
     artTuple = ArticleRec(**artDict)
     return artTuple
 
+def articleDbRowToRec(artDict):
+    """ convert a dict from the articles.db, e.g. from lookupArticlesBy, to an article tuple
+    with strings, like the rows of the .articles files
+    >>> articleDbRowToRec({"articleId":u"1000000001", "pmid":123, "doi":None, "chunkId":u"0_00000"}).pmid
+    u'123'
+    """
+    values = {}
+    for key in articleFields:
+        val = artDict.get(key)
+        if val is None:
+            val = u""
+        elif not isinstance(val, basestring):
+            val = unicode(val)
+        values[key] = val
+    return ArticleRec(**values)
+
 class PubWriterFile(object):
     """
     a class that stores article and file data into tab-sep files
@@ -284,11 +300,17 @@ class PubWriterFile(object):
     We only copy files over if any files data was actually written
     We only copy articles over if any articles data was actually written
 
+    chunkFormat can be "tsv", "col" or "both", default is pubConf.chunkFormat.
+    With "col", the files <chunkId>.files.col and <chunkId>.articles.col are
+    written instead of the tab-sep files, with "both" they are written in addition.
     """
-    def __init__(self, fileDataFilename):
+    def __init__(self, fileDataFilename, chunkFormat=None):
         self.articlesWritten = 0
         self.filesWritten = 0
         self.tempDir = pubConf.getTempDir()
+        if chunkFormat is None:
+            chunkFormat = pubConf.chunkFormat
+        assert(chunkFormat in ["tsv", "col", "both"])
 
         # convoluted way to find output filenames
         # needed because of parasol
@@ -316,6 +338,7 @@ class PubWriterFile(object):
 
         self.finalArticleName = join(outDir, articleBaseName)
         self.finalFileDataName    = join(outDir, self.fileBaseName)
+        self.finalFileIdxName = join(outDir, chunkId+".files.idx")
         self.finalRefFname = join(self.refDir, refBaseName)
 
         # setup file and article table handles
@@ -323,16 +346,32 @@ class PubWriterFile(object):
         # chunks. Temp files are moved over to final on self.close()
         #self.tmpFileFname = os.path.join(self.tempDir, self.fileBaseName)
         self.tmpFileFname = tempfile.mktemp(prefix="pubStore.files.")
-        self.fileFh = openFunc(self.tmpFileFname, "w")
-        self.fileFh.write("#"+"\t".join(fileDataFields)+"\n")
-
         #self.tmpArticleFname = os.path.join(self.tempDir, articleBaseName)
         self.tmpArticleFname = tempfile.mktemp(prefix="pubStore.article.")
-        self.articleFh = openFunc(self.tmpArticleFname, "w")
-        self.articleFh.write("#"+"\t".join(articleFields)+"\n")
-
-        maxCommon.delOnExit(self.tmpFileFname)
-        maxCommon.delOnExit(self.tmpArticleFname)
+        self.fileFh = None
+        self.articleFh = None
+        # rows of the .files.idx index: [articleId, offset, length, fileCount]
+        self.fileIdxRows = []
+        if chunkFormat in ["tsv", "both"]:
+            self.fileFh = openFunc(self.tmpFileFname, "w")
+            self.fileFh.write("#"+"\t".join(fileDataFields)+"\n")
+            self.articleFh = openFunc(self.tmpArticleFname, "w")
+            self.articleFh.write("#"+"\t".join(articleFields)+"\n")
+            maxCommon.delOnExit(self.tmpFileFname)
+            maxCommon.delOnExit(self.tmpArticleFname)
+
+        # same for the column files
+        self.fileCols = None
+        self.articleCols = None
+        if chunkFormat in ["col", "both"]:
+            self.finalFileColName = join(outDir, chunkId+".files.col")
+            self.finalArticleColName = join(outDir, chunkId+".articles.col")
+            self.tmpFileColFname = tempfile.mktemp(prefix="pubStore.files.col.")
+            self.tmpArticleColFname = tempfile.mktemp(prefix="pubStore.article.col.")
+            self.fileCols = pubColStore.ColWriter(self.tmpFileColFname, fileDataFields, "fileId")
+            self.articleCols = pubColStore.ColWriter(self.tmpArticleColFname, articleFields, "articleId")
+            maxCommon.delOnExit(self.tmpFileColFname)
+            maxCommon.delOnExit(self.tmpArticleColFname)
 
         self.outFilename = os.path.join(outDir, fileDataBasename)
         logging.debug("pubStore writer open. tmp files %s and %s. Dest files %s and %s" % \
@@ -409,7 +448,20 @@ class PubWriterFile(object):
 
         #logging.log(5, "Writing line to file table, dict is %s" % fileDict)
         self.filesWritten += 1
-        self.fileFh.write(line+"\n")
+        if self.fileFh is not None:
+            self._addToFileIndex(fileDict["articleId"], len(line)+1)
+            self.fileFh.write(line+"\n")
+        if self.fileCols is not None:
+            self.fileCols.writeRow(fileTuple)
+
+    def _addToFileIndex(self, articleId, lineLen):
+        " update the .files.idx rows before a line of lineLen bytes is written to the files table "
+        if len(self.fileIdxRows)==0 or self.fileIdxRows[-1][0]!=articleId:
+            # offset is a virtual offset for bgzf files
+            self.fileIdxRows.append([articleId, self.fileFh.tell(), 0, 0])
+        idxRow = self.fileIdxRows[-1]
+        idxRow[2] += lineLen
+        idxRow[3] += 1
 
     def _checkFields(self, inDict, fieldList):
         """ makes sure that inDict contains one key for each string in fieldList.
@@ -451,7 +503,10 @@ class PubWriterFile(object):
         articleTuple = listToUtf8Escape(articleTuple)
 
         line = "\t".join(articleTuple)
-        self.articleFh.write(line+"\n")
+        if self.articleFh is not None:
+            self.articleFh.write(line+"\n")
+        if self.articleCols is not None:
+            self.articleCols.writeRow(articleTuple)
         self.articlesWritten += 1
         logging.log(5, "%d articles written" % self.articlesWritten)
 
@@ -476,21 +531,36 @@ class PubWriterFile(object):
         """
         logging.debug("Moving local tempfiles over to files on server %s" % self.finalArticleName)
 
-        self.fileFh.close()
-        self.articleFh.close()
-
         if self.articlesWritten==0:
             logging.warn("No articles received, not writing anything, but creating a 0 sized file for parasol")
+        if self.articlesWritten==0 or self.articleFh is None:
             # just create a 0-size file for parasol
             open(self.finalArticleName, "w")
 
-        if self.filesWritten > 0 or keepEmpty:
-            logging.debug("moving articles table to %s" % self.finalArticleName)
-            shutil.move(self.tmpFileFname, self.finalFileDataName)
+        if self.articleFh is not None:
+            self.fileFh.close()
+            self.articleFh.close()
+
+            if self.filesWritten > 0 or keepEmpty:
+                logging.debug("moving articles table to %s" % self.finalArticleName)
+                shutil.move(self.tmpFileFname, self.finalFileDataName)
+                writeFileIndex(self.finalFileIdxName, self.fileIdxRows)
+
+            if self.articlesWritten > 0 or keepEmpty:
+                logging.debug("moving files table to %s" % self.finalFileDataName)
+                shutil.move(self.tmpArticleFname, self.finalArticleName)
 
-        if self.articlesWritten > 0 or keepEmpty:
-            logging.debug("moving files table to %s" % self.finalFileDataName)
-            shutil.move(self.tmpArticleFname, self.finalArticleName)
+        if self.articleCols is not None:
+            self.fileCols.close()
+            self.articleCols.close()
+
+            if self.filesWritten > 0 or keepEmpty:
+                logging.debug("moving files column file to %s" % self.finalFileColName)
+                shutil.move(self.tmpFileColFname, self.finalFileColName)
+
+            if self.articlesWritten > 0 or keepEmpty:
+                logging.debug("moving articles column file to %s" % self.finalArticleColName)
+                shutil.move(self.tmpArticleColFname, self.finalArticleColName)
 
         if self.refFh!=None:
             self.refFh.close()
@@ -508,6 +578,87 @@ def createPseudoFile(articleData):
     fileTuple = FileDataRec(**fileData)
     return fileTuple
 
+def keepOnlyMain(files):
+    " remove all suppl files "
+    mainFiles = {}
+    newFiles = []
+    for fileData in files:
+        if fileData.fileType=="main" or fileData.fileType=="":
+            newFiles.append(fileData)
+    logging.log(5, "Main-text filter: got %d files, returned %d files" % (len(files), len(newFiles)))
+    return newFiles
+
+def keepBestMain(files, preferType):
+    """ if there are several main text formats, keep only one of them.
+    preferType can be "pdf" or "xml" (which includes html files)
+    Keep all other files
+    """
+    mainFiles = {}
+    newFiles = []
+    for fileData in files:
+        if fileData.fileType=="main" or fileData.fileType=="":
+            # we should never have two main files with same type
+            assert(fileData.mimeType not in mainFiles)
+            mainFiles[fileData.mimeType] = fileData
+        else:
+            newFiles.append(fileData)
+
+    # this should happen only very very rarely, if main file was corrupted
+    if len(mainFiles)==0:
+        logging.error("No main file for article?")
+        logging.error("%s" % files)
+        return newFiles
+
+    if len(mainFiles)==1:
+        newFiles.insert(0, list(mainFiles.values())[0])
+        return newFiles
+
+    # remove the pdf if there are better files
+    if preferType=="xml":
+        if "application/pdf" in mainFiles and \
+                ("text/xml" in mainFiles or "text/html" in mainFiles):
+            logging.debug("Removing pdf")
+            del mainFiles["application/pdf"]
+
+    elif preferType=="pdf":
+        # remove the xml if there are PDF files
+        if "application/pdf" in mainFiles:
+            if "text/xml" in mainFiles:
+                del mainFiles["text/xml"]
+                logging.debug("Removing xml")
+            if "text/html" in mainFiles:
+                del mainFiles["text/html"]
+                logging.debug("Removing html")
+    else:
+        assert(False)
+
+    # paranoia check: make sure that we still have left one file
+    if not len(mainFiles)>=1:
+        logging.error("no main file: in %s out %s " % (files, mainFiles))
+        raise Exception("no main file left")
+
+    newFiles.insert(0, list(mainFiles.values())[0])
+    return newFiles
+
+def keepPreferredFiles(fileDataList, algPrefs):
+    " apply the onlyMain, preferXml and preferPdf filters of algPrefs "
+    if algPrefs!=None:
+        if algPrefs.onlyMain:
+            fileDataList = keepOnlyMain(fileDataList)
+        if algPrefs.preferXml:
+            fileDataList = keepBestMain(fileDataList, "xml")
+        if algPrefs.preferPdf:
+            fileDataList = keepBestMain(fileDataList, "pdf")
+    return fileDataList
+
+def filterArticleFiles(articleData, fileDataList, algPrefs):
+    """ return the files of an article that an algorithm with algPrefs gets: a pseudo-file
+    from the abstract if it wants only the meta data, otherwise the files left after the
+    onlyMain, preferXml and preferPdf filters """
+    if algPrefs!=None and algPrefs.onlyMeta:
+        return [createPseudoFile(articleData)]
+    return keepPreferredFiles(fileDataList, algPrefs)
+
 class PubReaderFile(object):
     """
     read articles from tab-sep files
@@ -557,67 +708,15 @@ class PubReaderFile(object):
                return fileDataList, fileData
         return fileDataList, None
 
-    def _keepOnlyMain(self, files):
-        " remove all suppl files "
-        mainFiles = {}
-        newFiles = []
-        for fileData in files:
-            if fileData.fileType=="main" or fileData.fileType=="":
-                newFiles.append(fileData)
-        logging.log(5, "Main-text filter: got %d files, returned %d files" % (len(files), len(newFiles)))
-        return newFiles
-
-    def _keepBestMain(self, files, preferType):
-        """ if there are several main text formats, keep only one of them.
-        preferType can be "pdf" or "xml" (which includes html files)
-        Keep all other files
+    def filterFileList(self, articleData, fileDataList, algPrefs):
+        """ given an article and all its files from iterArticlesFileList(None), return
+        the files that iterArticlesFileList(algPrefs) would have returned. Used to run
+        algorithms with different algPrefs over a single pass of the reader.
         """
-        mainFiles = {}
-        newFiles = []
-        for fileData in files:
-            if fileData.fileType=="main" or fileData.fileType=="":
-                # we should never have two main files with same type
-                assert(fileData.mimeType not in mainFiles)
-                mainFiles[fileData.mimeType] = fileData
-            else:
-                newFiles.append(fileData)
-
-        # this should happen only very very rarely, if main file was corrupted
-        if len(mainFiles)==0:
-            logging.error("No main file for article?")
-            logging.error("%s" % files)
-            return newFiles
-
-        if len(mainFiles)==1:
-            newFiles.insert(0, list(mainFiles.values())[0])
-            return newFiles
-
-        # remove the pdf if there are better files
-        if preferType=="xml":
-            if "application/pdf" in mainFiles and \
-                    ("text/xml" in mainFiles or "text/html" in mainFiles):
-                logging.debug("Removing pdf")
-                del mainFiles["application/pdf"]
-
-        elif preferType=="pdf":
-            # remove the xml if there are PDF files
-            if "application/pdf" in mainFiles:
-                if "text/xml" in mainFiles:
-                    del mainFiles["text/xml"]
-                    logging.debug("Removing xml")
-                if "text/html" in mainFiles:
-                    del mainFiles["text/html"]
-                    logging.debug("Removing html")
-        else:
-            assert(False)
-
-        # paranoia check: make sure that we still have left one file
-        if not len(mainFiles)>=1:
-            logging.error("no main file: in %s out %s " % (files, mainFiles))
-            raise Exception("no main file left")
-
-        newFiles.insert(0, list(mainFiles.values())[0])
-        return newFiles
+        if self.fileRows==None:
+            # pseudo-file from the abstract
+            return fileDataList
+        return filterArticleFiles(articleData, fileDataList, algPrefs)
 
     def iterArticlesFileList(self, algPrefs):
         """ iterate over articles AND files, as far as possible
@@ -652,16 +751,7 @@ class PubReaderFile(object):
                 # if file data is there and we want it, read as much as we can
                 fileDataList, lastFileData = \
                     self._readFilesForArticle(articleData.articleId, fileDataList)
-
-                if algPrefs!=None:
-                    if algPrefs.onlyMain:
-                        fileDataList = self._keepOnlyMain(fileDataList)
-                    if algPrefs.preferXml:
-                        fileDataList = self._keepBestMain(fileDataList, "xml")
-                    if algPrefs.preferPdf:
-                        fileDataList = self._keepBestMain(fileDataList, "pdf")
-
-                yield articleData, fileDataList
+                yield articleData, keepPreferredFiles(fileDataList, algPrefs)
                 fileDataList = [lastFileData]
 
             else:
@@ -705,6 +795,84 @@ class PubReaderFile(object):
         if self.fileRows:
             self.fileRows.close()
 
+class PubReaderColFile(PubReaderFile):
+    """
+    read articles from column files (.articles.col and .files.col, see pubColStore.py)
+    Same interface as PubReaderFile. The column files are only opened and read
+    when rows are requested, so algorithms with onlyMeta never read .files.col.
+    """
+    def __init__(self, fname):
+        " fname can be any file of the chunk, e.g. xxx.articles.gz or xxx.files.col "
+        baseDir = dirname(fname)
+        base = basename(fname).split('.')[0]
+        self.articleColFn = join(baseDir, base+".articles.col")
+        self.fileColFn = join(baseDir, base+".files.col")
+        logging.debug("Reading %s and %s" % (self.articleColFn, self.fileColFn))
+        self.colReaders = []
+
+        self.articleRows = None
+        if isfile(self.articleColFn):
+            self.articleRows = self._iterRows(self.articleColFn)
+
+        self.fileRows = None
+        if isfile(self.fileColFn):
+            self.fileRows = self._iterRows(self.fileColFn)
+
+    def _iterRows(self, fname, skipFields=[]):
+        " open a column file and yield its rows as namedtuples with unicode values "
+        colReader = pubColStore.ColReader(fname, encoding="utf8")
+        self.colReaders.append(colReader)
+        Record = namedtuple('tsvRec', colReader.fieldNames)
+        fields = [f for f in colReader.fieldNames if f not in skipFields]
+        for row in colReader.iterRows(fields=fields):
+            yield Record(*row)
+
+    def iterFileRows(self, skipContent=False):
+        """ iterate over file data. With skipContent, the content field is
+        not read and is always an empty string. """
+        if skipContent and self.fileRows is not None:
+            return self._iterRows(self.fileColFn, skipFields=["content"])
+        return self.fileRows
+
+    def close(self):
+        PubReaderFile.close(self)
+        for colReader in self.colReaders:
+            colReader.close()
+
+def openPubReader(fname):
+    """ return a reader for the chunk of fname, e.g. xxx.articles.gz. Uses the
+    column files if they exist, otherwise the tab-sep files. """
+    chunkBase = join(dirname(fname), basename(fname).split('.')[0])
+    if isfile(chunkBase+".articles.col"):
+        return PubReaderColFile(fname)
+    return PubReaderFile(fname)
+
+def convertChunkToCol(fname):
+    """ write column files .articles.col and .files.col for the tab-sep chunk of
+    fname, to convert existing text directories. Files are first written to
+    temp files and moved over at the end. The .articles.col file is written last,
+    as readers only use the column files if it exists.
+    """
+    chunkBase = join(dirname(fname), basename(fname).split('.')[0])
+    for tabType, idField in [("files", "fileId"), ("articles", "articleId")]:
+        tsvName = makeChunkPath(dirname(fname), basename(chunkBase), tabType)
+        if not isfile(tsvName) or getsize(tsvName)==0:
+            logging.debug("Not converting %s, no data" % tsvName)
+            continue
+        tmpFname = tempfile.mktemp(prefix="pubStore.%s.col." % tabType)
+        maxCommon.delOnExit(tmpFname)
+        colWriter = None
+        for row in maxCommon.iterTsvRows(tsvName, encoding=None):
+            if colWriter is None:
+                colWriter = pubColStore.ColWriter(tmpFname, row._fields, idField)
+            colWriter.writeRow(row)
+        if colWriter is None:
+            continue
+        colWriter.close()
+        colName = "%s.%s.col" % (chunkBase, tabType)
+        logging.debug("Moving %s to %s" % (tmpFname, colName))
+        shutil.move(tmpFname, colName)
+
 #class PubReaderPmidDir:
 #    """ reads files from a directory of text files in format <pmid>.txt"""
 #    def __init__(self, dirName):
@@ -809,9 +977,8 @@ def iterArticleDirList(textDir, algPrefs=None):
     logging.debug("Found %d files in input dir %s" % (len(fileNames), textDir))
     pm = maxCommon.ProgressMeter(len(fileNames))
     for textCount, textFname in enumerate(fileNames):
-        reader = PubReaderFile(textFname)
         logging.debug("Reading %s, %d files left" % (textFname, len(fileNames)-textCount))
-        pr = PubReaderFile(textFname)
+        pr = openPubReader(textFname)
         artIter = pr.iterArticlesFileList(algPrefs)
         for article, fileList in artIter:
             yield article, fileList
@@ -854,7 +1021,7 @@ def iterArticleDataDir(textDir, type="articles", filterFname=None, updateIds=Non
         if filterFname!=None and not filterFname in textFname:
             logging.warn("Skipping %s, because file filter is set" % textFname)
             continue
-        reader = PubReaderFile(textFname)
+        reader = openPubReader(textFname)
         logging.debug("Reading %s, %d files left" % (textFname, len(fileNames)-fcount))
         fcount+=1
         if type=="articles":
@@ -1115,49 +1282,137 @@ def chunkIdFromFname(fname):
     " given the path of chunk, return it's chunk ID, like 0_00001 "
     return basename(fname).split(".")[0]
 
-def addToDatabase(con, cur, tsvFnames):
-    " load articles files into sqlLite db table. Adds a field 'chunkId'. "
-    tableName = "articles"
-    allFields = list(tuple(articleFields)) # make a deep copy of list
-    allFields.append("chunkId")
-
-    idxFields = ["pmid", "pmcId","printIssn", "eIssn", "year", "doi", "extId"]
-    intFields = ["pmid", "pmcId","year","offset"]
-    primKey = "articleId"
-
-    # create table
-    tableFields = articleFields
-    tableFields.append("chunkId")
-    createSql, idxSqls = maxTables.makeTableCreateStatement(tableName, articleFields, \
-        intFields=intFields, idxFields=idxFields, primKey=primKey)
+# articles.db: fields, indexes and primary key of the table "articles"
+artDbFields = articleFields+["chunkId"]
+artDbIdxFields = ["pmid", "pmcId","printIssn", "eIssn", "year", "doi", "extId"]
+artDbIntFields = ["pmid", "pmcId","year","offset"]
+# commit after this many rows
+ARTDBBATCHROWS = 200000
+# drop the indexes and re-create them if the new chunks are more than this
+# fraction of all chunks
+ARTDBREINDEXFRAC = 0.2
+
+def tuneSqliteBulkLoad(cur, isTempDb):
+    """ set PRAGMAs for fast bulk inserts. Without a journal on disk, a crash during the load
+    can corrupt the db, so this is only done if isTempDb is set, for a new db that is copied
+    to its final place after the load. Other dbs keep the default rollback journal. """
+    if isTempDb:
+        cur.execute("PRAGMA synchronous=OFF")
+        cur.execute("PRAGMA journal_mode=MEMORY")
+    cur.execute("PRAGMA cache_size=-1000000") # in kbytes = 1 GB
+    cur.execute("PRAGMA temp_store=MEMORY")
+
+def createArticleTable(con, cur):
+    " create the table articles, return the list of CREATE INDEX statements "
+    createSql, idxSqls = maxTables.makeTableCreateStatement("articles", artDbFields, \
+        intFields=artDbIntFields, idxFields=artDbIdxFields, primKey="articleId")
     logging.log(5, "creating table with %s" % createSql)
     cur.execute(createSql)
     con.commit()
+    return idxSqls
 
-    logging.info("Loading data into table")
-    tp = maxCommon.ProgressMeter(len(tsvFnames))
-    sql = "INSERT INTO %s (%s) VALUES (%s)" % (tableName, ", ".join(allFields), ", ".join(["?"]*len(allFields)))
-    rowCount = 0
+def iterChunkDbRows(tsvFnames):
+    " yield the article rows of the chunks with the chunkId field appended "
     for tsvName in tsvFnames:
         logging.debug("Loading file %s" % tsvName)
-        if os.path.getsize(tsvName)==0:
+        reader = openPubReader(tsvName)
+        if reader.articleRows is None:
             logging.debug("Skipping %s, zero size" % tsvName)
             continue
-        rows = list(maxCommon.iterTsvRows(tsvName))
-        chunkId = chunkIdFromFname(tsvName)
-
-        # add the chunkId field
-        newRows = []
-        for row in rows:
-            newRow = list(row)
-            newRow.append(chunkId)
-            newRows.append(newRow)
-        rowCount += len(newRows)
+        chunkId = (chunkIdFromFname(tsvName),)
+        for row in reader.articleRows:
+            yield tuple(row)+chunkId
+        reader.close()
+
+def insertChunkRows(con, cur, tsvFnames, showProgress=True):
+    """ stream the article rows of chunks into the table articles,
+    one transaction per ARTDBBATCHROWS rows. Return the number of rows. """
+    sql = "INSERT INTO articles (%s) VALUES (%s)" % \
+        (", ".join(artDbFields), ", ".join(["?"]*len(artDbFields)))
+    rowCount = 0
+    tp = maxCommon.ProgressMeter(len(tsvFnames), quiet=(not showProgress))
+    batch = []
+    for tsvName in tsvFnames:
+        for row in iterChunkDbRows([tsvName]):
+            batch.append(row)
+            if len(batch) >= ARTDBBATCHROWS:
+                cur.executemany(sql, batch)
+                con.commit()
+                rowCount += len(batch)
+                batch = []
+        tp.taskCompleted()
+    cur.executemany(sql, batch)
+    con.commit()
+    rowCount += len(batch)
+    return rowCount
+
+def loadStagingDb(args):
+    """ load chunks into a new sqlite db without indexes, for a worker process.
+    Return the db path and the number of rows """
+    dbPath, tsvFnames = args
+    con, cur = maxTables.openSqlite(dbPath, lockDb=True)
+    createArticleTable(con, cur)
+    rowCount = insertChunkRows(con, cur, tsvFnames, showProgress=False)
+    con.close()
+    return dbPath, rowCount
+
+def loadChunksParallel(con, cur, tsvFnames, procCount):
+    """ parse the chunks in procCount processes into staging dbs and copy
+    these into the table articles of con. Return the number of rows. """
+    stageDir = pubGeneric.makeTempDir("artDbStage")
+    groupSize = int(math.ceil(len(tsvFnames)/float(procCount)))
+    jobs = []
+    for i in range(0, len(tsvFnames), groupSize):
+        jobs.append((join(stageDir, "stage%d.db" % len(jobs)), tsvFnames[i:i+groupSize]))
+
+    logging.info("Loading %d chunks in %d processes into staging dbs in %s" % \
+        (len(tsvFnames), len(jobs), stageDir))
+    pool = multiprocessing.Pool(len(jobs))
+    rowCount = 0
+    # merge in chunk order, as soon as each staging db is ready
+    for stagePath, stageRowCount in pool.imap(loadStagingDb, jobs):
+        logging.info("Merging %s, %d rows" % (stagePath, stageRowCount))
+        cur.execute("ATTACH DATABASE ? AS stage", (stagePath,))
+        cur.execute("INSERT INTO articles (%s) SELECT %s FROM stage.articles" % \
+            (", ".join(artDbFields), ", ".join(artDbFields)))
+        con.commit()
+        cur.execute("DETACH DATABASE stage")
+        os.remove(stagePath)
+        rowCount += stageRowCount
+    pool.close()
+    pool.join()
+    shutil.rmtree(stageDir)
+    return rowCount
+
+def addToDatabase(con, cur, tsvFnames, procCount=1, isTempDb=False):
+    """ load articles files into sqlLite db table. Adds a field 'chunkId'.
+    If the new chunks are a big part of the table, the indexes are dropped
+    before the load and re-created afterwards.
+    If procCount is > 1, the chunks are parsed in parallel, see loadChunksParallel.
+    Set isTempDb if con is a new db that is copied to its final place afterwards,
+    see tuneSqliteBulkLoad.
+    """
+    tuneSqliteBulkLoad(cur, isTempDb)
+    idxSqls = createArticleTable(con, cur)
 
-        logging.log(5, "Running Sql %s against %d rows" % (sql, len(newRows)))
-        cur.executemany(sql, newRows)
+    try:
+        oldChunkCount = cur.execute("SELECT COUNT(*) FROM loadedFiles").fetchone()[0]
+    except sqlite3.OperationalError:
+        oldChunkCount = 0
+    newFrac = len(tsvFnames) / float(max(1, oldChunkCount+len(tsvFnames)))
+    reindex = (newFrac > ARTDBREINDEXFRAC)
+    if reindex:
+        logging.info("New chunks are %d%% of all chunks, dropping indexes before loading" % (100*newFrac))
+        for idxName in getIndexNames(cur, "articles"):
+            cur.execute("DROP INDEX %s" % idxName)
         con.commit()
-        tp.taskCompleted()
+
+    logging.info("Loading data into table")
+    procCount = min(procCount, len(tsvFnames))
+    if procCount > 1:
+        rowCount = loadChunksParallel(con, cur, tsvFnames, procCount)
+    else:
+        rowCount = insertChunkRows(con, cur, tsvFnames)
 
     logging.info("Adding indexes to table")
     for idxSql in idxSqls:
@@ -1167,6 +1422,11 @@ def addToDatabase(con, cur, tsvFnames):
     addLoadedFiles(con, cur, tsvFnames)
     logging.info("Loaded %s chunks into index, %d new rows" % (len(tsvFnames), rowCount))
 
+def getIndexNames(cur, tableName):
+    " return the names of the indexes of a table that were created with CREATE INDEX "
+    sql = "SELECT name FROM sqlite_master WHERE type='index' AND tbl_name=? AND sql IS NOT NULL"
+    return [row[0] for row in cur.execute(sql, (tableName,)).fetchall()]
+
 #def loadNewTsvFilesSqlite(inDir, tableName, tsvFnames):
     #" load pubDoc files that are not loaded yet into sqlite db table, mark them as loaded at the end "
     #if len(tsvFnames)==0:
@@ -1192,10 +1452,12 @@ def addToDatabase(con, cur, tsvFnames):
         #con, cur = openArticleDb(inDir)
         #loadIndexes(con, cur, toLoadFnames)
 
-def updateSqlite(textDir):
+def updateSqlite(textDir, procCount=None):
     """ load all .articles files that are not currently indexed
-    into the sqlite database
+    into the sqlite database. procCount defaults to pubConf.articleDbLoadProcs.
     """
+    if procCount is None:
+        procCount = pubConf.articleDbLoadProcs
     artFnames = getAllArticleFnames(textDir)
     assert(len(artFnames)!=0) # there are no input files in the text data directory
     dbPath = getArtDbPath(textDir)
@@ -1213,7 +1475,7 @@ def updateSqlite(textDir):
     toLoadFnames = getUnloadedFnames(con, cur, artFnames)
     toLoadPaths = [join(textDir, fname) for fname in toLoadFnames]
 
-    addToDatabase(con, cur, toLoadPaths)
+    addToDatabase(con, cur, toLoadPaths, procCount=procCount, isTempDb=copyBack)
     con.close()
 
     if copyBack:
@@ -1316,26 +1578,125 @@ def lookupArticleByPmid(datasets, pmid, preferLocal=True):
             return art
     return None
 
+def lookupArticlesByPmids(pmids, datasets=["medline"]):
+    """ bulk version of lookupArticleByPmid for local dbs. Return a dict pmid -> article dict
+    for all pmids that were found. Datasets are searched in order. """
+    results = {}
+    for dataset in datasets:
+        missing = [p for p in pmids if p not in results]
+        if len(missing)==0:
+            break
+        if not dataset in connCache:
+            connCache[dataset] = openArticleDb(dataset)
+        con, cur = connCache[dataset]
+        logging.info("Looking up %d PMIDs in %s" % (len(missing), dataset))
+        results.update(lookupArticlesBy(con, cur, "pmid", missing))
+    return results
+
+# (path of db file, column, value) -> article dict or None
+articleLookupCache = maxCommon.LruCache(100000)
+
+# max number of values in one "IN (...)" query, sqlite allows 999 variables
+LOOKUPBATCHSIZE = 500
+# stop waiting for a locked database after this many seconds
+DBLOCKTIMEOUT = 3600
+
+def executeRetry(cur, sql, params=()):
+    """ run a query and return all rows. While the database is locked by a writer,
+    retry with increasing waits, from 0.1 to 10 seconds. """
+    waitTime = 0.1
+    startTime = time.time()
+    while True:
+        try:
+            return cur.execute(sql, params).fetchall()
+        except sqlite3.OperationalError, ex:
+            if "locked" not in str(ex):
+                raise
+            if time.time()-startTime > DBLOCKTIMEOUT:
+                raise Exception("database was locked for more than %d seconds" % DBLOCKTIMEOUT)
+            logging.info("Database is locked, waiting for %.1f secs" % waitTime)
+            time.sleep(waitTime)
+            waitTime = min(2*waitTime, 10)
+
+def rowToDict(row):
+    " convert sqlite row object to normal dict "
+    return dict(zip(list(row.keys()), row))
+
+def checkArticleColumn(column):
+    " column names cannot be query parameters, so make sure they are valid "
+    if column not in artDbFields:
+        raise Exception("%s is not a field of the articles table" % column)
+
+def getDbPath(cur):
+    " return the file path of the main db of a sqlite cursor, '' for in-memory dbs "
+    for seq, name, path in cur.execute("PRAGMA database_list").fetchall():
+        if name=="main":
+            return path
+    return ""
+
 def lookupArticle(con, cur, column, val):
     " uses sqlite db, returns a dict with info we have locally about last matching article, None if not found "
-    whereExpr = "%s=%s" % (column, val)
-    return list(iterArticlesWhere(con, cur, whereExpr))[-1]
+    # sqlite connections cannot carry attributes and ids of closed ones are reused, so
+    # the cache is keyed on the db file. In-memory dbs are not cached.
+    dbPath = getDbPath(cur)
+    cacheKey = (dbPath, column, unicode(val))
+    art = False
+    if dbPath!="":
+        art = articleLookupCache.get(cacheKey, False)
+    if art is False:
+        checkArticleColumn(column)
+        # the last entry should be the newest one
+        sql = "SELECT * FROM articles WHERE %s=? ORDER BY rowid DESC LIMIT 1" % column
+        rows = executeRetry(cur, sql, (val,))
+        if len(rows)==0:
+            logging.warn("No info in local db for %s=%s" % (column, val))
+            art = None
+        else:
+            art = rowToDict(rows[0])
+        if dbPath!="":
+            articleLookupCache.put(cacheKey, art)
+    if art is None:
+        return None
+    return dict(art)
+
+def lookupArticlesBy(con, cur, column, vals):
+    """ return a dict val -> article dict for all vals that are found in the db.
+    If a val matches several articles, returns the last one.
+    Uses "IN" queries with LOOKUPBATCHSIZE values each. """
+    checkArticleColumn(column)
+    if column in artDbIntFields:
+        # so we can match the integers from the db to the input values
+        keyToVal = dict([(int(v), v) for v in vals if unicode(v).isdigit()])
+    else:
+        keyToVal = dict([(unicode(v), v) for v in vals])
+    keys = list(keyToVal)
+
+    # with a plain cursor, rows are tuples, which is faster than sqlite3.Row
+    tupleCur = sqlite3.Cursor(con)
+    tupleCur.row_factory = None
+    found = {}
+    fieldNames = None
+    for i in range(0, len(keys), LOOKUPBATCHSIZE):
+        batch = keys[i:i+LOOKUPBATCHSIZE]
+        sql = "SELECT rowid, * FROM articles WHERE %s IN (%s)" % \
+            (column, ",".join(["?"]*len(batch)))
+        rows = executeRetry(tupleCur, sql, batch)
+        if fieldNames is None:
+            fieldNames = [desc[0] for desc in tupleCur.description][1:]
+            colIdx = fieldNames.index(column)+1
+        for row in rows:
+            key = row[colIdx]
+            if key not in found or found[key][0] < row[0]:
+                found[key] = row
 
-def iterArticlesWhere(con, cur, whereExpr):
-    " yields dicts for article that satisfy where expression "
-    rows = None
-    tryCount = 60
+    results = {}
+    for key, row in found.iteritems():
+        results[keyToVal[key]] = dict(zip(fieldNames, row[1:]))
+    return results
 
-    while rows==None and tryCount>0:
-        try:
-            rows = list(cur.execute("SELECT * from articles WHERE %s" % whereExpr))
-        except sqlite3.OperationalError:
-            logging.info("Database is locked, waiting for 60 secs")
-            time.sleep(60)
-            tryCount -= 1
-
-    if rows == None:
-        raise Exception("database was locked for more than 60 minutes")
+def iterArticlesWhere(con, cur, whereExpr, params=()):
+    " yields dicts for article that satisfy where expression, can contain ? for params "
+    rows = executeRetry(cur, "SELECT * from articles WHERE %s" % whereExpr, params)
 
     if len(rows)==0:
         logging.warn("No info in local db for %s" % (whereExpr))
@@ -1343,10 +1704,7 @@ def iterArticlesWhere(con, cur, whereExpr):
 
     for row in rows:
         # convert sqlite object to normal dict with strings
-        rowDict = {}
-        for key, val in zip(list(row.keys()), row):
-            rowDict[key] = val
-        yield rowDict
+        yield rowToDict(row)
 
 def lookupArticleData(articleId, lookupKey="articleId"):
     " lookup article meta data for an article via a database "
@@ -1365,13 +1723,14 @@ def lookupArticleData(articleId, lookupKey="articleId"):
         #assert(isfile(dbPath))
         if not (isfile(dbPath)):
             return None
-        cur, con = maxTables.openSqlite(dbPath, asDict=True)
-        conCache[textDir] = (cur, con)
+        con, cur = maxTables.openSqlite(dbPath, asDict=True)
+        conCache[textDir] = (con, cur)
     else:
-        cur, con = conCache[textDir]
+        con, cur = conCache[textDir]
 
-    sql = "SELECT * from articles where %s=%s" % (lookupKey, articleId)
-    rows = list(cur.execute(sql))
+    checkArticleColumn(lookupKey)
+    sql = "SELECT * from articles where %s=?" % lookupKey
+    rows = executeRetry(cur, sql, (articleId,))
     #assert(len(rows)==1)
     if len(rows)==0:
         #raise Exception("Could not find article %s in textDir %s" % (articleId, textDir))
@@ -1394,31 +1753,195 @@ def makeChunkPath(inDir, chunkId, tabType="articles"):
         artPath = join(inDir, "%s.%s.gz" % (chunkId, tabType))
     return artPath
 
+def writeFileIndex(fname, idxRows):
+    """ write the .files.idx index of a chunk: one row per article with the offset of
+    its first line in .files.gz, the length of its lines in bytes and the number of files.
+    For bgzf-compressed files, the offset is a bgzf virtual offset.
+    """
+    tmpFname = fname+".tmp"
+    ofh = open(tmpFname, "w")
+    ofh.write("#articleId\toffset\tlength\tfileCount\n")
+    for artId, offset, length, fileCount in idxRows:
+        ofh.write("%s\t%d\t%d\t%d\n" % (artId, offset, length, fileCount))
+    ofh.close()
+    os.rename(tmpFname, fname)
+
+def readFileIndex(fname):
+    " parse a .files.idx file into a dict articleId -> (offset, length, fileCount) "
+    idx = {}
+    for row in maxCommon.iterTsvRows(fname, encoding=None):
+        idx[row.articleId] = (int(row.offset), int(row.length), int(row.fileCount))
+    return idx
+
+def isBgzf(fname):
+    " return True if fname is a gzip file with bgzf blocks "
+    header = open(fname, "rb").read(14)
+    return len(header)==14 and header[:4]=="\x1f\x8b\x08\x04" and header[12:14]=="BC"
+
+def openFilesTable(fname):
+    """ open a .files or .files.gz table for reading, with bgzf if possible, so seeks are fast.
+    A .files.col file is opened as a pubColStore.ColReader. """
+    if fname.endswith(".col"):
+        return pubColStore.ColReader(fname, encoding="utf8")
+    if fname.endswith(".gz"):
+        if bgzfLoaded and isBgzf(fname):
+            return Bio.bgzf.open(fname, "rb")
+        logging.warn("%s is not bgzf-compressed, seeking in it requires decompression" % fname)
+        return gzip.open(fname, "rb")
+    return open(fname, "rb")
+
+def buildFileIndex(filesFname):
+    """ create the .files.idx index for an existing .files.gz table by reading it once
+    """
+    idxFname = join(dirname(filesFname), chunkIdFromFname(filesFname)+".files.idx")
+    logging.debug("Indexing %s to %s" % (filesFname, idxFname))
+    fh = openFilesTable(filesFname)
+    fh.readline() # skip headers
+    idxRows = []
+    while True:
+        offset = fh.tell()
+        line = fh.readline()
+        if line=="":
+            break
+        artId = line.split("\t", 3)[2]
+        if len(idxRows)==0 or idxRows[-1][0]!=artId:
+            idxRows.append([artId, offset, 0, 0])
+        idxRows[-1][2] += len(line)
+        idxRows[-1][3] += 1
+    fh.close()
+    writeFileIndex(idxFname, idxRows)
+    return idxFname
+
+def indexTextDir(inDir):
+    " create .files.idx for all chunks in inDir that do not have one yet "
+    fnames = getAllArticleFnames(inDir, type="files")
+    pm = maxCommon.ProgressMeter(len(fnames))
+    for fname in fnames:
+        idxFname = join(dirname(fname), chunkIdFromFname(fname)+".files.idx")
+        if not isfile(idxFname) and getsize(fname)!=0:
+            buildFileIndex(fname)
+        pm.taskCompleted()
+
+class FileHandleCache(object):
+    """ keeps up to maxCount tables open for reading. The least recently used one
+    is closed when a new one has to be opened.
+    """
+    def __init__(self, maxCount=100):
+        self.maxCount = maxCount
+        self.handles = OrderedDict()
+
+    def get(self, fname):
+        " return the open file handle for fname "
+        fh = self.handles.pop(fname, None)
+        if fh is None:
+            if len(self.handles) >= self.maxCount:
+                oldName, oldFh = self.handles.popitem(last=False)
+                logging.debug("Closing %s" % oldName)
+                oldFh.close()
+            logging.debug("Opening %s" % fname)
+            fh = openFilesTable(fname)
+        self.handles[fname] = fh
+        return fh
+
+    def close(self):
+        for fh in self.handles.values():
+            fh.close()
+        self.handles.clear()
+
+filesFhCache = FileHandleCache()
+
+# chunk .files path -> (file index dict or None, namedtuple class of the table), the index of
+# a chunk can be big, so only as many are kept as there are open files in filesFhCache
+fileIndexCache = maxCommon.LruCache(filesFhCache.maxCount)
+
+def _getFileIndex(filesPath):
+    """ return the index and the row class of a files table, both are cached.
+    The index of a .files.col file is a dict articleId -> list of fileIds. """
+    cached = fileIndexCache.get(filesPath)
+    if cached is None and filesPath.endswith(".col"):
+        colReader = filesFhCache.get(filesPath)
+        Rec = namedtuple("tsvRec", colReader.fieldNames)
+        idx = {}
+        for fileId in colReader.ids():
+            idx.setdefault(fileId[:-pubConf.FILEDIGITS], []).append(fileId)
+        cached = (idx, Rec)
+        fileIndexCache.put(filesPath, cached)
+    elif cached is None:
+        fh = filesFhCache.get(filesPath)
+        fh.seek(0)
+        fields = fh.readline().lstrip("#").rstrip("\n").split("\t")
+        Rec = namedtuple("tsvRec", fields)
+        idxFname = join(dirname(filesPath), chunkIdFromFname(filesPath)+".files.idx")
+        idx = None
+        if isfile(idxFname):
+            idx = readFileIndex(idxFname)
+        else:
+            logging.debug("No index %s, using offsets from articles.db" % idxFname)
+        cached = (idx, Rec)
+        fileIndexCache.put(filesPath, cached)
+    return cached
+
+def readArticleFiles(filesPath, artId, dbOffset=None):
+    """ return the file rows of an article as a list of dicts. Uses the .files.idx
+    index of the chunk or, if there is none, the offset from articles.db.
+    filesPath can also be a .files.col file, then dbOffset is not used.
+    """
+    idx, Rec = _getFileIndex(filesPath)
+    fh = filesFhCache.get(filesPath)
+    artId = str(artId)
+
+    if filesPath.endswith(".col"):
+        if artId not in idx:
+            logging.warn("article %s is not in %s" % (artId, filesPath))
+            return []
+        return [Rec(*row)._asdict() for row in fh.getRows(idx[artId])]
+    elif idx is not None:
+        if artId not in idx:
+            logging.warn("article %s is not in index of %s" % (artId, filesPath))
+            return []
+        offset, length, fileCount = idx[artId]
+        fh.seek(offset)
+        lines = fh.read(length).splitlines()
+    else:
+        # old chunks without index: offsets in articles.db, only reliable for bgzf
+        logging.debug("Seeking to offset %s" % dbOffset)
+        fh.seek(int(dbOffset))
+        lines = []
+        while True:
+            line = fh.readline()
+            if line=="" or line.split("\t", 3)[2]!=artId:
+                break
+            lines.append(line.rstrip("\n"))
+
+    fileRows = []
+    for line in lines:
+        fields = [f.decode("utf8") for f in line.split("\t")]
+        fileRows.append(Rec(*fields)._asdict())
+    return fileRows
+
 def lookupFullDocs(inDirs, whereExpr):
     """
     inDirs is a list of directories with pubStore sqlite indexes (article.db files)
     query is the part behind the WHERE in an sql command on the articles table
     yields tuples of (articleRow, list of fileRow).
+    Open file handles are kept in filesFhCache, so many lookups do not re-open files.
+    The files of chunks in column format are read from their .files.col file. An
+    article of a chunk without any files table gets an empty list.
     """
     for inDir in inDirs:
         con, cur = openArticleDb(inDir, mustOpen=True)
-        fileRows = []
         for artDict in iterArticlesWhere(con, cur, whereExpr):
             artId = artDict["articleId"]
             chunkId, offset = artDict["chunkId"], artDict["offset"]
             filesPath = makeChunkPath(inDir, chunkId, "files")
-            logging.debug("Opening %s" % filesPath)
-            filesFh = Bio.bgzf.open(filesPath)
-            fileReader = maxCommon.TsvReader(filesFh)
-            logging.debug("Seeking to offset %s" % offset)
-            fileReader.seek(int(offset))
-
-            # pull out all files with this article ID
-            while True:
-                row = fileReader.nextRow()
-                if row is None or row.fileId[:len(artId)]!=artId:
-                    break
-                fileRows.append(row._asdict())
+            if not isfile(filesPath):
+                # column-only chunk: its .articles.gz is an empty placeholder, offset is 0
+                filesPath = join(inDir, chunkId+".files.col")
+            if not isfile(filesPath):
+                logging.debug("Chunk %s in %s has no files table" % (chunkId, inDir))
+                yield artDict, []
+                continue
+            fileRows = readArticleFiles(filesPath, artId, offset)
             yield artDict, fileRows
 
 def getAllArticleFnames(inDir, type="articles"):
@@ -1426,6 +1949,8 @@ def getAllArticleFnames(inDir, type="articles"):
     inFnames = glob.glob(join(inDir, "*.%s.gz" % type))
     if len(inFnames)==0:
         inFnames = glob.glob(join(inDir, "*.%s" % type))
+    if len(inFnames)==0:
+        inFnames = glob.glob(join(inDir, "*.%s.col" % type))
     return inFnames
 
 
@@ -1435,7 +1960,7 @@ def iterPubReaders(inDir):
     pm = maxCommon.ProgressMeter(len(fnames))
     logging.info("found %d input chunks in %s" % (len(fnames), inDir))
     for fname in fnames:
-        pr = PubReaderFile(fname)
+        pr = openPubReader(fname)
         yield pr
         pm.taskCompleted()
 
@@ -128,6 +128,37 @@ blackList = set([
     ('F', 442, 'A'), ('A', 101, 'D'), ('A', 2, 'H'), ('A', 375, 'M'), ('A', 375, 'P'), ('A', 529, 'L'), ('A', 6, 'L'), ('B', 10, 'R'), ('B', 10, 'S'), ('B', 1203, 'L'), ('C', 2, 'M'), ('C', 2, 'W'), ('B', 16, 'V'), ('B', 35, 'M'), ('B', 3, 'D'), ('B', 46, 'M'), ('C', 33, 'A'), ('C', 4, 'I'), ('C', 127, 'I'), ('C', 463, 'A'), ('C', 611, 'B'), ('C', 831, 'L'), ('D', 18, 'T'), ('D', 1, 'B'), ('D', 2, 'N'), ('D', 422, 'T'), ('D', 8, 'G'), ('F', 36, 'E'), ('F', 36, 'P'), ('F', 11, 'G'), ('F', 1, 'B'), ('F', 4, 'N'), ('G', 14, 'D'), ('G', 1, 'B'), ('G', 1, 'E'), ('H', 2, 'M'), ('H', 2, 'P'), ('H', 48, 'N'), ('H', 4, 'M'), ('H', 4, 'S'), ('H', 69, 'V'), ('C', 3, 'A'), ('C', 1, 'R'), ('H', 766, 'T'), ('I', 51, 'T'), ('K', 562, 'R'), ('L', 5178, 'Y'), ('L', 2, 'C'), ('L', 929, 'S'), ('M', 59, 'K'), ('M', 10, 'K'), ('M', 10, 'T'), ('M', 14, 'K'), ('M', 22, 'K'), ('M', 24, 'K'), ('M', 25, 'K'), ('M', 28, 'K'), ('M', 33, 'K'), ('M', 38, 'K'), ('M', 9, 'A'), ('M', 9, 'K'), ('H', 1755, 'A'), ('H', 295, 'A'), ('H', 295, 'R'), ('H', 322, 'M'), ('H', 460, 'M'), ('H', 510, 'A'), ('H', 676, 'B'), ('P', 3, 'D'), ('R', 201, 'C'), ('R', 2, 'C'), ('S', 16, 'Y'), ('S', 594, 'S'), ('N', 303, 'L'), ('N', 1003, 'L'), ('N', 2307, 'L'), ('N', 1108, 'L'), ('T', 47, 'D'), ('T', 27, 'A'), ('T', 88, 'M'), ('T', 98, 'G'), ('H', 5, 'D'), ('C', 1, 'A'), ('C', 1, 'D'), ('C', 2, 'D'), ('C', 2, 'G'), ('C', 2, 'H'), ('C', 2, 'N'), ('V', 79, 'B'), ('V', 9, 'P'), ('V', 10, 'M'), ('V', 9, 'M'), ('X', 16, 'C')
 ])
 
+# ===== PREFILTER ========
+# findVariantDescriptions first searches the text for anchors, short strings that every
+# match of an anchored pattern contains, e.g. the "R7" of "R71G" or the "c.1" of
+# "c.123delT". The anchored patterns then only run on windows around the anchors.
+# This can be switched off, e.g. to compare the results
+usePrefilter = True
+
+anchorRe = re.compile(r"[a-z][1-9]|[cp]\.[1-9]|[0-9]+(?:[actg]|del|ins|dup)|substitution of|(?:snp|rs)[^0-9]{0,8}[0-9]", \
+    flags=re.IGNORECASE)
+
+# a pattern is anchored if its template in regex.txt matches one of these: the position
+# is preceded by c. p. a letter or the amino acid, or followed by a nucleotide or del/ins/dup
+anchoredTemplateRes = [re.compile(x) for x in [
+    r"[cp]\\\.\{(pos|fromPos)\}",
+    r"(\{origAaShort\}|\{origAaLong\}|IVS|nt)\{pos\}",
+    r"\{pos\}(\{origDna\}|\{origDnas\}|del|ins|dup)",
+    r"^substitution of ",
+    r"\(SNP\|dbSNP\|rs\|Rs\|RefSNP\|refSNP\).*\?P<rsId>",
+    ]]
+
+# max number of characters between the start of a pattern match and its anchor:
+# separator, "p.(" and the longest amino acid name, or "deletion of "
+ANCHORMAXPREFIX = 20
+# the search for matches that start in a window stops this many characters after its end.
+# All matches up to this length are found, longer ones only if they end with a run of
+# nucleotides or amino acids, see iterWindowMatches()
+WINDOWRIGHTMARGIN = 100
+# if the windows with their margins are longer than this fraction of the text,
+# the patterns run on the whole text
+WINDOWMAXFRAC = 0.5
+
 # ===== FUNCTIONS TO INIT THE GLOBALS =================
 
 def loadDb(logLevel=logging.DEBUG, loadSequences=True):
@@ -201,6 +232,8 @@ class SeqData(object):
         logger.info("opening %s" % fname)
         seqs = pubKeyVal.SqliteKvDb(fname)
         self.seqs = seqs
+        # seqId -> sequence or None if not in the db
+        self.seqCache = maxCommon.LruCache(pubConf.varSeqCacheSize)
 
         # refprot to refseqId
         # refseq to CDS Start
@@ -212,8 +245,8 @@ class SeqData(object):
             self.refProtToRefSeq[row.refProt] = row.refSeq
             self.refSeqCds[row.refSeq] = int(row.cdsStart) - 1  # NCBI is 1-based
 
-        # refseq to genome
-        self.pslCache = {}
+        # refseq to genome, refseqId without version -> list of psls on the plus strand
+        self.pslCache = maxCommon.LruCache(pubConf.varPslCacheSize)
         self.refGenePsls = openIndexedPsls(mutDataDir, "refGenePsls.9606")
 
         # dbsnp db
@@ -227,9 +260,49 @@ class SeqData(object):
         " get seq from db , cache results "
         logger.log(5, "Looking up sequence for id %s" % seqId)
         seqId = str(seqId)  # no unicode
-        if seqId not in self.seqs:
-            return None
-        return self.seqs[seqId]
+        seq = self.seqCache.get(seqId, False)
+        if seq is False:
+            seq = self.seqs.get(seqId)
+            self.seqCache.put(seqId, seq)
+        return seq
+
+    def prefetchGenes(self, entrezGenes):
+        """ load the refseq sequences and psls of the entrez genes into the caches,
+        with one query for the sequences and one for the psls. entrezGenes is a list of
+        entrez IDs or strings of them separated by "/", as for groundVariant()
+        """
+        protIds = set()
+        rnaIds = set()
+        for entrezStr in entrezGenes:
+            for entrezGene in str(entrezStr).split("/"):
+                if not entrezGene.isdigit():
+                    continue
+                entrezGene = int(entrezGene)
+                protIds.update([str(x) for x in self.entrez2refprots.get(entrezGene) or []])
+                rnaIds.update([str(x) for x in self.entrez2refseqs.get(entrezGene) or []])
+        # proteins are mapped to the genome via their refseqs
+        for protId in protIds:
+            if protId in self.refProtToRefSeq:
+                rnaIds.add(self.refProtToRefSeq[protId])
+        seqIds = protIds.union(rnaIds)
+
+        missSeqIds = [x for x in seqIds if x not in self.seqCache]
+        if len(missSeqIds)!=0:
+            foundSeqs = self.seqs.getMany(missSeqIds)
+            for seqId in missSeqIds:
+                self.seqCache.put(seqId, foundSeqs.get(seqId))
+
+        pslIds = set([x.split(".")[0] for x in rnaIds])
+        missPslIds = [x for x in pslIds if x not in self.pslCache]
+        if len(missPslIds)!=0:
+            foundPsls = self.refGenePsls.getMany(missPslIds)
+            for pslId in missPslIds:
+                if pslId in foundPsls:
+                    self.pslCache.put(pslId, parsePsls(foundPsls[pslId]))
+                else:
+                    self.pslCache.put(pslId, [])
+        logger.debug("Prefetched %d of %d sequences and %d of %d psls for genes %s" % \
+            (len(missSeqIds), len(seqIds), len(missPslIds), len(pslIds), entrezGenes))
 
     def lookupDbSnp(self, chrom, start, end):
         " return the rs-Id of a position or None if not found "
@@ -486,6 +559,18 @@ class SeqVariantData(object):
 
 # ===== FUNCTIONS =================
 # helper methods for SeqData
+def parsePsls(pslLines):
+    """ create Psl objects from the lines of a psl file,
+    reverse complement those on the negative strand
+    """
+    psls = []
+    for line in pslLines.split("\n"):
+        psl = Psl(line.split("\t"))
+        if psl.strand == "-":
+            psl = psl.reverseComplement()
+        psls.append(psl)
+    return psls
+
 def getPsls(qId, cache, dbm, stripVersion=False):
     """ load psls from compressed dbm, create Psl objects, use a cache
     reverse complement is on negative strand
@@ -494,29 +579,19 @@ def getPsls(qId, cache, dbm, stripVersion=False):
     if stripVersion:
         qId = str(qId).split(".")[0]
     logger.debug("Getting mapping psl for %s" % qId)
-    if qId in cache:
-        psls = cache[qId]
-    else:
-        if not qId in dbm:
-            logger.error("Could not find PSL for %s" % qId)
-            return []
-        pslLines = dbm[qId]
-        psls = []
-        for line in pslLines.split("\n"):
-            psl = Psl(line.split("\t"))
-            psls.append(psl)
-        cache[qId] = psls
-    logger.debug("Got mapping psl %s" % str(psls[0]))
-
-    corrPsls = []
-    for p in psls:
-        if p.strand == "-":
-            p2 = p.reverseComplement()
+    psls = cache.get(qId)
+    if psls is None:
+        pslLines = dbm.get(qId)
+        if pslLines is None:
+            psls = []
         else:
-            p2 = p
-        corrPsls.append(p2)
-
-    return corrPsls
+            psls = parsePsls(pslLines)
+        cache.put(qId, psls)
+    if len(psls)==0:
+        logger.error("Could not find PSL for %s" % qId)
+        return []
+    logger.debug("Got mapping psl %s", psls[0])
+    return list(psls)
 
 def makeMention(match, patName):
     start = match.start()
@@ -525,7 +600,7 @@ def makeMention(match, patName):
     return mention
 
 def parseRegex(mutDataDir):
-    """ parse and compile regexes to list (seqType, mutType, patName, pat) """
+    """ parse and compile regexes to list (seqType, mutType, isCoding, patName, pat, isAnchored) """
     # read regexes, translate placeholders to long form and compile
     replDict = {
     "sep"         : r"""(?:^|[:;\s\(\[\'\"/,\-])""",
@@ -569,6 +644,9 @@ def parseRegex(mutDataDir):
             flags = re.IGNORECASE
             logger.info("ignoring case for this pattern")
         patComp = re.compile(patFull, flags=flags)
+        isAnchored = isAnchoredTemplate(row.pat)
+        if not isAnchored:
+            logger.info("pattern has no anchor, running it on the whole text")
         if row.isCoding == "True":
             isCoding = True
         elif row.isCoding == "False":
@@ -576,13 +654,77 @@ def parseRegex(mutDataDir):
         else:
             logger.info("Skipping regex. Invalid value for isCoding: "+row.isCoding)
             continue
-        regexList.append((row.seqType, row.mutType, isCoding, patName, patComp))
+        regexList.append((row.seqType, row.mutType, isCoding, patName, patComp, isAnchored))
         counts[(row.seqType, row.mutType)] += 1
 
     for regexType, count in counts.iteritems():
             logger.info("regexType %s, found %d regexes" % (str(regexType), count))
     return regexList
 
+def isAnchoredTemplate(template):
+    """ True if all matches of the regex.txt pattern template contain a match of anchorRe
+    >>> isAnchoredTemplate(r"{sep}p\.\(?{origAaLong}{pos}{mutAaLong}{fs}")
+    True
+    >>> isAnchoredTemplate(r"{sep}{pos}del{origDnas}")
+    True
+    >>> isAnchoredTemplate(r"{origAaLong}\u2192{mutAaLong}")
+    False
+    """
+    if re.__name__!="re":
+        # the windows rely on how the re module treats "^" with a start position
+        return False
+    for templRe in anchoredTemplateRes:
+        if templRe.search(template) is not None:
+            return True
+    return False
+
+def findAnchorWindows(text):
+    """ return a sorted list of non-overlapping [start, end] ranges of text.
+    All matches of anchored patterns start in one of these ranges.
+    >>> findAnchorWindows("Patients with the R71G mutation, see table 2, and rs1234")
+    [[0, 22], [30, 53]]
+    """
+    windows = []
+    for match in anchorRe.finditer(text):
+        start = max(0, match.start()-ANCHORMAXPREFIX)
+        end = match.end()
+        if len(windows)!=0 and start <= windows[-1][1]:
+            windows[-1][1] = end
+        else:
+            windows.append([start, end])
+    return windows
+
+def windowSize(windows, textLen):
+    " return the number of characters that are searched in the windows "
+    size = 0
+    for winStart, winEnd in windows:
+        size += min(textLen, winEnd+WINDOWRIGHTMARGIN)-winStart
+    return size
+
+def iterWindowMatches(pat, text, windows):
+    """ yield the matches of pat that start in windows, the same as pat.finditer(text)
+    if all matches start in windows.
+    The search in a window stops WINDOWRIGHTMARGIN characters after its end, where a longer
+    match can be cut, so all matches are matched again without this limit.
+    >>> pat = re.compile("[A-Z][1-9][0-9]*[A-Z]+")
+    >>> text = "R71G and "+100*" "+"A23"+200*"B"+" and C45G"
+    >>> [m.group(0)[:6] for m in iterWindowMatches(pat, text, findAnchorWindows(text))]
+    ['R71G', 'A23BBB', 'C45G']
+    """
+    textLen = len(text)
+    lastEnd = 0
+    for winStart, winEnd in windows:
+        pos = max(winStart, lastEnd)
+        endPos = min(textLen, winEnd+WINDOWRIGHTMARGIN)
+        while pos <= winEnd:
+            match = pat.search(text, pos, endPos)
+            if match is None or match.start() > winEnd:
+                break
+            match = pat.match(text, match.start())
+            yield match
+            lastEnd = match.end()
+            pos = max(lastEnd, match.start()+1)
+
 def parseMatchRsId(match, patName):
     """ given a regular expression match object,
     return special mutation object for rsIds
@@ -818,10 +960,23 @@ def findVariantDescriptions(text, exclPos=set()):
     exclPos = set(exclPos)
     varMentions = defaultdict(list)
     varDescObj = {}
-    for seqType, mutType, isCoding, patName, pat in regexes:
-        for match in pat.finditer(text):
-            logger.debug("Match: Pattern %s, text %s" % (patName, match.groups()))
-            if isOverlapping(match, exclPos):
+    windows = None
+    if usePrefilter:
+        windows = findAnchorWindows(text)
+        if windowSize(windows, len(text)) > WINDOWMAXFRAC*len(text):
+            # searching the windows separately would be slower
+            windows = None
+    isDebug = logger.isEnabledFor(logging.DEBUG)
+    for seqType, mutType, isCoding, patName, pat, isAnchored in regexes:
+        if windows is not None and isAnchored:
+            matches = iterWindowMatches(pat, text, windows)
+        else:
+            matches = pat.finditer(text)
+
+        for match in matches:
+            if isDebug:
+                logger.debug("Match: Pattern %s, text %s" % (patName, match.groups()))
+            if len(exclPos)!=0 and isOverlapping(match, exclPos):
                 logger.debug("Overlapping with exclPos")
                 continue
             if mutType == "sub":
@@ -835,7 +990,7 @@ def findVariantDescriptions(text, exclPos=set()):
             elif mutType == "dup":
                 variant = parseMatchDup(match, patName, seqType, isCoding)
             else:
-                logger.debug("Ignoring match %s; don't know how to handle" % match.groups())
+                logger.debug("Ignoring match %s; don't know how to handle" % (match.groups(),))
                 continue
             if variant == None:
                 continue
@@ -843,8 +998,9 @@ def findVariantDescriptions(text, exclPos=set()):
             mention = makeMention(match, patName)
             varDescObj[variant.getName()] = variant
             varMentions[variant.getName()].append(mention)
-            debugSnip = pubAlg.getSnippet(text, mention.start, mention.end, maxContext=60)
-            logger.debug("Found Variant: %s, snippet %s" % (str(variant), debugSnip))
+            if isDebug:
+                debugSnip = pubAlg.getSnippet(text, mention.start, mention.end, maxContext=60)
+                logger.debug("Found Variant: %s, snippet %s" % (str(variant), debugSnip))
 
     # convert to dict of "prot"|"dna"|"dbSnp" -> list (variant, mentions)
     variants = {}
@@ -1324,6 +1480,8 @@ def groundVariant(docId, text, variant, mentions, snpMentions, entrezGenes, inse
 
     allBeds = []
     logger.debug("Grounding mutation %s onto genes %s" % (variant, entrezGenes))
+    # get the sequences of all genes with two queries, instead of several per gene
+    geneData.prefetchGenes(entrezGenes)
     groundSuccess = False
     # try all entrez genes in article
     for entrezGene in entrezGenes:
@@ -1,7 +1,7 @@
 # search for a dictionary compiled with pubDictCompile
 import os, logging
 from fastFind import fastFind, loadLex
-import pubNlp
+import pubNlp, pubConf
 from os.path import basename
 
 # this variable has to be defined, otherwise the jobs will not run.
@@ -25,7 +25,7 @@ def startup(paramDict):
     global lexes
     for fname in paramDict["fnames"].split(","):
         lexName = basename(fname).split(".")[0]
-        lexes[lexName]=loadLex(fname)
+        lexes[lexName]=loadLex(fname, cacheDir=pubConf.getLexCacheDir())
 
     if "toLower" in paramDict:
         global toLower
@@ -54,7 +54,8 @@ def annotateFile(article, file):
         if not found:
             return
 
-    for section, sentStart, sentEnd, sent in pubNlp.sectionSentences(text, file.fileType, mustHaveVerb=False):
+    for section, sentStart, sentEnd, sent in pubNlp.sectionSentences(text, file.fileType, mustHaveVerb=False, \
+            fileId=file.fileId):
         #if len(sent)<20:
             #logging.debug("Sentence too short: %d characters" % len(text))
             #continue
@@ -128,7 +128,7 @@ def startup(paramDict):
     #varFinder.loadDb(loadSequences=False)
     varFinder.loadDb()
     
-def findDisGeneVariant(text):
+def findDisGeneVariant(text, fileId=None):
     """
     >>> geneFinder.initData(exclMarkerTypes=["dnaSeq", "band"])
     >>> varFinder.loadDb(loadSequences=False)
@@ -140,7 +140,7 @@ def findDisGeneVariant(text):
     docGenes = list(geneFinder.findGeneNames(text))
     docEntrezIds = set([r[-1] for r in docGenes])
 
-    for section, start, end, sentence in pubNlp.sectionSentences(text):
+    for section, start, end, sentence in pubNlp.sectionSentences(text, fileId=fileId):
         conds = list(pubNlp.findDiseases(sentence))
         drugs = list(pubNlp.findDrugs(sentence))
         genes = list(geneFinder.findGeneNames(sentence))
@@ -196,7 +196,7 @@ def annotateFile(article, file):
     if file.fileType == "supp":
         return
     text = file.content
-    for row in findDisGeneVariant(text):
+    for row in findDisGeneVariant(text, file.fileId):
         yield row
         
 if __name__ == "__main__":
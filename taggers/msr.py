@@ -130,7 +130,7 @@ class splitSent:
         pmid = article.pmid
         if file.fileType=="supp":
             return
-        for row in pubNlp.sectionSentences(text, file.fileType):
+        for row in pubNlp.sectionSentences(text, file.fileType, fileId=file.fileId):
             section, sentStart, sentEnd, text = row
             tokens = text.split()
             if len(tokens)<6:
@@ -85,6 +85,8 @@ class UpcaseCounter:
         self.wordCounts = {}
         self.headers = ["word", "articleIds"]
         self.reduceHeaders = ["word", "count"]
+        # too many words to keep all in memory
+        self.streamReduce = True
 
     def map(self, article, file, text, results):
         #words = set(text.replace("\a"," ").split())
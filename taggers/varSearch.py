@@ -22,10 +22,10 @@ def findGenes(pmid, text):
 def annotateFile(artData, fileData):
     pmid = artData.pmid
     text = fileData.content
-    for r in findVarDisGeneDrug(pmid, text):
+    for r in findVarDisGeneDrug(pmid, text, fileData.fileId):
         yield r
 
-def findVarDisGeneDrug(pmid, text):
+def findVarDisGeneDrug(pmid, text, fileId=None):
     """
     >>> startup({})
     >>> list(findVarDisGeneDrug(0, "The R71G BRCA1 is a breast cancer founder mutation not treatable with Herceptin"))
@@ -36,7 +36,7 @@ def findVarDisGeneDrug(pmid, text):
             " mutant " not in textLow:
         return
 
-    for section, sentStart, sentEnd, sentText in pubNlp.sectionSentences(text):
+    for section, sentStart, sentEnd, sentText in pubNlp.sectionSentences(text, fileId=fileId):
         genes = list(geneFinder.findGeneNames(sentText))
         if len(genes)==0:
             continue
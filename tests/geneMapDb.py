@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# regression test and benchmark for the compiled gene mapping db of geneFinder.loadMappings
+
+# Random uniprot.tab.marshal and entrez.9606.tab.marshal files are written to a temp dir, the
+# results of geneFinder.markerToGenes and of the mapping dicts have to be the same when they are
+# loaded from the marshal files and from the mapping db compiled by geneMapDb.compileGeneMaps.
+# With --bench, the startup time and RSS of a process that loads the mappings either way is
+# printed, on the random data or on the marshal files in a directory, e.g. pubConf.geneDataDir.
+
+import sys, os, time, random, shutil, optparse, marshal, resource, subprocess
+from os.path import join, abspath
+
+from testLib import tempDir, checkResult, Timer, makeParser, parseArgs
+import geneMapDb
+
+def randAcc(prefix, digits):
+    return prefix+"".join([random.choice("0123456789") for i in range(digits)])
+
+def makeData(geneCount, upCount, accCount, seed=1):
+    " return random upData and entrezToSym dicts with the structure of the marshal files "
+    random.seed(seed)
+    genes = random.sample(xrange(1, 10*geneCount), geneCount)
+    entrezToSym = {}
+    for gene in genes:
+        entrezToSym[gene] = randAcc("G", 5)
+    ups = list(set([randAcc("P", 5) for i in range(upCount)]))
+    someSyms = entrezToSym.values()[:1000]
+    upToEntrez, upToSym, entrezToUp = {}, {}, {}
+    for up in ups:
+        if random.random()<0.9:
+            upGenes = random.sample(genes, random.choice([1, 1, 1, 2]))
+            upToEntrez[up] = upGenes
+            for gene in upGenes:
+                entrezToUp.setdefault(gene, []).append(up)
+        if random.random()<0.8:
+            upToSym[up] = random.choice(someSyms+[randAcc("S", 4)])
+    accToUps = {}
+    for i in range(accCount):
+        acc = randAcc(random.choice(["omim", "NP_", "NM_", "X", "ENSG"]), 6)
+        accToUps[acc] = random.sample(ups, random.choice([1, 1, 2, 3]))
+    upData = {"accToUps":accToUps, "upToEntrez":upToEntrez, "upToSym":upToSym, "entrezToUp":entrezToUp}
+    return upData, entrezToSym
+
+def writeMarshal(dataDir, upData, entrezToSym):
+    " write the files of pubPrepGeneDir that geneFinder.loadMappings reads "
+    marshal.dump({9606:upData}, open(join(dataDir, "uniprot.tab.marshal"), "wb"))
+    marshal.dump({"entrez2sym":entrezToSym}, open(join(dataDir, "entrez.9606.tab.marshal"), "wb"))
+
+def loadGeneFinder(dataDir):
+    " import geneFinder and load the mappings from dataDir "
+    import geneFinder
+    geneFinder.GENEDATADIR = dataDir
+    geneFinder.loadMappings()
+    return geneFinder
+
+def queryAll(geneFinder, upData, entrezToSym, markers):
+    " return the results of markerToGenes and of the mapping dicts for all keys "
+    res = []
+    for markerType, markerId in markers:
+        res.append(geneFinder.markerToGenes(markerType, markerId))
+    for name, keys in [("accToUps", upData["accToUps"].keys()+["NOACC"]),
+            ("upToEntrez", upData["upToEntrez"].keys()+["NOUP"]),
+            ("upToSym", upData["upToSym"].keys()),
+            ("entrezToUp", entrezToSym.keys()+[0]),
+            ("entrezToSym", entrezToSym.keys()+[0]),
+            ("symToEntrez", entrezToSym.values()+["NOSYM"])]:
+        mapping = getattr(geneFinder, name)
+        res.append(sorted([(k, mapping.get(k), k in mapping) for k in keys]))
+    return res
+
+def makeMarkers(upData, entrezToSym):
+    " return a list of (markerType, markerId) that covers all branches of markerToGenes "
+    markers = []
+    for acc in upData["accToUps"].keys()[:5000]:
+        if acc.startswith("omim"):
+            markers.append( ("omim", acc[4:]) )
+        elif acc.startswith("N"):
+            markers.append( ("refseq", acc.lower()+".1") )
+        else:
+            markers.append( ("ensembl", acc) )
+    for up in upData["upToEntrez"].keys()[:5000]:
+        markers.append( ("uniprot", up) )
+    for gene in entrezToSym.keys()[:5000]:
+        markers.append( ("entrez", str(gene)) )
+    markers.extend([("genbank", "XNOACC"), ("uniprot", "PNOUP")])
+    return markers
+
+def testGeneMap(upData, entrezToSym):
+    " compare the results with the marshal files and with the mapping db "
+    with tempDir("geneMapDb") as tmpDir:
+        writeMarshal(tmpDir, upData, entrezToSym)
+        markers = makeMarkers(upData, entrezToSym)
+        geneFinder = loadGeneFinder(tmpDir)
+        expected = queryAll(geneFinder, upData, entrezToSym, markers)
+
+        geneMapDb.compileGeneMaps(tmpDir)
+        geneFinder = loadGeneFinder(tmpDir)
+        assert(geneFinder.geneMap!=None)
+        found = queryAll(geneFinder, upData, entrezToSym, markers)
+
+        # a mapping db that is older than the marshal files is not used
+        uniprotFname = join(tmpDir, "uniprot.tab.marshal")
+        os.utime(uniprotFname, (time.time()+60, time.time()+60))
+        geneFinder = loadGeneFinder(tmpDir)
+        assert(geneFinder.geneMap==None)
+    for exp, res in zip(expected, found):
+        if exp!=res:
+            print("expected %s, found %s" % (repr(exp)[:200], repr(res)[:200]))
+            break
+    checkResult(expected!=found, "%d markers, %d accessions" % (len(markers), len(upData["accToUps"])))
+
+def maxRssMb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+
+def loadOnly(dataDir):
+    " the child process of the benchmark: load the mappings, look up accessions and print stats "
+    accs = open(join(dataDir, "lookupAccs.txt")).read().splitlines()
+    import geneFinder
+    startRss = maxRssMb()
+    with Timer() as loadTimer:
+        geneFinder = loadGeneFinder(dataDir)
+    loadRss = maxRssMb()-startRss
+    with Timer() as lookupTimer:
+        for acc in accs:
+            geneFinder.markerToGenes("ensembl", acc)
+    print("%s: startup %.2f sec, RSS +%.1f MB, after %d markerToGenes: RSS +%.1f MB, %d lookups/sec" % \
+        (geneFinder.geneMap and "mapping db" or "marshal", loadTimer.seconds, loadRss, len(accs), \
+        maxRssMb()-startRss, len(accs)/lookupTimer.seconds))
+
+def benchmark(dataDir, lookupCount):
+    " run the loading in new processes, with the marshal files and with the mapping db "
+    with tempDir("geneMapDb") as tmpDir:
+        for fname in ["uniprot.tab.marshal", "entrez.9606.tab.marshal"]:
+            shutil.copy(join(dataDir, fname), tmpDir)
+        accs = marshal.load(open(join(tmpDir, "uniprot.tab.marshal"), "rb"))[9606]["accToUps"].keys()
+        random.seed(1)
+        ofh = open(join(tmpDir, "lookupAccs.txt"), "w")
+        for i in range(lookupCount):
+            ofh.write(random.choice(accs)+"\n")
+        ofh.close()
+        del accs
+
+        cmd = [sys.executable, abspath(__file__), "--loadOnly", tmpDir]
+        subprocess.check_call(cmd)
+        with Timer() as timer:
+            geneMapDb.compileGeneMaps(tmpDir)
+        print("compiling the mapping db: %.2f sec, %.1f MB" % (timer.seconds, \
+            os.path.getsize(geneMapDb.gmapFname(tmpDir, 9606))/1000000.0))
+        subprocess.check_call(cmd)
+
+def main():
+    parser = makeParser("""usage: %prog [options] [dataDir] - regression test for the
+    compiled gene mapping db. Compares geneFinder.markerToGenes and the mapping dicts when
+    loaded from random marshal files and from the mapping db. With --bench, the marshal
+    files can be taken from dataDir.
+    """, "benchmark the startup time and memory of loadMappings instead")
+    parser.add_option("", "--genes", dest="genes", type="int", default=20000, \
+        help="number of random entrez genes, default %default")
+    parser.add_option("", "--uniprots", dest="uniprots", type="int", default=100000, \
+        help="number of random uniprot IDs, default %default")
+    parser.add_option("", "--accs", dest="accs", type="int", default=500000, \
+        help="number of random accessions, default %default")
+    parser.add_option("", "--lookups", dest="lookups", type="int", default=100000, \
+        help="for --bench: number of random accession lookups, default %default")
+    parser.add_option("", "--loadOnly", dest="loadOnly", \
+        help=optparse.SUPPRESS_HELP)
+    (options, args) = parseArgs(parser)
+
+    if options.loadOnly:
+        loadOnly(options.loadOnly)
+    elif options.bench:
+        if len(args)!=0:
+            benchmark(args[0], options.lookups)
+        else:
+            with tempDir("geneMapDb") as dataDir:
+                upData, entrezToSym = makeData(options.genes, options.uniprots, options.accs)
+                writeMarshal(dataDir, upData, entrezToSym)
+                del upData, entrezToSym
+                benchmark(dataDir, options.lookups)
+    else:
+        upData, entrezToSym = makeData(options.genes/10, options.uniprots/10, options.accs/10)
+        testGeneMap(upData, entrezToSym)
+
+if __name__=="__main__":
+    main()
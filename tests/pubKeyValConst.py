@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# regression test and benchmark for pubKeyVal.ConstKvDb, the constant mmap-backed key-value store
+
+# The same key-value pairs are written to a ConstKvDb and to a SqliteKvDb, both have to return
+# the same values. With --bench, loading and random lookups of the two are timed, on random
+# pairs or on a tab-sep file with two fields, e.g. the uniprot pairs in the SqliteKvDb docstring.
+
+import os, random
+from os.path import join
+
+from testLib import tempDir, checkResult, Timer, makeParser, parseArgs
+import pubKeyVal, maxTables
+
+def makePairs(count, seed=1):
+    " random uniprot-like accession -> sequence pairs, with some duplicate keys and None values "
+    random.seed(seed)
+    pairs = []
+    for i in range(count):
+        key = "P%05d" % random.randint(0, count)
+        if i%10==0:
+            val = None
+        else:
+            val = "".join([random.choice("ACDEFGHIKLMNPQRSTVWY") for j in range(random.randint(0, 300))])
+        pairs.append( (key, val) )
+    return pairs
+
+def readPairs(fname):
+    " read the pairs from a tab-sep file with one or two fields "
+    pairs = []
+    for line in maxTables.openFile(fname):
+        if line.startswith("#"):
+            continue
+        fields = line.rstrip("\n").split("\t")
+        if len(fields)==1:
+            fields.append(None)
+        pairs.append( tuple(fields) )
+    return pairs
+
+def writeDbs(pairs, tmpDir, compress):
+    " write the pairs to a sqlite and a constant db, return both opened for reading "
+    sqliteDb = pubKeyVal.SqliteKvDb(join(tmpDir, "pairs"), singleProcess=True, newDb=True, eightBit=True)
+    # the constant db stores None as ""
+    sqliteDb.update([(k, v or "") for k, v in pairs])
+    sqliteDb.close()
+    constDb = pubKeyVal.ConstKvDb(join(tmpDir, "pairs"), newDb=True, compress=compress)
+    constDb.update(pairs)
+    constDb.close()
+    return pubKeyVal.SqliteKvDb(join(tmpDir, "pairs"), eightBit=True), \
+        pubKeyVal.ConstKvDb(join(tmpDir, "pairs"))
+
+def testConst(pairs):
+    " compare the values of the constant db with the values of sqlite "
+    failed = False
+    for compress in [False, True]:
+        with tempDir("pubKeyValConst") as tmpDir:
+            sqliteDb, constDb = writeDbs(pairs, tmpDir, compress)
+            keys = sorted(set([k for k, v in pairs]))
+            missing = ["X%d" % i for i in range(100)]
+            if sorted(constDb.keys())!=keys or len(constDb)!=len(keys):
+                print("compress=%s: different keys" % compress)
+                failed = True
+            for key in keys+missing:
+                if constDb.get(key)!=sqliteDb.get(key) or (key in constDb)!=(key in sqliteDb):
+                    print("compress=%s: different value for %s" % (compress, key))
+                    failed = True
+            if constDb.getMany(keys+missing)!=sqliteDb.getMany(keys+missing):
+                print("compress=%s: different result of getMany" % compress)
+                failed = True
+            constDb.close()
+    checkResult(failed, "%d pairs, %d keys" % (len(pairs), len(keys)))
+
+def benchmark(pairs, lookupCount):
+    " print the time for writing the dbs and for random lookups "
+    keys = [k for k, v in pairs]
+    random.seed(1)
+    lookupKeys = [random.choice(keys) for i in range(lookupCount)]
+    for compress in [False, True]:
+        with tempDir("pubKeyValConst") as tmpDir:
+            with Timer() as sqliteWrite:
+                db = pubKeyVal.SqliteKvDb(join(tmpDir, "pairs"), singleProcess=True, newDb=True, \
+                    eightBit=True, compress=compress)
+                for key, val in pairs:
+                    db[key] = val or ""
+                db.close()
+
+            with Timer() as constWrite:
+                db = pubKeyVal.ConstKvDb(join(tmpDir, "pairs"), newDb=True, compress=compress)
+                db.update(pairs)
+                db.close()
+
+            dbs = [("sqlite", pubKeyVal.SqliteKvDb(join(tmpDir, "pairs"), eightBit=True, \
+                compress=compress), sqliteWrite.seconds),
+                ("const", pubKeyVal.ConstKvDb(join(tmpDir, "pairs")), constWrite.seconds)]
+            for name, db, writeTime in dbs:
+                with Timer() as getTimer:
+                    for key in lookupKeys:
+                        db.get(key)
+                with Timer() as manyTimer:
+                    db.getMany(lookupKeys)
+                fsize = os.path.getsize(db.dbName)
+                print("%s compress=%s: write %.2f sec, %d MB, get %d lookups/sec, getMany %d lookups/sec" % \
+                    (name, compress, writeTime, fsize/1000000, lookupCount/getTimer.seconds, \
+                    lookupCount/manyTimer.seconds))
+                db.close()
+
+def main():
+    parser = makeParser("""usage: %prog [options] [pairFile] - regression test for
+    pubKeyVal.ConstKvDb. Compares its values with SqliteKvDb on random pairs or the
+    pairs in a tab-sep file with two fields.
+    """, "benchmark writing and lookups of ConstKvDb and SqliteKvDb instead")
+    parser.add_option("", "--count", dest="count", type="int", default=100000, \
+        help="number of random pairs if no pairFile is specified, default %default")
+    parser.add_option("", "--lookups", dest="lookups", type="int", default=100000, \
+        help="for --bench: number of random lookups, default %default")
+    (options, args) = parseArgs(parser)
+
+    if len(args)==0:
+        pairs = makePairs(options.count)
+    else:
+        pairs = readPairs(args[0])
+
+    if options.bench:
+        benchmark(pairs, options.lookups)
+    else:
+        testConst(pairs)
+
+if __name__=="__main__":
+    main()
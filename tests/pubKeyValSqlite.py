@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# regression test and benchmark for the bulk-load and WAL modes of pubKeyVal.SqliteKvDb
+
+# The same key-value pairs are written with the normal batched inserts, with bulk=True and with
+# indexKvFile, all dbs have to contain the same pairs. With --bench, the write throughput of a
+# new db with and without bulk loading and of updates of an existing db with and without WAL
+# is printed, the updates with another process that reads from the db at the same time.
+
+import os, time, random, shutil, multiprocessing
+from os.path import join
+
+from testLib import tempDir, checkResult, Timer, makeParser, parseArgs
+import pubKeyVal
+
+def makePairs(count, seed=1):
+    " random uniprot-like accession -> id pairs, with some duplicate keys "
+    random.seed(seed)
+    pairs = []
+    for i in range(count):
+        key = "P%07d" % random.randint(0, count)
+        val = "%s_HUMAN" % "".join([random.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ") for j in range(5)])
+        pairs.append( (key, val) )
+    return pairs
+
+def writeDb(fname, pairs, bulk, batchSize=100000):
+    " write pairs to a new db in batches, return the seconds it took "
+    with Timer() as timer:
+        db = pubKeyVal.SqliteKvDb(fname, singleProcess=True, newDb=True, eightBit=True, bulk=bulk)
+        for i in range(0, len(pairs), batchSize):
+            db.update(pairs[i:i+batchSize])
+        db.close()
+    return timer.seconds
+
+def readDb(fname):
+    " return all pairs of a db as a sorted list "
+    db = pubKeyVal.SqliteKvDb(fname, eightBit=True)
+    pairs = sorted(db.con.execute("SELECT key, value FROM data").fetchall())
+    db.close()
+    return pairs
+
+def testBulk(pairs):
+    " compare the pairs of dbs written in the different ways "
+    with tempDir("pubKeyValSqlite") as tmpDir:
+        writeDb(join(tmpDir, "plain"), pairs, False)
+        writeDb(join(tmpDir, "bulk"), pairs, True)
+        tabFname = join(tmpDir, "pairs.tab")
+        ofh = open(tabFname, "w")
+        for key, val in pairs:
+            ofh.write("%s\t%s\n" % (key, val))
+        ofh.close()
+        pubKeyVal.indexKvFile(tabFname)
+
+        expPairs = readDb(join(tmpDir, "plain"))
+        failed = False
+        for name in ["bulk", "pairs.tab"]:
+            if readDb(join(tmpDir, name))!=expPairs:
+                print("%s: different pairs than with normal inserts" % name)
+                failed = True
+        leftFiles = [f for f in os.listdir(tmpDir) if not f.endswith(".sqlite") and f!="pairs.tab"]
+        if len(leftFiles)!=0:
+            print("temporary files left: %s" % leftFiles)
+            failed = True
+    checkResult(failed, "%d pairs, %d keys" % (len(pairs), len(expPairs)))
+
+def readLoop(fname, keys, stopEvent, lookupCount):
+    " look up random keys until stopEvent is set, count them in lookupCount "
+    db = pubKeyVal.SqliteKvDb(fname, eightBit=True)
+    while not stopEvent.is_set():
+        db.get(random.choice(keys))
+        lookupCount.value += 1
+
+def benchUpdates(fname, pairs, wal, batchSize):
+    """ update an existing db with pairs while another process reads from it.
+    Return the seconds it took and the number of lookups of the reader per second. """
+    stopEvent = multiprocessing.Event()
+    lookupCount = multiprocessing.Value("l", 0)
+    keys = [k for k, v in pairs]
+    reader = multiprocessing.Process(target=readLoop, args=(fname, keys, stopEvent, lookupCount))
+    reader.start()
+    time.sleep(1)
+    startCount = lookupCount.value
+    with Timer() as timer:
+        db = pubKeyVal.SqliteKvDb(fname, eightBit=True, wal=wal)
+        for i in range(0, len(pairs), batchSize):
+            db.update(pairs[i:i+batchSize])
+        db.close()
+    readCount = lookupCount.value-startCount
+    stopEvent.set()
+    reader.join()
+    return timer.seconds, readCount/timer.seconds
+
+def benchmark(pairs, updateCount, batchSize):
+    " print the throughput of new dbs with and without bulk loading and of updates with and without WAL "
+    with tempDir("pubKeyValSqlite") as tmpDir:
+        for bulk in [False, True]:
+            fname = join(tmpDir, "bulk%s" % bulk)
+            seconds = writeDb(fname, pairs, bulk)
+            print("new db, bulk=%s: %d pairs, %.2f sec, %d pairs/sec" % \
+                (bulk, len(pairs), seconds, len(pairs)/seconds))
+
+        updatePairs = makePairs(updateCount, seed=2)
+        for wal in [False, True]:
+            fname = join(tmpDir, "wal%s" % wal)
+            shutil.copy(join(tmpDir, "bulkTrue.sqlite"), fname+".sqlite")
+            seconds, readsPerSec = benchUpdates(fname, updatePairs, wal, batchSize)
+            print("updates, wal=%s: %d pairs in batches of %d, %.2f sec, %d pairs/sec, reader: %d lookups/sec" % \
+                (wal, len(updatePairs), batchSize, seconds, len(updatePairs)/seconds, readsPerSec))
+
+def main():
+    parser = makeParser("""usage: %prog [options] - regression test for the bulk-load
+    mode of pubKeyVal.SqliteKvDb
+    """, "benchmark writing new dbs and updates instead")
+    parser.add_option("", "--count", dest="count", type="int", default=100000, \
+        help="number of random pairs, default %default")
+    parser.add_option("", "--updates", dest="updates", type="int", default=100000, \
+        help="for --bench: number of pairs added to an existing db, default %default")
+    parser.add_option("", "--batchSize", dest="batchSize", type="int", default=1000, \
+        help="for --bench: number of pairs per update, default %default")
+    (options, args) = parseArgs(parser)
+
+    pairs = makePairs(options.count)
+    if options.bench:
+        benchmark(pairs, options.updates, options.batchSize)
+    else:
+        testBulk(pairs)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# regression test and benchmark for the chaining step of pubMap:
+# chainPsls, onlyLongestChains and chainsToBeds, via chainPslToBed
+
+# pubMap/chainInput.psl are psls of 15 articles, pubMap/chainExpected.* are the
+# sorted .bed and .psl files that chainPslToBed wrote for them before chainPsls
+# and onlyLongestChains were rewritten. The order of chains with the same number
+# of members is not defined, so the output is compared sorted.
+
+import os, random, collections
+from os.path import join
+
+from testLib import testPath, tempDir, checkResult, Timer, makeParser, parseArgs
+import pubMap, pubConf
+
+# the fields of maxCommon.iterTsvRows(format="psl")
+PslRec = collections.namedtuple("psl", ["score", "misMatches", "repMatches", "nCount", \
+    "qNumInsert", "qBaseInsert", "tNumInsert", "tBaseInsert", "strand", "qName", "qSize", \
+    "qStart", "qEnd", "tName", "tSize", "tStart", "tEnd", "blockCount", "blockSizes", \
+    "qStarts", "tStarts"])
+
+def runChaining(pslFname, outDir):
+    " run chainPslToBed, return dict file extension -> sorted lines "
+    dbBedNames = pubMap.chainPslToBed(pslFname, join(outDir, "00000.hg19.bed"))
+    result = {}
+    for db in dbBedNames:
+        for ext in ["bed", "psl"]:
+            fname = join(outDir, "00000.%s.%s" % (db, ext))
+            result["%s.%s" % (db, ext)] = sorted(open(fname).readlines())
+    return result
+
+def testChaining():
+    " compare chainPslToBed output on the recorded input with the recorded output "
+    with tempDir("pubMapChain") as tmpDir:
+        result = runChaining(testPath("pubMap", "chainInput.psl"), tmpDir)
+
+    expExts = [f.replace("chainExpected.", "") for f in os.listdir(testPath("pubMap"))
+        if f.startswith("chainExpected.")]
+    failed = False
+    if sorted(result)!=sorted(expExts):
+        print("different output files: %s, expected %s" % (sorted(result), sorted(expExts)))
+        failed = True
+    for ext in expExts:
+        expLines = open(testPath("pubMap", "chainExpected."+ext)).readlines()
+        if result.get(ext)!=expLines:
+            print("%s: output differs from pubMap/chainExpected.%s" % (ext, ext))
+            failed = True
+    checkResult(failed, "%d files" % len(expExts))
+
+def makeGenePsls(geneCount, seed=1):
+    """ psls for one article with geneCount genes of 1, 2, ... geneCount sequences, e.g. a table
+    of primers. Every sequence also matches one random other locus. All chains have different
+    sizes, the worst case for onlyLongestChains. """
+    random.seed(seed)
+    psls = []
+    seqId = 0
+    for gene in range(geneCount):
+        for i in range(gene+1):
+            qName = "%d%03d%05d" % (4000000000, seqId // 100000, seqId % 100000)
+            seqId += 1
+            for tStart in [gene*1000000+i*100, (geneCount+random.randint(0, 3*geneCount))*1000000]:
+                psls.append(PslRec(30, 0, 0, 0, 0, 0, 0, 0, "+", qName, 30, 0, 30, "hg19,chr1,g", \
+                    300000000, tStart, tStart+30, 1, "30,", "0,", "%d," % tStart))
+    return psls
+
+def benchmark(geneCounts):
+    " print the time for chaining articles with many matches "
+    for geneCount in geneCounts:
+        psls = makeGenePsls(geneCount)
+        with Timer() as timer:
+            chains = pubMap.onlyLongestChains(pubMap.chainPsls(psls, pubConf.maxChainDist))
+        chainCount = sum([len(x) for x in chains.values()])
+        print("%d genes, %d matches: %d chains, %.2f seconds" % \
+            (geneCount, len(psls), chainCount, timer.seconds))
+
+def main():
+    parser = makeParser("""usage: %prog [options] - regression test for the pubMap chaining step
+    """, "benchmark chaining on articles with >1000 matches instead")
+    (options, args) = parseArgs(parser)
+
+    if options.bench:
+        benchmark([50, 100, 200, 400])
+    else:
+        testChaining()
+
+if __name__=="__main__":
+    main()
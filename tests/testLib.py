@@ -0,0 +1,54 @@
+# shared setup of the regression tests and benchmarks in this directory
+
+# Importing this module puts ../lib into sys.path. A test script usually has a test function
+# that calls checkResult and a benchmark function, and a main function that parses the options
+# with parseArgs and runs one of them, depending on --bench.
+
+import sys, os, time, tempfile, shutil, optparse, logging, contextlib
+from os.path import join, dirname, abspath
+
+testDir = dirname(abspath(__file__))
+libDir = join(dirname(testDir), "lib")
+if libDir not in sys.path:
+    sys.path.insert(0, libDir)
+
+def testPath(*parts):
+    " return the path of a file in the tests directory "
+    return join(testDir, *parts)
+
+@contextlib.contextmanager
+def tempDir(prefix):
+    " create a temporary directory and remove it with all its files at the end of the with-block "
+    dirName = tempfile.mkdtemp(prefix=prefix+".")
+    try:
+        yield dirName
+    finally:
+        shutil.rmtree(dirName)
+
+def checkResult(failed, okMsg):
+    " print FAILED and exit with 1 if failed is true, otherwise print 'OK, <okMsg>' "
+    if failed:
+        print("FAILED")
+        sys.exit(1)
+    print("OK, %s" % okMsg)
+
+class Timer(object):
+    " with Timer() as t: ..., then t.seconds is the time the with-block took "
+    def __enter__(self):
+        self.startTime = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.seconds = time.time()-self.startTime
+
+def makeParser(usage, benchHelp):
+    " return an OptionParser with the option --bench, the test scripts add their own options "
+    parser = optparse.OptionParser(usage)
+    parser.add_option("", "--bench", dest="bench", action="store_true", help=benchHelp)
+    return parser
+
+def parseArgs(parser):
+    " parse the command line and set up logging, return (options, args) "
+    (options, args) = parser.parse_args()
+    logging.basicConfig(level=logging.WARN)
+    return options, args
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# regression test and benchmark for the prefilter of varFinder.findVariantDescriptions
+
+# varFinder/corpus.txt has one document per line, with the mutation descriptions of all
+# patterns in regex.txt and text around them that is similar to them. The variants found with
+# the prefilter have to be the same as without it, where every pattern runs on the whole text.
+# Only the regexes are loaded, the gene data and the genome hg19.fa are replaced by stubs, so the
+# test runs without the varFinder data files.
+
+import logging
+
+from testLib import testPath, checkResult, Timer, makeParser, parseArgs
+import varFinder
+
+class StubSeqData(object):
+    " replaces varFinder.SeqData: the only lookup of findVariantDescriptions is rsIdToGenome "
+    def rsIdToGenome(self, rsId):
+        " a made-up position that depends only on the rsId "
+        return "chr1", int(rsId), int(rsId)+1
+
+def loadRegexes():
+    " load the regexes of varFinder, with stubs for the sequences and the genome "
+    varFinder.SequenceFileDB = lambda fname: {}
+    varFinder.loadDb(logLevel=logging.WARN, loadSequences=False)
+    varFinder.geneData = StubSeqData()
+
+def findVariants(docs, usePrefilter):
+    " return a list with the result of findVariantDescriptions for every document "
+    varFinder.usePrefilter = usePrefilter
+    return [varFinder.findVariantDescriptions(doc) for doc in docs]
+
+def readDocs(fnames):
+    " return the lines of the files as unicode strings "
+    docs = []
+    for fname in fnames:
+        for line in open(fname):
+            docs.append(line.rstrip("\n").decode("utf8"))
+    return docs
+
+def testPrefilter(docs):
+    " compare the variants found with and without prefilter "
+    # the documents are short, so make sure that the windows are used for all of them
+    varFinder.WINDOWMAXFRAC = float("inf")
+    expected = findVariants(docs, False)
+    found = findVariants(docs, True)
+    failed = False
+    varCount = 0
+    for doc, exp, res in zip(docs, expected, found):
+        varCount += sum([len(x) for x in exp.values()])
+        if repr(exp)!=repr(res):
+            print("different result for %s" % doc[:80].encode("utf8"))
+            print("without prefilter: %s" % repr(exp))
+            print("with prefilter: %s" % repr(res))
+            failed = True
+    checkResult(failed, "%d documents, %d variants" % (len(docs), varCount))
+
+def benchmark(docs, repeat):
+    " print the throughput with and without the prefilter "
+    byteCount = repeat*sum([len(doc) for doc in docs])
+    for usePrefilter in [False, True]:
+        with Timer() as timer:
+            for i in range(repeat):
+                findVariants(docs, usePrefilter)
+        print("prefilter %s: %d documents, %.2f seconds, %.2f MB/sec" % \
+            (usePrefilter, repeat*len(docs), timer.seconds, byteCount/timer.seconds/1000000.0))
+
+def main():
+    parser = makeParser("""usage: %prog [options] [textFiles] - regression test for the
+    varFinder prefilter. Compares the variants found with and without the prefilter in
+    varFinder/corpus.txt or the textFiles, one document per line.
+    """, "benchmark findVariantDescriptions with and without the prefilter instead")
+    parser.add_option("", "--repeat", dest="repeat", type="int", default=100, \
+        help="for --bench: run over the documents this many times, default %default")
+    (options, args) = parseArgs(parser)
+
+    fnames = args
+    if len(fnames)==0:
+        fnames = [testPath("varFinder", "corpus.txt")]
+    docs = readDocs(fnames)
+    loadRegexes()
+
+    if options.bench:
+        benchmark(docs, options.repeat)
+    else:
+        testPrefilter(docs)
+
+if __name__=="__main__":
+    main()